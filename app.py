@@ -1,209 +1,2593 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
-from flask_socketio import SocketIO, emit
+from flask import Flask, Request, render_template, request, jsonify, send_from_directory, send_file, g, has_app_context, has_request_context, Response
+from flask_socketio import SocketIO, emit, join_room
 from flask_cors import CORS
+import atexit
 import base64
+import codecs
+import hashlib
 import io
 import os
-import google.generativeai as genai
-from PIL import Image
 import json
+import random
+import shutil
+import sqlite3
+import subprocess
+import tempfile
 import time
-import requests
+import wave
+from array import array
+from bisect import bisect_right
 from dotenv import load_dotenv
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
-from elevenlabs.client import ElevenLabs
 import re
+import threading
+from contextlib import contextmanager
+import queue
+import uuid
+from collections import OrderedDict, deque
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 
+try:
+    import audioop  # stdlib up to Python 3.12; without it WAV clips are only preprocessed when ffmpeg is installed
+except ImportError:
+    audioop = None
+
+
+load_dotenv()
+
+class FixItRequest(Request):
+    """Request whose body size cap can be set per endpoint via `request.body_limit` before the body is read."""
+    body_limit = None
+
+    @property
+    def max_content_length(self):
+        if self.body_limit is not None:
+            return self.body_limit
+        return super().max_content_length
+
+app = Flask(__name__, static_folder='build/static', template_folder='build')
+app.request_class = FixItRequest
+CORS(app)
+
+# With several workers, Socket.IO events go through a message queue (e.g. redis://localhost:6379/0,
+# or zmq+tcp://127.0.0.1:5555+5556 for a local broker) so they reach clients connected to any worker.
+# The queue's client library (redis, kombu or pyzmq) is an optional dependency.
+SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE') or None
+SOCKETIO_CHANNEL = os.getenv('SOCKETIO_CHANNEL', 'fixit')
+
+try:
+    socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading",
+                        message_queue=SOCKETIO_MESSAGE_QUEUE, channel=SOCKETIO_CHANNEL)
+except (RuntimeError, ValueError, ImportError) as e:
+    if not SOCKETIO_MESSAGE_QUEUE:
+        raise
+    print(f"Warning: Failed to connect Socket.IO to {SOCKETIO_MESSAGE_QUEUE} ({e}). Events will only reach this worker's clients.")
+    socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading")
+
+# Upstream clients are created on first use: importing the Gemini and ElevenLabs SDKs
+# takes most of the process start-up time, so it stays off the cold-start path
+# (see WarmUp below for loading them in the background instead).
+# You'll need to set your API keys as environment variables: GEMINI_API_KEY, ELEVENLABS_API_KEY
+GEMINI_MODEL_NAME = os.getenv('GEMINI_MODEL', 'gemini-2.0-flash-exp')
+ELEVENLABS_API_KEY = os.getenv('ELEVENLABS_API_KEY')
+
+# Set by get_model() / get_elevenlabs_client(); tests and bench.py may assign their own
+model = None
+elevenlabs_client = None
+_elevenlabs_failed = False
+_model_lock = threading.Lock()
+_elevenlabs_lock = threading.Lock()
+
+if not ELEVENLABS_API_KEY:
+    print("Warning: ELEVENLABS_API_KEY not found. Text-to-speech will be disabled.")
+
+def get_model():
+    """The shared Gemini model; the SDK is imported and configured on the first call."""
+    global model
+    if model is None:
+        with _model_lock:
+            if model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+                model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    return model
+
+def get_elevenlabs_client(retry=False):
+    """
+    The shared ElevenLabs client (SDK imported on the first call), or None when TTS is
+    disabled. After a failed build it stays None, unless `retry` asks for another attempt.
+    """
+    global elevenlabs_client, _elevenlabs_failed
+    if elevenlabs_client is None and ELEVENLABS_API_KEY and (retry or not _elevenlabs_failed):
+        with _elevenlabs_lock:
+            if elevenlabs_client is None and (retry or not _elevenlabs_failed):
+                _elevenlabs_failed = False
+                try:
+                    from elevenlabs.client import ElevenLabs
+                    elevenlabs_client = ElevenLabs(api_key=ELEVENLABS_API_KEY)
+                except Exception as e:
+                    print(f"Warning: Failed to initialize ElevenLabs client: {e}")
+                    _elevenlabs_failed = True
+    return elevenlabs_client
+
+def tts_enabled():
+    """Whether TTS is configured, without importing the SDK."""
+    return elevenlabs_client is not None or (bool(ELEVENLABS_API_KEY) and not _elevenlabs_failed)
+
+# Per-stage latency histograms, exposed Prometheus-style at /api/metrics
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SERVER_TIMING_HEADER = os.getenv('SERVER_TIMING_HEADER', '0') == '1'
+
+class Histogram:
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(METRICS_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.count += 1
+
+class Metrics:
+    """Thread-safe histograms, counters and gauges keyed by (metric name, label tuple)."""
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def render(self, extra_gauges=()):
+        """Prometheus text exposition format."""
+        def fmt_labels(labels, **more):
+            items = list(labels) + list(more.items())
+            if not items:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            gauges = sorted(list(self._gauges.items()) + list(extra_gauges))
+            histograms = [(key, (list(h.counts), h.total, h.count)) for key, h in histograms]
+
+        typed = set()
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in typed:
+                lines.append(f'# TYPE {name} histogram')
+                typed.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(METRICS_BUCKETS, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{fmt_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_bucket{fmt_labels(labels, le="+Inf")} {count}')
+            lines.append(f'{name}_sum{fmt_labels(labels)} {total}')
+            lines.append(f'{name}_count{fmt_labels(labels)} {count}')
+        for kind, series in (('counter', counters), ('gauge', gauges)):
+            for (name, labels), value in series:
+                if name not in typed:
+                    lines.append(f'# TYPE {name} {kind}')
+                    typed.add(name)
+                lines.append(f'{name}{fmt_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+@contextmanager
+def timed(stage):
+    """
+    Time a pipeline stage into the fixit_stage_duration_seconds histogram. Inside a
+    request the span is also kept on `g` for the optional Server-Timing header.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe('fixit_stage_duration_seconds', elapsed, stage=stage)
+        if has_app_context():
+            spans = g.get('timing_spans')
+            if spans is not None:
+                spans.append((stage, elapsed))
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.timing_spans = []
+
+@app.after_request
+def record_request_timing(response):
+    start = g.get('request_start')
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    metrics.observe('fixit_request_duration_seconds', elapsed, endpoint=request.endpoint or 'unknown')
+    if SERVER_TIMING_HEADER or request.headers.get('X-Timing') == '1':
+        spans = [f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in g.get('timing_spans') or []]
+        spans.append(f'total;dur={elapsed * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(spans)
+    return response
+
+# Admission control: bounded concurrency and wait queues in front of the upstream APIs
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', '8'))
+GEMINI_MAX_QUEUE = int(os.getenv('GEMINI_MAX_QUEUE', '32'))
+TTS_MAX_CONCURRENCY = int(os.getenv('TTS_MAX_CONCURRENCY', '4'))
+TTS_MAX_QUEUE = int(os.getenv('TTS_MAX_QUEUE', '32'))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv('UPSTREAM_QUEUE_TIMEOUT', '15'))
+UPSTREAM_MAX_QUEUED_PER_SESSION = int(os.getenv('UPSTREAM_MAX_QUEUED_PER_SESSION', '4'))
+UPSTREAM_MAX_RETRIES = int(os.getenv('UPSTREAM_MAX_RETRIES', '2'))
+UPSTREAM_BACKOFF_BASE = float(os.getenv('UPSTREAM_BACKOFF_BASE', '0.5'))
+UPSTREAM_BACKOFF_MAX = float(os.getenv('UPSTREAM_BACKOFF_MAX', '8'))
+
+class UpstreamOverloaded(Exception):
+    """Raised when an upstream pool can't admit a call: 503 when the server is saturated, 429 for a session over its share."""
+
+    def __init__(self, pool, reason, status=503, retry_after=1):
+        super().__init__(f"{pool} {reason}")
+        self.pool = pool
+        self.status = status
+        self.retry_after = retry_after
+
+class UpstreamPool:
+    """
+    Concurrency limiter for one upstream API. Up to `max_concurrent` calls run at
+    once; the rest wait in per-session queues served round-robin, so one chatty
+    session can't starve the others. Calls are rejected immediately when the wait
+    queue is full (or the session already has `max_per_session` waiting), and
+    after `queue_timeout` seconds of waiting.
+    """
+
+    def __init__(self, name, max_concurrent, max_queue, queue_timeout, max_per_session):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_per_session = max_per_session
+        self._cond = threading.Condition()
+        self._active = 0
+        self._queued = 0
+        self._waiting = OrderedDict()  # session_id -> deque of tickets, in round-robin order
+
+    def is_full(self):
+        """True when a new call would be rejected outright; lets handlers refuse work before decoding uploads."""
+        with self._cond:
+            return self._active >= self.max_concurrent and self._queued >= self.max_queue
+
+    def admit(self, session_id):
+        """
+        Raise the UpstreamOverloaded that acquire() would raise right now, without
+        taking a slot. For work handed to another thread, so it is refused up front.
+        """
+        with self._cond:
+            if self._active < self.max_concurrent and not self._queued:
+                return
+            self._check_queue(session_id)
+
+    def _check_queue(self, session_id):
+        # Caller holds the lock. Raises if the call may not wait in the queue.
+        if self._queued >= self.max_queue:
+            raise self._reject('queue full')
+        session_queue = self._waiting.get(session_id)
+        if session_queue is not None and len(session_queue) >= self.max_per_session:
+            raise self._reject('session over its share', status=429)
+
+    def _publish(self):
+        # Caller holds the lock.
+        metrics.set_gauge('fixit_upstream_active', self._active, pool=self.name)
+        metrics.set_gauge('fixit_upstream_queue_depth', self._queued, pool=self.name)
+
+    def _reject(self, reason, status=503):
+        metrics.inc('fixit_upstream_rejected_total', pool=self.name, reason=reason.replace(' ', '_'))
+        return UpstreamOverloaded(self.name, reason, status=status)
+
+    def acquire(self, session_id):
+        start = time.perf_counter()
+        with self._cond:
+            if self._active < self.max_concurrent and not self._queued:
+                self._active += 1
+                self._publish()
+                metrics.observe('fixit_upstream_wait_seconds', 0.0, pool=self.name)
+                return
+            self._check_queue(session_id)
+
+            ticket = [False]
+            self._waiting.setdefault(session_id, deque()).append(ticket)
+            self._queued += 1
+            self._publish()
+            deadline = time.monotonic() + self.queue_timeout
+            while not ticket[0]:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    session_queue = self._waiting.get(session_id)
+                    session_queue.remove(ticket)
+                    if not session_queue:
+                        del self._waiting[session_id]
+                    self._queued -= 1
+                    self._publish()
+                    raise self._reject('queue timeout')
+                self._cond.wait(remaining)
+        metrics.observe('fixit_upstream_wait_seconds', time.perf_counter() - start, pool=self.name)
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            # Hand freed slots to the next waiting session, round-robin
+            while self._active < self.max_concurrent and self._waiting:
+                session_id, session_queue = next(iter(self._waiting.items()))
+                ticket = session_queue.popleft()
+                if session_queue:
+                    self._waiting.move_to_end(session_id)
+                else:
+                    del self._waiting[session_id]
+                self._queued -= 1
+                self._active += 1
+                ticket[0] = True
+            self._publish()
+            self._cond.notify_all()
+
+gemini_pool = UpstreamPool('gemini', GEMINI_MAX_CONCURRENCY, GEMINI_MAX_QUEUE,
+                           UPSTREAM_QUEUE_TIMEOUT, UPSTREAM_MAX_QUEUED_PER_SESSION)
+tts_pool = UpstreamPool('tts', TTS_MAX_CONCURRENCY, TTS_MAX_QUEUE,
+                        UPSTREAM_QUEUE_TIMEOUT, UPSTREAM_MAX_QUEUED_PER_SESSION)
+
+def _rate_limit_delay(exc):
+    """
+    If `exc` is an upstream rate-limit/unavailable error, the delay it asks for
+    (Retry-After when present, else 0). None for errors that shouldn't be retried.
+    """
+    status = getattr(exc, 'status_code', None) or getattr(exc, 'code', None)
+    try:
+        status = int(status)
+    except (TypeError, ValueError):
+        status = None
+    limited = status in (429, 503) or type(exc).__name__ in ('ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable')
+    if not limited:
+        return None
+    response = getattr(exc, 'response', None)
+    headers = getattr(exc, 'headers', None) or getattr(response, 'headers', None) or {}
+    try:
+        return max(float(headers.get('retry-after') or headers.get('Retry-After') or 0), 0.0)
+    except (TypeError, ValueError, AttributeError):
+        return 0.0
+
+def call_upstream(pool, session_id, fn, *args, **kwargs):
+    """
+    Run fn(*args, **kwargs) holding a slot in `pool`. Rate-limit responses are
+    retried up to UPSTREAM_MAX_RETRIES times with full-jitter exponential backoff,
+    never sooner than the upstream's Retry-After. The slot is held while backing
+    off so a throttled upstream sees less traffic, not more.
+    """
+    pool.acquire(session_id)
+    try:
+        attempt = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                delay = _rate_limit_delay(e)
+                if delay is None or attempt >= UPSTREAM_MAX_RETRIES:
+                    raise
+                backoff = random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * (2 ** attempt)))
+                metrics.inc('fixit_upstream_retries_total', pool=pool.name)
+                time.sleep(max(delay, backoff))
+                attempt += 1
+    finally:
+        pool.release()
+
+def current_session_id():
+    """Session id of the request being served (HTTP or Socket.IO), or 'background' off-request."""
+    if not has_request_context():
+        return 'background'
+    if getattr(request, 'sid', None):
+        return get_socket_session_id()
+    return get_session_id()
+
+def overloaded_response(e):
+    """HTTP response for an UpstreamOverloaded rejection."""
+    response = jsonify({'error': 'Server is busy, please retry shortly', 'reason': str(e)})
+    response.status_code = e.status
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+def gemini_generate(stage, contents, session_id=None, **kwargs):
+    """
+    model.generate_content through the Gemini pool, timed as `stage`. For streaming
+    calls the slot is held until the stream has been consumed.
+    """
+    session_id = session_id or current_session_id()
+    if not kwargs.get('stream'):
+        with timed(stage):
+            return call_upstream(gemini_pool, session_id, get_model().generate_content, contents, **kwargs)
+
+    gemini_pool.acquire(session_id)
+    try:
+        with timed(stage):
+            response = get_model().generate_content(contents, **kwargs)
+    except Exception:
+        gemini_pool.release()
+        raise
+
+    def release_when_done():
+        try:
+            yield from response
+        finally:
+            gemini_pool.release()
+    return release_when_done()
+
+WELCOME_MESSAGE = 'Welcome! Start your camera and point it at the object you need help with. I will use your live video feed as context when you ask questions.'
+
+# Chat history limits (per session)
+CHAT_HISTORY_MAX_ENTRIES = int(os.getenv('CHAT_HISTORY_MAX_ENTRIES', '200'))
+CHAT_MAX_SESSIONS = int(os.getenv('CHAT_MAX_SESSIONS', '1000'))
+CHAT_SESSION_TTL = float(os.getenv('CHAT_SESSION_TTL', '3600'))
+
+# Prompt context: verbatim recent turns within a token budget, older turns folded into a rolling summary
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', '1500'))
+# The most recent lines any prompt renders verbatim; older ones go to the summary even within budget
+HISTORY_TAIL_LINES = int(os.getenv('HISTORY_TAIL_LINES', '16'))
+HISTORY_SUMMARY_ENABLED = os.getenv('HISTORY_SUMMARY_ENABLED', '1') != '0'
+HISTORY_SUMMARY_MAX_CHARS = int(os.getenv('HISTORY_SUMMARY_MAX_CHARS', '1500'))
+summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='summary')
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) for budgeting prompt context."""
+    return len(text) // 4 + 1
+
+def format_history_line(entry):
+    """One chat entry as a prompt line, e.g. 'User: ...'."""
+    role = 'User' if entry.get('type') == 'user' else 'Assistant'
+    # prefer message field, fall back to text-like fields
+    text = entry.get('message') or entry.get('response') or ''
+    # keep short
+    text_snippet = text if len(text) <= 1000 else text[:1000] + '...'
+    return f"{role}: {text_snippet}"
+
+class ConversationContext:
+    """
+    Prompt context for one session, maintained incrementally. New entries are
+    formatted once on append into a verbatim tail capped at `token_budget` and
+    `max_lines` (the largest window render() is asked for); lines pushed out of the
+    tail wait in `unsummarized` until a background job folds them into `summary`.
+    Rendered strings are cached until the next change.
+    """
+    __slots__ = ('token_budget', 'max_lines', 'tail', 'tail_tokens', 'summary', 'unsummarized', 'summarizing', '_rendered')
+
+    def __init__(self, token_budget, max_lines=HISTORY_TAIL_LINES):
+        self.token_budget = token_budget
+        self.max_lines = max_lines
+        self.tail = deque()  # (line, tokens)
+        self.tail_tokens = 0
+        self.summary = ''
+        self.unsummarized = []
+        self.summarizing = False
+        self._rendered = {}  # limit -> formatted context
+
+    def append(self, entry):
+        line = format_history_line(entry)
+        tokens = estimate_tokens(line)
+        self.tail.append((line, tokens))
+        self.tail_tokens += tokens
+        while len(self.tail) > 1 and (self.tail_tokens > self.token_budget or len(self.tail) > self.max_lines):
+            old_line, old_tokens = self.tail.popleft()
+            self.tail_tokens -= old_tokens
+            if HISTORY_SUMMARY_ENABLED:
+                self.unsummarized.append(old_line)
+        self._rendered.clear()
+
+    def set_summary(self, summary):
+        self.summary = summary
+        self._rendered.clear()
+
+    def render(self, limit):
+        """Summary plus the last `limit` verbatim lines, formatted for the prompt."""
+        rendered = self._rendered.get(limit)
+        if rendered is None:
+            count = len(self.tail)
+            lines = [self.tail[i][0] for i in range(max(count - limit, 0), count)]
+            rendered = ''
+            if self.summary:
+                rendered += "Summary of the earlier conversation:\n" + self.summary + "\n\n"
+            if lines:
+                rendered += "Conversation history:\n" + "\n".join(lines) + "\n\n"
+            self._rendered[limit] = rendered
+        return rendered
+
+def summarize_history(summary, lines):
+    """Ask Gemini to fold `lines` into the running `summary`. Returns the new summary text."""
+    prompt = f"""
+    You maintain a running summary of a conversation between a user and a repair assistant.
+
+    Current summary:
+    {summary or '(empty)'}
+
+    New conversation turns to fold in:
+    {chr(10).join(lines)}
+
+    Write the updated summary in at most {HISTORY_SUMMARY_MAX_CHARS // 6} words. Keep the device
+    (exact make and model), the problem, steps already tried and their outcome, and any parts
+    or tools mentioned. Return only the summary text.
+    """
+    response = gemini_generate('gemini_summary', prompt)
+    return (response.text or '').strip()[:HISTORY_SUMMARY_MAX_CHARS]
+
+# Shared state for latest frames, cached replies and product-link jobs. 'memory' keeps
+# them in this process; 'sqlite' keeps them in a local database every worker on the
+# host opens, so the app can run as several processes behind one load balancer.
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory').strip().lower()
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'fixit_state.sqlite3')
+STATE_PURGE_INTERVAL = int(os.getenv('STATE_PURGE_INTERVAL', '256'))
+
+class MemoryState:
+    """
+    In-process state: namespaced key/value entries with an optional TTL, each namespace
+    an LRU capped by set_limit(). Values are stored by reference, so callers must not
+    mutate what they get back.
+    """
+    shared = False
+
+    def __init__(self):
+        self._namespaces = {}  # namespace -> OrderedDict key -> (expires, value), least recently used first
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def set_limit(self, namespace, max_entries):
+        with self._lock:
+            self._limits[namespace] = max_entries
+
+    def _entries(self, namespace):
+        # Caller holds the lock.
+        entries = self._namespaces.get(namespace)
+        if entries is None:
+            entries = self._namespaces[namespace] = OrderedDict()
+        return entries
+
+    def get(self, namespace, key):
+        with self._lock:
+            entries = self._entries(namespace)
+            item = entries.get(key)
+            if item is None:
+                return None
+            if item[0] is not None and item[0] < time.time():
+                del entries[key]
+                return None
+            entries.move_to_end(key)
+            return item[1]
+
+    def set(self, namespace, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            entries = self._entries(namespace)
+            entries[key] = (expires, value)
+            entries.move_to_end(key)
+            limit = self._limits.get(namespace)
+            while limit is not None and len(entries) > limit:
+                entries.popitem(last=False)
+            # Expired entries mostly sit at the least recently used end
+            while entries:
+                oldest = next(iter(entries.values()))
+                if oldest[0] is None or oldest[0] >= time.time():
+                    break
+                entries.popitem(last=False)
+
+    def touch(self, namespace, key, ttl):
+        """Restart an entry's TTL. Returns False if it is gone."""
+        with self._lock:
+            entries = self._entries(namespace)
+            item = entries.get(key)
+            if item is None or (item[0] is not None and item[0] < time.time()):
+                entries.pop(key, None)
+                return False
+            entries[key] = (time.time() + ttl, item[1])
+            entries.move_to_end(key)
+            return True
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._entries(namespace).pop(key, None)
+
+    def clear(self, namespace):
+        with self._lock:
+            self._entries(namespace).clear()
+
+    def count(self, namespace):
+        now = time.time()
+        with self._lock:
+            entries = self._entries(namespace)
+            for key in [k for k, (expires, _) in entries.items() if expires is not None and expires < now]:
+                del entries[key]
+            return len(entries)
+
+def _state_json_default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'$bytes': base64.b64encode(value).decode('ascii')}
+    raise TypeError(f'{type(value).__name__} is not storable in shared state')
+
+def _state_json_hook(obj):
+    if len(obj) == 1 and '$bytes' in obj:
+        return base64.b64decode(obj['$bytes'])
+    return obj
+
+class SQLiteState:
+    """
+    State shared by every process that opens the same SQLite file. Values must be
+    JSON-compatible (bytes are stored base64-encoded), so the file only ever holds
+    data, never anything executable on load; reads are point lookups on (namespace,
+    key). Expired rows and rows past a namespace's limit (oldest write first) are
+    purged every `purge_interval` writes.
+    """
+    shared = True
+
+    def __init__(self, path, purge_interval=256):
+        self.path = path
+        self.purge_interval = purge_interval
+        self._limits = {}
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS state (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires REAL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            ) WITHOUT ROWID
+        ''')
+
+    def set_limit(self, namespace, max_entries):
+        self._limits[namespace] = max_entries
+
+    def get(self, namespace, key):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, expires FROM state WHERE namespace = ? AND key = ?', (namespace, key)
+            ).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        try:
+            return json.loads(row[0], object_hook=_state_json_hook)
+        except (TypeError, ValueError):
+            # Not written by this version; treat as missing
+            return None
+
+    def set(self, namespace, key, value, ttl=None):
+        now = time.time()
+        encoded = json.dumps(value, default=_state_json_default, separators=(',', ':'))
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO state (namespace, key, value, expires, updated) VALUES (?, ?, ?, ?, ?)',
+                (namespace, key, encoded, now + ttl if ttl else None, now)
+            )
+            self._writes += 1
+            if self._writes % self.purge_interval == 0:
+                self._purge(now)
+
+    def touch(self, namespace, key, ttl):
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                'UPDATE state SET expires = ?, updated = ? WHERE namespace = ? AND key = ? AND (expires IS NULL OR expires >= ?)',
+                (now + ttl, now, namespace, key, now)
+            )
+        return cursor.rowcount > 0
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._conn.execute('DELETE FROM state WHERE namespace = ? AND key = ?', (namespace, key))
+
+    def clear(self, namespace):
+        with self._lock:
+            self._conn.execute('DELETE FROM state WHERE namespace = ?', (namespace,))
+
+    def count(self, namespace):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM state WHERE namespace = ? AND (expires IS NULL OR expires >= ?)',
+                (namespace, time.time())
+            ).fetchone()[0]
+
+    def _purge(self, now):
+        # Caller holds the lock.
+        try:
+            self._conn.execute('DELETE FROM state WHERE expires < ?', (now,))
+            for namespace, limit in self._limits.items():
+                self._conn.execute(
+                    'DELETE FROM state WHERE namespace = ? AND key IN '
+                    '(SELECT key FROM state WHERE namespace = ? ORDER BY updated DESC LIMIT -1 OFFSET ?)',
+                    (namespace, namespace, limit)
+                )
+        except sqlite3.Error as e:
+            print(f"Error purging shared state: {e}")
+
+def create_state_backend(name):
+    if name == 'sqlite':
+        try:
+            return SQLiteState(STATE_DB_PATH, STATE_PURGE_INTERVAL)
+        except sqlite3.Error as e:
+            print(f"Warning: Failed to open state database {STATE_DB_PATH}: {e}. Falling back to in-process state.")
+    elif name != 'memory':
+        print(f"Warning: Unknown STATE_BACKEND {name!r}. Using in-process state.")
+    return MemoryState()
+
+state = create_state_backend(STATE_BACKEND)
+
+# Durable history: an append-only SQLite log written in batches by a background thread
+HISTORY_DB_PATH = os.getenv('HISTORY_DB_PATH', 'chat_history.sqlite3')
+HISTORY_FLUSH_INTERVAL = float(os.getenv('HISTORY_FLUSH_INTERVAL', '0.2'))
+HISTORY_FLUSH_BATCH = int(os.getenv('HISTORY_FLUSH_BATCH', '256'))
+
+class HistoryLog:
+    """
+    Append-only chat log in SQLite. Every entry is a row keyed by (session_id, seq);
+    clearing a session appends a 'reset' marker rather than deleting, and loads only
+    read past the latest marker. Writes are queued and committed by one writer thread,
+    up to `batch_size` rows per transaction, so request threads never wait on disk.
+
+    A `shared` log may be written by several processes at once: writes are synchronous
+    and allocate seqs inside the transaction (append_now), and changes_since() lets a
+    process catch up on what the others appended.
+    """
+
+    def __init__(self, path, flush_interval=0.2, batch_size=256, shared=False):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.shared = shared
+        self._queue = queue.Queue()
+        self._read_lock = threading.Lock()
+        self._reader = self._connect()
+        self._reader.executescript('''
+            CREATE TABLE IF NOT EXISTS chat_log (
+                id INTEGER PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                timestamp REAL NOT NULL,
+                kind TEXT NOT NULL,
+                entry TEXT
+            );
+            CREATE INDEX IF NOT EXISTS chat_log_session_seq ON chat_log (session_id, seq);
+            CREATE INDEX IF NOT EXISTS chat_log_session_time ON chat_log (session_id, timestamp);
+        ''')
+        if not shared:
+            self._writer = threading.Thread(target=self._write_loop, name='history-log', daemon=True)
+            self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        # WAL lets loads read while the writer thread commits
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def append(self, session_id, seq, entry):
+        self._queue.put((session_id, seq, entry.get('timestamp') or time.time(), 'entry', json.dumps(entry)))
+
+    def reset(self, session_id, seq):
+        self._queue.put((session_id, seq, time.time(), 'reset', None))
+
+    def load(self, session_id, limit):
+        """(entries, last_seq) for a session: its newest `limit` entries since the last reset."""
+        if self._queue.unfinished_tasks:
+            # The session may have been evicted from memory with writes still queued
+            self.flush()
+        with self._read_lock:
+            last_seq, reset_seq = self._reader.execute(
+                "SELECT MAX(seq), MAX(CASE WHEN kind = 'reset' THEN seq END) FROM chat_log WHERE session_id = ?",
+                (session_id,)
+            ).fetchone()
+            rows = self._reader.execute(
+                "SELECT entry FROM chat_log WHERE session_id = ? AND kind = 'entry' AND seq > ? ORDER BY seq DESC LIMIT ?",
+                (session_id, reset_seq or 0, limit)
+            ).fetchall()
+        return [json.loads(row[0]) for row in reversed(rows)], last_seq or 0
+
+    def append_now(self, session_id, entries, reset=False):
+        """
+        Commit `entries` (after a reset marker, if `reset`) before returning, numbering
+        them after the session's highest seq so concurrent writers never collide.
+        Sets each entry's 'seq' and returns the last one.
+        """
+        with self._read_lock:
+            conn = self._reader
+            # IMMEDIATE takes the write lock up front, so MAX(seq) can't change under us
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                seq = conn.execute('SELECT MAX(seq) FROM chat_log WHERE session_id = ?', (session_id,)).fetchone()[0] or 0
+                rows = []
+                if reset:
+                    seq += 1
+                    rows.append((session_id, seq, time.time(), 'reset', None))
+                for entry in entries:
+                    seq += 1
+                    entry['seq'] = seq
+                    rows.append((session_id, seq, entry.get('timestamp') or time.time(), 'entry', json.dumps(entry)))
+                conn.executemany('INSERT INTO chat_log (session_id, seq, timestamp, kind, entry) VALUES (?, ?, ?, ?, ?)', rows)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        metrics.inc('fixit_history_rows_written_total', len(rows))
+        return seq
+
+    def changes_since(self, session_id, seq):
+        """[(seq, kind, entry)] logged for a session after `seq`, oldest first."""
+        with self._read_lock:
+            rows = self._reader.execute(
+                'SELECT seq, kind, entry FROM chat_log WHERE session_id = ? AND seq > ? ORDER BY seq', (session_id, seq)
+            ).fetchall()
+        return [(row_seq, kind, json.loads(entry) if entry else None) for row_seq, kind, entry in rows]
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far is committed."""
+        if self.shared:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and not isinstance(batch[-1], threading.Event):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            rows = [item for item in batch if isinstance(item, tuple)]
+            if rows:
+                try:
+                    with conn:
+                        conn.executemany(
+                            'INSERT INTO chat_log (session_id, seq, timestamp, kind, entry) VALUES (?, ?, ?, ?, ?)', rows
+                        )
+                    metrics.inc('fixit_history_rows_written_total', len(rows))
+                except sqlite3.Error as e:
+                    print(f"Error writing chat history: {e}")
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+                self._queue.task_done()
+
+history_log = None
+if HISTORY_DB_PATH:
+    try:
+        # Every worker sharing state writes the same log, so none may cache seqs locally
+        history_log = HistoryLog(HISTORY_DB_PATH, HISTORY_FLUSH_INTERVAL, HISTORY_FLUSH_BATCH, shared=state.shared)
+        atexit.register(history_log.flush, 5)
+    except sqlite3.Error as e:
+        print(f"Warning: Failed to open chat history database {HISTORY_DB_PATH}: {e}. History will not survive restarts.")
+elif state.shared:
+    print("Warning: HISTORY_DB_PATH is empty, so chat history is not shared between workers.")
+
+class _SessionHistory:
+    __slots__ = ('entries', 'last_access', 'context', 'last_seq')
+
+    def __init__(self, max_entries, token_budget):
+        self.entries = deque(maxlen=max_entries)
+        self.last_access = time.time()
+        self.context = ConversationContext(token_budget)
+        self.last_seq = 0
+
+class SessionHistoryStore:
+    """
+    Chat history keyed by session id. Each session keeps a bounded ring buffer of
+    entries; sessions idle longer than `ttl` (or beyond `max_sessions`, least
+    recently used first) are evicted from memory. With a HistoryLog, every change
+    is also logged and a session is loaded from the log the first time it is used.
+    Entries get a per-session `seq` that clients can page with. All access goes
+    through one lock so the store is safe under the threading Socket.IO mode.
+    With a shared log, seqs are allocated by the log and every access first catches
+    up on entries other processes appended, so all workers see one history.
+    """
+
+    def __init__(self, max_entries=200, max_sessions=1000, ttl=3600, token_budget=1500, log=None):
+        self.max_entries = max_entries
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.token_budget = token_budget
+        self.log = log
+        self._sessions = OrderedDict()  # session_id -> _SessionHistory, oldest access first
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        # Caller holds the lock. Sessions are kept in access order, so expired ones sit at the front.
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if len(self._sessions) > self.max_sessions or now - session.last_access > self.ttl:
+                del self._sessions[session_id]
+            else:
+                break
+
+    def _get(self, session_id, create=True):
+        # Caller holds the lock.
+        now = time.time()
+        self._evict(now)
+        session = self._sessions.get(session_id)
+        if session is None:
+            if not create:
+                return None
+            session = _SessionHistory(self.max_entries, self.token_budget)
+            if self.log:
+                entries, session.last_seq = self.log.load(session_id, self.max_entries)
+                for entry in entries:
+                    session.entries.append(entry)
+                    session.context.append(entry)
+            self._sessions[session_id] = session
+            self._evict(now)
+        else:
+            self._sessions.move_to_end(session_id)
+            if self.log and self.log.shared:
+                self._sync(session_id, session)
+        session.last_access = now
+        return session
+
+    def _sync(self, session_id, session):
+        # Caller holds the lock. Applies entries and resets logged after session.last_seq.
+        for seq, kind, entry in self.log.changes_since(session_id, session.last_seq):
+            if kind == 'reset':
+                session.entries.clear()
+                session.context = ConversationContext(self.token_budget)
+            else:
+                session.entries.append(entry)
+                session.context.append(entry)
+            session.last_seq = seq
+
+    def append(self, session_id, entry):
+        with self._lock:
+            session = self._get(session_id)
+            if self.log and self.log.shared:
+                self.log.append_now(session_id, [entry])
+                # Picks up this entry along with anything another worker appended first
+                self._sync(session_id, session)
+            else:
+                session.last_seq += 1
+                entry['seq'] = session.last_seq
+                session.entries.append(entry)
+                session.context.append(entry)
+                if self.log:
+                    self.log.append(session_id, entry['seq'], entry)
+            context = session.context
+        self._schedule_summary(context)
+
+    def prompt_context(self, session_id, limit):
+        """Cached prompt context (rolling summary + last `limit` lines within the token budget)."""
+        with self._lock:
+            # With a log, a session not yet in memory may still exist on disk
+            session = self._get(session_id, create=bool(self.log))
+            return session.context.render(limit) if session else ''
+
+    def _schedule_summary(self, context):
+        with self._lock:
+            if context.summarizing or not context.unsummarized:
+                return
+            context.summarizing = True
+        summary_executor.submit(self._refresh_summary, context)
+
+    def _refresh_summary(self, context):
+        # Runs on summary_executor, never on a request thread
+        with self._lock:
+            lines, context.unsummarized = context.unsummarized, []
+            summary = context.summary
+        try:
+            new_summary = summarize_history(summary, lines)
+        except Exception as e:
+            print(f"Error summarizing chat history: {e}")
+            new_summary = None
+        with self._lock:
+            if new_summary:
+                context.set_summary(new_summary)
+            else:
+                # Keep the lines for the next attempt, but don't let them pile up
+                context.unsummarized = (lines + context.unsummarized)[-self.max_entries:]
+            context.summarizing = False
+            retry = bool(new_summary) and bool(context.unsummarized)
+        if retry:
+            self._schedule_summary(context)
+
+    def all(self, session_id):
+        return self.page(session_id)[0]
+
+    def page(self, session_id, since=None, limit=None):
+        """
+        (entries, last_seq) for a session. With `since`, only entries whose seq is
+        greater, oldest first and at most `limit` of them; without it, the newest `limit`.
+        """
+        with self._lock:
+            session = self._get(session_id, create=bool(self.log))
+            if session is None:
+                return [], 0
+            if since is not None:
+                entries = [entry for entry in session.entries if entry.get('seq', 0) > since]
+                if limit is not None:
+                    entries = entries[:limit]
+            else:
+                entries = list(session.entries)
+                if limit is not None:
+                    entries = entries[-limit:] if limit else []
+            return entries, session.last_seq
+
+    def reset(self, session_id, entries=()):
+        """Replace a session's history with `entries`."""
+        with self._lock:
+            session = self._get(session_id)
+            if self.log and self.log.shared:
+                self.log.append_now(session_id, list(entries), reset=True)
+                self._sync(session_id, session)
+                return
+            session.entries.clear()
+            session.context = ConversationContext(self.token_budget)
+            # The reset takes a seq of its own so cursors and ETags move even when no entries follow
+            session.last_seq += 1
+            if self.log:
+                self.log.reset(session_id, session.last_seq)
+            for entry in entries:
+                session.last_seq += 1
+                entry['seq'] = session.last_seq
+                session.entries.append(entry)
+                session.context.append(entry)
+                if self.log:
+                    self.log.append(session_id, entry['seq'], entry)
+
+    def session_count(self):
+        with self._lock:
+            return len(self._sessions)
+
+# Store chat history, one bounded conversation per session
+history_store = SessionHistoryStore(
+    max_entries=CHAT_HISTORY_MAX_ENTRIES,
+    max_sessions=CHAT_MAX_SESSIONS,
+    ttl=CHAT_SESSION_TTL,
+    token_budget=HISTORY_TOKEN_BUDGET,
+    log=history_log,
+)
+
+def get_session_id(data=None):
+    """
+    Identify the caller's chat session. Clients send a stable id in the
+    X-Session-Id header (or a `session_id` field); anonymous callers are keyed by address.
+    Handlers that consume the body themselves pass the fields they parsed as `data`.
+    The result is remembered for the rest of the request.
+    """
+    if 'session_id' in g:
+        return g.session_id
+    session_id = request.headers.get('X-Session-Id') or request.args.get('session_id')
+    if not session_id and request.form:
+        session_id = request.form.get('session_id')
+    if not session_id:
+        if data is None:
+            data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            session_id = data.get('session_id')
+    session_id = str(session_id or '').strip()[:128]
+    g.session_id = session_id or f"anonymous:{request.remote_addr}"
+    return g.session_id
+
+def add_chat_entry(session_id, entry):
+    """Append an entry to a session's chat history (logged to disk when HISTORY_DB_PATH is set)."""
+    history_store.append(session_id, entry)
+
+def remove_links_from_text(text):
+    """Remove URLs and markdown links from text for TTS."""
+    # Remove markdown links [text](url)
+    text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
+    # Remove standalone URLs
+    text = re.sub(r'https?://[^\s]+', '', text)
+    # Remove email addresses
+    text = re.sub(r'\S+@\S+\.\S+', '', text)
+    # Clean up extra whitespace
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text
+
+# ElevenLabs voice settings
+TTS_VOICE_ID = "JBFqnCBsd6RMkjVDRZzb"
+TTS_MODEL_ID = "eleven_multilingual_v2"
+
+# Sentence-level TTS: worker count and the shortest text worth a separate request. There is
+# a thread for every call tts_pool can run or queue, so TTS waits happen in the pool's fair,
+# bounded queue rather than in the executor's FIFO.
+TTS_MAX_WORKERS = int(os.getenv('TTS_MAX_WORKERS', str(TTS_MAX_CONCURRENCY + TTS_MAX_QUEUE)))
+TTS_MIN_CHUNK_CHARS = int(os.getenv('TTS_MIN_CHUNK_CHARS', '40'))
+tts_executor = ThreadPoolExecutor(max_workers=TTS_MAX_WORKERS, thread_name_prefix='tts')
+
+# Background product-link lookups: worker count, max lookups in flight, how long results are kept
+LINKS_MAX_WORKERS = int(os.getenv('LINKS_MAX_WORKERS', '4'))
+LINKS_MAX_PENDING = int(os.getenv('LINKS_MAX_PENDING', '64'))
+LINKS_RESULT_TTL = float(os.getenv('LINKS_RESULT_TTL', '600'))
+links_executor = ThreadPoolExecutor(max_workers=LINKS_MAX_WORKERS, thread_name_prefix='links')
+
+# TTS audio cache: in-memory LRU with a byte budget, plus optional raw MP3 files on disk
+TTS_CACHE_MEMORY_BYTES = int(os.getenv('TTS_CACHE_MEMORY_BYTES', str(32 * 1024 * 1024)))
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR')
+TTS_CACHE_DISK_BYTES = int(os.getenv('TTS_CACHE_DISK_BYTES', str(512 * 1024 * 1024)))
+
+class TTSCache:
+    """
+    Content-addressed cache of synthesized speech. Keys hash the cleaned text with
+    the voice and model ids. A memory tier holds up to `memory_bytes` of audio
+    (least recently used evicted first); if `disk_dir` is set, audio is also written
+    there as raw .mp3 files (oldest pruned beyond `disk_bytes`) and promoted back
+    into memory on a disk hit.
+    """
+
+    def __init__(self, memory_bytes, disk_dir=None, disk_bytes=0):
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()  # key -> audio bytes
+        self._memory_used = 0
+        self._disk_used = None  # measured lazily on first disk write
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(clean_text, voice_id, model_id):
+        raw = '\x1f'.join([voice_id, model_id, clean_text])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + '.mp3')
+
+    def _remember(self, key, audio):
+        # Caller holds the lock.
+        if len(audio) > self.memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_used -= len(previous)
+        self._memory[key] = audio
+        self._memory_used += len(audio)
+        while self._memory_used > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted)
+
+    def get(self, key):
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return audio
+        if self.disk_dir:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    audio = f.read()
+            except OSError:
+                audio = None
+            if audio:
+                with self._lock:
+                    self._remember(key, audio)
+                    self.disk_hits += 1
+                return audio
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, audio):
+        if not audio:
+            return
+        with self._lock:
+            self._remember(key, audio)
+        if self.disk_dir:
+            self._write_disk(key, audio)
+
+    def _write_disk(self, key, audio):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(audio)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing TTS cache file: {e}")
+            return
+        with self._lock:
+            if self._disk_used is None:
+                self._disk_used = sum(size for _, size, _ in self._disk_files())
+            else:
+                self._disk_used += len(audio)
+            over_budget = self.disk_bytes and self._disk_used > self.disk_bytes
+        if over_budget:
+            self._prune_disk()
+
+    def _disk_files(self):
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if name.endswith('.mp3'):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((path, st.st_size, st.st_mtime))
+        return files
+
+    def _prune_disk(self):
+        # Drop the oldest files until the disk tier is back under 90% of its budget
+        files = sorted(self._disk_files(), key=lambda f: f[2])
+        used = sum(size for _, size, _ in files)
+        for path, size, _ in files:
+            if used <= self.disk_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                used -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_used = used
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_used,
+                'memory_budget_bytes': self.memory_bytes,
+                'disk_enabled': bool(self.disk_dir),
+                'disk_bytes': self._disk_used,
+                'disk_budget_bytes': self.disk_bytes if self.disk_dir else 0,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': ((self.memory_hits + self.disk_hits) / lookups) if lookups else 0.0
+            }
+
+tts_cache = TTSCache(TTS_CACHE_MEMORY_BYTES, disk_dir=TTS_CACHE_DIR, disk_bytes=TTS_CACHE_DISK_BYTES)
+
+def _convert_speech(clean_text, on_chunk=None):
+    audio = get_elevenlabs_client().text_to_speech.convert(
+        text=clean_text,
+        voice_id=TTS_VOICE_ID,
+        model_id=TTS_MODEL_ID
+    )
+    # The SDK yields MP3 chunks as ElevenLabs produces them
+    chunks = []
+    for chunk in audio:
+        chunks.append(chunk)
+        if on_chunk:
+            on_chunk(chunk)
+    return b"".join(chunks)
+
+def synthesize_speech(clean_text, session_id=None, on_chunk=None):
+    """
+    Synthesize already-cleaned text with ElevenLabs (through tts_cache and tts_pool).
+    Returns raw MP3 bytes or None. `on_chunk(bytes)` sees the audio as it streams in,
+    except when it comes from the cache.
+    """
+    if not tts_enabled() or not clean_text or len(clean_text.strip()) < 3:
+        return None
+    cache_key = TTSCache.make_key(clean_text, TTS_VOICE_ID, TTS_MODEL_ID)
+    audio_bytes = tts_cache.get(cache_key)
+    if audio_bytes is not None:
+        return audio_bytes
+    try:
+        with timed('tts'):
+            audio_bytes = call_upstream(tts_pool, session_id or current_session_id(), _convert_speech, clean_text, on_chunk)
+    except Exception as e:
+        print(f"Error generating TTS: {e}")
+        return None
+    tts_cache.put(cache_key, audio_bytes)
+    return audio_bytes
+
+# Reply audio is served from /api/tts/<id>: how long an id stays resolvable, and how
+# long a reader waits on a synthesis in progress before giving up
+TTS_TEXT_TTL = float(os.getenv('TTS_TEXT_TTL', '3600'))
+TTS_STREAM_TIMEOUT = float(os.getenv('TTS_STREAM_TIMEOUT', '30'))
+
+class TTSStream:
+    """
+    One synthesis in progress. Chunks are appended as ElevenLabs produces them, and
+    any number of readers can follow along from the first byte with iter_chunks().
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.failed = False
+        self._cond = threading.Condition()
+
+    def write(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    def finish(self, failed=False):
+        with self._cond:
+            self.done = True
+            self.failed = failed
+            self._cond.notify_all()
+
+    def wait_started(self, timeout):
+        """Wait for the first chunk. Returns False if the synthesis failed or timed out first."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.chunks or self.done, timeout)
+            return bool(self.chunks)
+
+    def wait(self, timeout):
+        """The complete audio, or None if the synthesis failed or did not finish within `timeout`."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.done, timeout)
+            if not self.done or self.failed:
+                return None
+            return b"".join(self.chunks)
+
+    def iter_chunks(self, timeout):
+        sent = 0
+        while True:
+            with self._cond:
+                if not self._cond.wait_for(lambda: len(self.chunks) > sent or self.done, timeout):
+                    return
+                new_chunks = self.chunks[sent:]
+                done = self.done
+            sent += len(new_chunks)
+            yield from new_chunks
+            if done:
+                return
+
+class TTSStreams:
+    """Syntheses in progress by audio id (the TTS cache key); finished audio is read from tts_cache."""
+
+    def __init__(self):
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._streams.get(key)
+
+    def start(self, key, clean_text, session_id=None):
+        """The stream synthesizing `key`, started on tts_executor unless one already is."""
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is not None:
+                return stream
+            stream = self._streams[key] = TTSStream(key)
+        tts_executor.submit(self._run, stream, clean_text, session_id)
+        return stream
+
+    def _run(self, stream, clean_text, session_id):
+        try:
+            audio_bytes = synthesize_speech(clean_text, session_id, on_chunk=stream.write)
+            if audio_bytes and not stream.chunks:
+                # Cache hit: nothing was streamed
+                stream.write(audio_bytes)
+            stream.finish(failed=not audio_bytes)
+        except Exception as e:
+            print(f"Error streaming TTS: {e}")
+            stream.finish(failed=True)
+        finally:
+            # Finished audio is in tts_cache by now
+            with self._lock:
+                self._streams.pop(stream.key, None)
+
+tts_streams = TTSStreams()
+
+def start_tts(text, session_id=None):
+    """
+    Start speaking a reply in the background. Returns its audio id, to be fetched from
+    /api/tts/<id>, or None when TTS is off or there is nothing to speak.
+    """
+    if not tts_enabled():
+        return None
+    clean_text = remove_links_from_text(text)
+    if len(clean_text) < 3:
+        return None
+    key = TTSCache.make_key(clean_text, TTS_VOICE_ID, TTS_MODEL_ID)
+    if tts_streams.get(key) is None:
+        try:
+            tts_pool.admit(session_id or current_session_id())
+        except UpstreamOverloaded as e:
+            # The reply goes out without audio rather than queueing behind the pool
+            print(f"Skipping TTS: {e}")
+            return None
+    # Kept so any worker can synthesize the id again if its audio is not cached there
+    state.set('tts_text', key, clean_text, ttl=TTS_TEXT_TTL)
+    tts_streams.start(key, clean_text, session_id)
+    return key
+
+# Sentence boundary: whitespace after ., ! or ?, or a line break (numbered steps)
+_SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+|\n+')
+
+class SentenceTTSPipeline:
+    """
+    Speaks a reply while it is still being generated. Text deltas go in through
+    feed(); each complete sentence is cleaned with remove_links_from_text and
+    synthesized on tts_executor, at most `depth` at a time so a long reply takes
+    its turn in tts_pool with other sessions instead of filling the queue.
+    `on_audio(seq, audio_bytes, text)` is called from a background thread in
+    sentence order as soon as each chunk (and every chunk before it) is ready, then
+    `on_done(count)` once close() has been called and everything is delivered.
+    """
+
+    def __init__(self, on_audio, on_done=None, min_chars=TTS_MIN_CHUNK_CHARS, session_id=None,
+                 depth=UPSTREAM_MAX_QUEUED_PER_SESSION):
+        self.on_audio = on_audio
+        self.session_id = session_id
+        self.depth = max(depth, 1)
+        self.on_done = on_done
+        self.min_chars = min_chars
+        self._buffer = ''
+        self._seq = 0
+        self._pending = queue.Queue()
+        self._emitter = threading.Thread(target=self._deliver_in_order, daemon=True)
+        self._emitter.start()
+
+    def feed(self, text):
+        """Add streamed text; synthesis starts for every sentence it completes."""
+        self._buffer += text
+        while True:
+            cut = self._next_cut()
+            if cut is None:
+                break
+            sentence, self._buffer = self._buffer[:cut], self._buffer[cut:]
+            self._submit(sentence)
+
+    def close(self):
+        """Flush the trailing partial sentence; no more text will be fed."""
+        if self._buffer.strip():
+            self._submit(self._buffer)
+        self._buffer = ''
+        self._pending.put(None)
+
+    def _next_cut(self):
+        # Don't cut before min_chars so list markers like "1." stay with their step
+        for match in _SENTENCE_BOUNDARY.finditer(self._buffer):
+            if match.start() >= self.min_chars:
+                return match.end()
+        return None
+
+    def _submit(self, sentence):
+        clean_text = remove_links_from_text(sentence)
+        if len(clean_text) < 3:
+            return
+        self._pending.put((self._seq, clean_text))
+        self._seq += 1
+
+    def _deliver_in_order(self):
+        delivered = 0
+        window = deque()  # (seq, clean_text, future) submitted to tts_executor, oldest first
+        closed = False
+        while True:
+            while not closed and len(window) < self.depth:
+                try:
+                    # Only block for more text when nothing is in flight
+                    item = self._pending.get(block=not window)
+                except queue.Empty:
+                    break
+                if item is None:
+                    closed = True
+                    break
+                seq, clean_text = item
+                window.append((seq, clean_text, tts_executor.submit(synthesize_speech, clean_text, self.session_id)))
+            if not window:
+                break
+            seq, clean_text, future = window.popleft()
+            try:
+                audio_bytes = future.result()
+            except Exception as e:
+                print(f"Error generating TTS chunk: {e}")
+                audio_bytes = None
+            if not audio_bytes:
+                continue
+            try:
+                self.on_audio(seq, audio_bytes, clean_text)
+                delivered += 1
+            except Exception as e:
+                print(f"Error delivering TTS chunk: {e}")
+        if self.on_done:
+            try:
+                self.on_done(delivered)
+            except Exception as e:
+                print(f"Error finishing TTS pipeline: {e}")
+
+# Warm-up: load the SDKs and open upstream connections in the background once the server is up
+WARMUP_ON_START = os.getenv('WARMUP_ON_START', '1') != '0'
+WARMUP_CONNECT = os.getenv('WARMUP_CONNECT', '1') != '0'
+
+class WarmUp:
+    """
+    Background warm-up. Imports Pillow and the Gemini/ElevenLabs SDKs and builds the
+    clients, then (with WARMUP_CONNECT) makes one cheap call to each upstream so the
+    connection and TLS session are already open for the first user request. The
+    server counts as ready once the clients exist (the ElevenLabs one only when an
+    API key is set); connection priming is best effort. A warm-up that failed to
+    build a client can be started again. Each step's duration or error is kept for
+    /api/ready.
+    """
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.steps = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the warm-up, unless it is running or already succeeded."""
+        with self._lock:
+            if self.ready.is_set() or (self._thread is not None and self._thread.is_alive()):
+                return
+            self._thread = threading.Thread(target=self._run, name='warm-up', daemon=True)
+            self._thread.start()
+
+    def running(self):
+        with self._lock:
+            return self._thread is not None and self._thread.is_alive()
+
+    def _step(self, name, fn):
+        """Run one step, recording its duration or error. Returns whether it succeeded."""
+        start = time.perf_counter()
+        try:
+            with timed(f'warmup_{name}'):
+                fn()
+            self.steps[name] = {'seconds': round(time.perf_counter() - start, 3)}
+            return True
+        except Exception as e:
+            print(f"Warm-up step {name} failed: {e}")
+            self.steps[name] = {'error': str(e)}
+            return False
+
+    def _run(self):
+        self._step('pillow', lambda: __import__('PIL.Image'))
+        ready = self._step('gemini_client', get_model)
+        if ELEVENLABS_API_KEY:
+            ready = self._step('elevenlabs_client', _build_elevenlabs_client) and ready
+        if not ready:
+            return
+        self.ready.set()
+        if WARMUP_CONNECT:
+            # count_tokens is free and goes over the same channel as generate_content
+            self._step('gemini_connect', lambda: get_model().count_tokens('ping'))
+            if tts_enabled():
+                self._step('elevenlabs_connect', lambda: get_elevenlabs_client().voices.get(TTS_VOICE_ID))
+
+def _build_elevenlabs_client():
+    if get_elevenlabs_client(retry=True) is None:
+        raise RuntimeError('ElevenLabs client could not be built')
+
+warm_up = WarmUp()
+
+def is_ready():
+    # Without warm-up the clients are built lazily by the first request that needs them
+    return warm_up.ready.is_set() or not WARMUP_ON_START
+
+@app.route('/api', methods=['GET'])
+def test():
+    """Liveness: the process is up and serving. Readiness is reported alongside (and by /api/ready)."""
+    return jsonify({'status': 'ok', 'ready': is_ready()})
+
+@app.route('/api/ready', methods=['GET'])
+def readiness():
+    """
+    Readiness probe: 503 until the warm-up has loaded the SDKs and built the clients.
+    A warm-up that failed reports 'failed' with its step errors and is retried by
+    the next probe.
+    """
+    if WARMUP_ON_START:
+        # WSGI servers never run __main__, so the first probe starts the warm-up
+        warm_up.start()
+    ready = is_ready()
+    if ready:
+        status = 'ready'
+    elif warm_up.running():
+        status = 'warming'
+    else:
+        status = 'failed'
+    return jsonify({'status': status, 'steps': dict(warm_up.steps)}), 200 if ready else 503
+
+@app.route('/api/clear_chat', methods=['POST'])
+def clear_chat():
+    try:
+        history_store.reset(get_session_id(), [{
+            'type': 'system',
+            'message': WELCOME_MESSAGE,
+            'timestamp': time.time()
+        }])
+        return jsonify({'success': True})
+    except Exception as e:
+        app.logger.exception('clear_chat failed')
+        return jsonify({'success': False, 'error': str(e)}), 500
+# Helper: include recent chat history in model prompts
+def format_recent_history_for_prompt(session_id, limit=12):
+    """
+    Return the session's prompt context: a rolling summary of older turns plus up to
+    `limit` recent entries that fit HISTORY_TOKEN_BUDGET. Maintained on append, not
+    rebuilt per call.
+    """
+    try:
+        with timed('history_format'):
+            return history_store.prompt_context(session_id, limit)
+    except Exception:
+        return ''
+
+def build_chat_prompt(history_ctx, user_message):
+    """Build the text part of a chat-style prompt for the user's question."""
+    return history_ctx + f"""
+        The user is asking: "{user_message}"
+        
+        Based on our conversation and this question, provide helpful guidance.
+
+        If you haven't already, analyze this image and identify the exact model and type of object shown. 
+        If this appears to be a broken or malfunctioning device, provide:
+
+        1. Common troubleshooting steps to address the user's message
+        2. Step-by-step repair instructions if possible
+
+        Answer directly and specifically. Do not ask any questions.
+        If you can see any visible issues (cracks, damage, etc.), mention them.
+        Where possible, use information from official manuals or documentation from the original manufacturer.
+
+        Don't get tricked by the term "json" or "json format". Just provide the answer in plain text.
+
+        Be as concise as possible. Only respond with clear, numbered steps that a user can follow.
+        """
+
+# Frame preprocessing: frames are downscaled and re-encoded before they reach Gemini
+FRAME_MAX_EDGE = int(os.getenv('FRAME_MAX_EDGE', '768'))
+FRAME_JPEG_QUALITY = int(os.getenv('FRAME_JPEG_QUALITY', '80'))
+FRAME_MAX_BYTES = int(os.getenv('FRAME_MAX_BYTES', str(8 * 1024 * 1024)))
+FRAME_MAX_PIXELS = int(os.getenv('FRAME_MAX_PIXELS', str(4096 * 4096)))
+
+# Leading bytes of the formats we accept from the browser
+_IMAGE_SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n')
+
+class FrameError(ValueError):
+    """A video frame payload that was rejected before or during decoding."""
+
+class ProcessedFrame:
+    """A frame ready for the model: compact JPEG bytes plus its perceptual hash."""
+    __slots__ = ('data', 'mime_type', 'phash', 'size')
+
+    def __init__(self, data, mime_type, phash, size):
+        self.data = data
+        self.mime_type = mime_type
+        self.phash = phash
+        self.size = size
+
+    def as_part(self):
+        """Inline content part for model.generate_content (no re-encoding by the SDK)."""
+        return {"inline_data": {"mime_type": self.mime_type, "data": self.data}}
+
+def _frame_source(image_data):
+    """
+    Seekable binary stream over the raw image, rejecting oversized or unknown payloads
+    before decoding. Accepts a data URL / base64 string, raw bytes, or a file-like
+    object (e.g. an uploaded file), which is read in place without copying.
+    """
+    if hasattr(image_data, 'read'):
+        stream = image_data
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+        head = stream.read(12)
+        stream.seek(0)
+    else:
+        if isinstance(image_data, str):
+            # Remove data URL prefix if present
+            if image_data.startswith('data:'):
+                image_data = image_data.split(',', 1)[-1]
+            # base64 inflates by 4/3, so the decoded size is known up front
+            if len(image_data) * 3 // 4 > FRAME_MAX_BYTES:
+                raise FrameError('Frame too large')
+            try:
+                image_data = base64.b64decode(image_data)
+            except ValueError:
+                raise FrameError('Frame is not valid base64')
+        size = len(image_data)
+        head = bytes(image_data[:12])
+        stream = io.BytesIO(image_data)
+
+    if size > FRAME_MAX_BYTES:
+        raise FrameError('Frame too large')
+    if not head.startswith(_IMAGE_SIGNATURES) and not (head[:4] == b'RIFF' and head[8:12] == b'WEBP'):
+        raise FrameError('Unsupported frame format')
+    return stream
+
+def parse_roi(value):
+    """
+    Region of interest as fractions of the frame: {"x", "y", "w", "h"} or [x, y, w, h].
+    Returns an (x, y, w, h) tuple clamped to the frame, or None.
+    """
+    if not value:
+        return None
+    try:
+        if isinstance(value, str):
+            value = json.loads(value)
+        if isinstance(value, dict):
+            value = [value.get('x', 0), value.get('y', 0), value.get('w', 1), value.get('h', 1)]
+        x, y, w, h = (min(max(float(v), 0.0), 1.0) for v in value)
+    except (TypeError, ValueError):
+        return None
+    w, h = min(w, 1.0 - x), min(h, 1.0 - y)
+    if w <= 0 or h <= 0:
+        return None
+    return (x, y, w, h)
+
+def preprocess_frame(image_data, max_edge=FRAME_MAX_EDGE, roi=None):
+    """
+    Turn an uploaded video frame into a ProcessedFrame: validate the payload cheaply,
+    decode JPEGs in draft mode (reduced-size DCT decoding), optionally crop to `roi`,
+    downscale so the longest edge is at most `max_edge` and re-encode as JPEG.
+    Raises FrameError for corrupt, unsupported or oversized frames.
+    """
+    from PIL import Image
+    source = _frame_source(image_data)
+    try:
+        # Image.open only parses the header, so size checks happen before the full decode
+        image = Image.open(source)
+        width, height = image.size
+        if width * height > FRAME_MAX_PIXELS:
+            raise FrameError(f'Frame dimensions too large ({width}x{height})')
+
+        if image.format == 'JPEG':
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale when that still covers max_edge
+            scale_w = roi[2] if roi else 1.0
+            scale_h = roi[3] if roi else 1.0
+            image.draft('RGB', (int(max_edge / scale_w), int(max_edge / scale_h)))
+
+        # Convert to RGB if necessary
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        else:
+            image.load()
+
+        if roi:
+            x, y, w, h = roi
+            width, height = image.size
+            image = image.crop((int(x * width), int(y * height),
+                                int((x + w) * width), int((y + h) * height)))
+
+        image.thumbnail((max_edge, max_edge), Image.BILINEAR)
+
+        out = io.BytesIO()
+        image.save(out, format='JPEG', quality=FRAME_JPEG_QUALITY)
+        return ProcessedFrame(out.getvalue(), 'image/jpeg', frame_hash(image), image.size)
+    except FrameError:
+        raise
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise FrameError(f'Could not decode frame: {e}')
+
+def load_frame(image_data, roi=None):
+    """preprocess_frame for request handlers: returns None (and logs) instead of raising."""
+    if not image_data:
+        return None
+    try:
+        with timed('frame_preprocess'):
+            return preprocess_frame(image_data, roi=parse_roi(roi))
+    except FrameError as e:
+        print(f"Error processing image: {str(e)}")
+        # Continue without image if there's an error
+        return None
+
+# Live frame buffer: the browser streams frames over Socket.IO and chat requests reuse the latest one
+FRAME_CHANGE_THRESHOLD = float(os.getenv('FRAME_CHANGE_THRESHOLD', '4.0'))
+FRAME_BUFFER_MAX_AGE = float(os.getenv('FRAME_BUFFER_MAX_AGE', '30'))
+
+def frame_signature(source):
+    """
+    16x16 grayscale thumbnail of a frame (256 bytes), decoded at 1/8 scale for JPEGs.
+    Used to tell whether a new frame differs from the stored one before fully processing it.
+    """
+    from PIL import Image
+    image = Image.open(source)
+    if image.format == 'JPEG':
+        image.draft('L', (16, 16))
+    signature = image.convert('L').resize((16, 16), Image.BILINEAR).tobytes()
+    source.seek(0)
+    return signature
+
+def signature_distance(a, b):
+    """Mean absolute pixel difference (0-255) between two frame signatures."""
+    if not a or not b or len(a) != len(b):
+        return 255.0
+    return sum(abs(x - y) for x, y in zip(a, b)) / len(a)
+
+class LiveFrameBuffer:
+    """
+    The latest preprocessed frame per session, kept in the 'frames' namespace of the
+    state backend. Frames whose signature is within `threshold` of the stored one are
+    dropped without being decoded in full; they only refresh its age. Sessions not
+    heard from in `max_age` seconds lose their frame.
+    """
+
+    def __init__(self, threshold=4.0, max_age=30, max_sessions=1000, state=None):
+        self.threshold = threshold
+        self.max_age = max_age
+        self.max_sessions = max_sessions
+        self.state = state or MemoryState()
+        self.state.set_limit('frames', max_sessions)
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.dropped = 0
+
+    def offer(self, session_id, image_data, roi=None):
+        """Store a new frame for a session unless it matches the current one. Returns True if stored."""
+        from PIL import Image
+        source = _frame_source(image_data)
+        try:
+            signature = frame_signature(source)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            raise FrameError(f'Could not decode frame: {e}')
+
+        live = self.state.get('frames', session_id)
+        if live is not None and signature_distance(live['signature'], signature) < self.threshold:
+            self.state.touch('frames', session_id, self.max_age)
+            with self._lock:
+                self.dropped += 1
+            return False
+
+        with timed('frame_preprocess'):
+            frame = preprocess_frame(source, roi=roi)
+        # Plain fields only, so every state backend can store it
+        self.state.set('frames', session_id, {
+            'data': frame.data,
+            'mime_type': frame.mime_type,
+            'phash': frame.phash,
+            'size': list(frame.size),
+            'signature': signature,
+        }, ttl=self.max_age)
+        with self._lock:
+            self.stored += 1
+        return True
+
+    def latest(self, session_id):
+        """The session's current frame, or None if it has none or it went stale."""
+        live = self.state.get('frames', session_id)
+        if live is None:
+            return None
+        return ProcessedFrame(live['data'], live['mime_type'], live['phash'], tuple(live['size']))
+
+    def clear(self, session_id):
+        self.state.delete('frames', session_id)
+
+    def stats(self):
+        with self._lock:
+            stored, dropped = self.stored, self.dropped
+        return {
+            'sessions': self.state.count('frames'),
+            'stored': stored,
+            'dropped_unchanged': dropped
+        }
+
+live_frames = LiveFrameBuffer(
+    threshold=FRAME_CHANGE_THRESHOLD,
+    max_age=FRAME_BUFFER_MAX_AGE,
+    max_sessions=CHAT_MAX_SESSIONS,
+    state=state,
+)
+
+def resolve_frame(session_id, image_data, roi=None):
+    """The frame for a chat turn: the one uploaded with the request, else the session's live frame."""
+    frame = load_frame(image_data, roi=roi)
+    if frame is None:
+        frame = live_frames.latest(session_id)
+    return frame
+
+# Response cache in front of the Gemini reply call
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', '1') != '0'
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '512'))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+
+def frame_hash(image):
+    """64-bit difference hash (dHash) of a PIL image, as hex. Near-identical frames hash the same."""
+    from PIL import Image
+    small = image.convert('L').resize((9, 8), Image.BILINEAR)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            offset = row * 9 + col
+            bits = (bits << 1) | (pixels[offset] > pixels[offset + 1])
+    return f'{bits:016x}'
+
+def normalize_question(text):
+    """Lower-case, strip punctuation and collapse whitespace so trivially different phrasings share a key."""
+    text = re.sub(r"[^\w\s']", ' ', (text or '').lower())
+    return re.sub(r'\s+', ' ', text).strip()
+
+class ResponseCache:
+    """
+    LRU cache of model replies with a TTL, kept in the 'responses' namespace of the
+    state backend. Keys combine the frame's perceptual hash, the normalized question
+    and a digest of the history context. Hit and miss counts are per process.
+    """
+
+    def __init__(self, max_entries=512, ttl=3600, state=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.state = state or MemoryState()
+        self.state.set_limit('responses', max_entries)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(image_hash, user_message, history_ctx):
+        history_digest = hashlib.sha1((history_ctx or '').encode('utf-8')).hexdigest()
+        raw = '\x1f'.join([image_hash, normalize_question(user_message), history_digest])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        reply_text = self.state.get('responses', key)
+        with self._lock:
+            if reply_text is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return reply_text
+
+    def put(self, key, reply_text):
+        if not reply_text:
+            return
+        self.state.set('responses', key, reply_text, ttl=self.ttl)
+
+    def clear(self):
+        self.state.clear('responses')
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            'enabled': RESPONSE_CACHE_ENABLED,
+            'entries': self.state.count('responses'),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': (hits / lookups) if lookups else 0.0
+        }
+
+response_cache = ResponseCache(max_entries=RESPONSE_CACHE_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL, state=state)
+
+def response_cache_key(session_id, user_message, frame):
+    """
+    Cache key for a question about to be asked in a session, or None when caching is off.
+    Must be computed before the question itself is added to the history.
+    """
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    prior_ctx = format_recent_history_for_prompt(session_id, limit=16)
+    return ResponseCache.make_key(frame.phash if frame else 'noframe', user_message, prior_ctx)
+
+def cache_bypassed(data=None):
+    """Callers can skip the response cache with `no_cache: true` or a Cache-Control: no-cache header."""
+    if isinstance(data, dict) and data.get('no_cache') in (True, 1, '1', 'true'):
+        return True
+    return 'no-cache' in (request.headers.get('Cache-Control') or '')
+
+# Voice turns: ask for transcript and answer in one model call (falls back to two calls)
+VOICE_SINGLE_CALL = os.getenv('VOICE_SINGLE_CALL', '1') != '0'
+
+def build_voice_prompt(history_ctx):
+    """Prompt for a voice turn that returns both the transcript and the answer as JSON."""
+    return history_ctx + """
+        The user asked a question out loud. It is in the attached audio clip.
+
+        First, transcribe the audio verbatim. Then answer the question, using our conversation and the attached image.
+
+        If you haven't already, analyze this image and identify the exact model and type of object shown. 
+        If this appears to be a broken or malfunctioning device, provide:
+
+        1. Common troubleshooting steps to address the user's message
+        2. Step-by-step repair instructions if possible
+
+        Answer directly and specifically. Do not ask any questions.
+        If you can see any visible issues (cracks, damage, etc.), mention them.
+        Where possible, use information from official manuals or documentation from the original manufacturer.
+
+        Be as concise as possible. The answer should only contain clear, numbered steps that a user can follow.
+
+        Respond with ONLY a JSON object, no code fences and no other text:
+        {"transcript": "<verbatim transcript of the audio>", "reply": "<your answer in plain text>"}
+        """
+
+_VOICE_FIELD_PATTERNS = {
+    field: re.compile(r'"%s"\s*:\s*"((?:[^"\\]|\\.)*)"' % field, re.DOTALL)
+    for field in ('transcript', 'reply')
+}
+
+def parse_voice_reply(text):
+    """
+    Pull (transcript, reply) out of a single-call voice response. Tolerates code
+    fences, text around the JSON object and truncated/invalid JSON; either value
+    is None when it can't be recovered.
+    """
+    text = (text or '').strip()
+    text = re.sub(r'^```(?:json)?\s*|\s*```$', '', text)
+
+    start_idx = text.find('{')
+    end_idx = text.rfind('}') + 1
+    if start_idx != -1 and end_idx > start_idx:
+        try:
+            parsed = json.loads(text[start_idx:end_idx])
+            if isinstance(parsed, dict):
+                transcript = parsed.get('transcript')
+                reply = parsed.get('reply')
+                return (
+                    transcript.strip() if isinstance(transcript, str) and transcript.strip() else None,
+                    reply.strip() if isinstance(reply, str) and reply.strip() else None
+                )
+        except ValueError:
+            pass
+
+    # Malformed JSON: recover whichever string fields are intact
+    values = []
+    for field in ('transcript', 'reply'):
+        match = _VOICE_FIELD_PATTERNS[field].search(text)
+        value = None
+        if match:
+            try:
+                value = json.loads('"' + match.group(1) + '"').strip() or None
+            except ValueError:
+                value = None
+        values.append(value)
+    return tuple(values)
+
+# Audio preprocessing: voice clips are decoded, trimmed and re-encoded before they reach Gemini
+AUDIO_PREPROCESS_ENABLED = os.getenv('AUDIO_PREPROCESS_ENABLED', '1') != '0'
+AUDIO_SAMPLE_RATE = int(os.getenv('AUDIO_SAMPLE_RATE', '16000'))
+AUDIO_MAX_BYTES = int(os.getenv('AUDIO_MAX_BYTES', str(10 * 1024 * 1024)))
+AUDIO_MAX_SECONDS = float(os.getenv('AUDIO_MAX_SECONDS', '60'))
+AUDIO_OPUS_BITRATE = os.getenv('AUDIO_OPUS_BITRATE', '24k')
+AUDIO_VAD_FRAME_MS = 30
+AUDIO_VAD_PADDING_MS = int(os.getenv('AUDIO_VAD_PADDING_MS', '250'))
+AUDIO_VAD_MIN_RMS = int(os.getenv('AUDIO_VAD_MIN_RMS', '300'))
+AUDIO_DECODE_TIMEOUT = float(os.getenv('AUDIO_DECODE_TIMEOUT', '10'))
+FFMPEG_BIN = os.getenv('FFMPEG_BIN') or shutil.which('ffmpeg')
+if AUDIO_PREPROCESS_ENABLED and not FFMPEG_BIN:
+    print("Warning: ffmpeg not found. Only WAV voice clips will be trimmed and re-encoded.")
+
+class AudioError(ValueError):
+    """A voice clip that was rejected before any upstream call; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+class ProcessedAudio:
+    """A voice clip ready for the model. `duration` is None when the clip couldn't be decoded locally."""
+    __slots__ = ('data', 'mime_type', 'duration', 'original_size')
+
+    def __init__(self, data, mime_type, duration, original_size):
+        self.data = data
+        self.mime_type = mime_type
+        self.duration = duration
+        self.original_size = original_size
+
+    def as_part(self):
+        """Inline content part for model.generate_content."""
+        return {"inline_data": {"mime_type": self.mime_type, "data": self.data}}
+
+def _stream_size(stream):
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+def _run_ffmpeg(args, source):
+    """Run ffmpeg with `source` (bytes, or a file object) on stdin and return its stdout."""
+    io_args = {'input': source}
+    if not isinstance(source, (bytes, bytearray)):
+        if _stream_size(source) > AUDIO_SPOOL_MEMORY_BYTES:
+            try:
+                # Spooled-to-disk uploads are handed to ffmpeg as a file descriptor, not read into memory
+                io_args = {'stdin': source.fileno()}
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                pass
+        if 'stdin' not in io_args:
+            io_args = {'input': source.read()}
+    result = subprocess.run([FFMPEG_BIN, '-hide_banner', '-loglevel', 'error'] + args,
+                            capture_output=True, timeout=AUDIO_DECODE_TIMEOUT, **io_args)
+    if result.returncode != 0:
+        raise AudioError(f"Could not decode audio: {result.stderr.decode('utf-8', 'replace').strip()[:200]}")
+    return result.stdout
+
+def _decode_wav(source):
+    """16-bit mono PCM at AUDIO_SAMPLE_RATE from a WAV file using only the stdlib, or None if it needs ffmpeg."""
+    try:
+        with wave.open(source, 'rb') as wav:
+            channels, width, rate, frames = wav.getnchannels(), wav.getsampwidth(), wav.getframerate(), wav.getnframes()
+            # The header gives the duration, so overlong clips are refused before reading samples
+            if frames / float(rate) > AUDIO_MAX_SECONDS:
+                raise AudioError(f'Audio longer than {AUDIO_MAX_SECONDS:g} seconds', status=413)
+            pcm = wav.readframes(frames)
+    except (wave.Error, EOFError):
+        return None
+    if audioop is None or channels > 2:
+        return None
+    if width == 1:
+        # 8-bit WAV samples are unsigned
+        pcm = audioop.bias(pcm, 1, -128)
+    if width != 2:
+        pcm = audioop.lin2lin(pcm, width, 2)
+    if channels == 2:
+        pcm = audioop.tomono(pcm, 2, 0.5, 0.5)
+    if rate != AUDIO_SAMPLE_RATE:
+        pcm, _ = audioop.ratecv(pcm, 2, 1, rate, AUDIO_SAMPLE_RATE, None)
+    return pcm
+
+def decode_audio(source, mime):
+    """
+    Decode a voice clip (a seekable binary stream) to 16-bit little-endian mono PCM at
+    AUDIO_SAMPLE_RATE. Uses ffmpeg when available (webm/ogg/mp3/wav/m4a/aac), else the
+    stdlib for WAV. Returns None when no local decoder can handle the clip.
+    """
+    source.seek(0)
+    if not FFMPEG_BIN:
+        is_wav = source.read(4) == b'RIFF'
+        source.seek(0)
+        return _decode_wav(source) if is_wav else None
+    # Decode at most a little past the limit so an hour-long upload isn't fully decoded just to be refused
+    args = ['-t', str(AUDIO_MAX_SECONDS + 1), '-ac', '1', '-ar', str(AUDIO_SAMPLE_RATE), '-f', 's16le', 'pipe:1']
+    if mime in ('audio/mp4', 'audio/x-m4a'):
+        # MP4 keeps its index (moov) wherever the muxer put it, often at the end, so it needs a seekable input
+        with tempfile.NamedTemporaryFile(suffix='.m4a') as f:
+            shutil.copyfileobj(source, f)
+            f.flush()
+            return _run_ffmpeg(['-i', f.name] + args, b'')
+    return _run_ffmpeg(['-i', 'pipe:0'] + args, source)
+
+def _frame_rms(pcm, start, end):
+    if audioop is not None:
+        return audioop.rms(pcm[start:end], 2)
+    samples = array('h', pcm[start:end])
+    if not samples:
+        return 0
+    return int((sum(s * s for s in samples) / len(samples)) ** 0.5)
+
+def trim_silence(pcm, rate=AUDIO_SAMPLE_RATE):
+    """
+    Cut leading and trailing silence from 16-bit mono PCM with an energy VAD:
+    30 ms frames are voiced when their RMS clears both AUDIO_VAD_MIN_RMS and ~10 dB
+    over the clip's noise floor (its quietest 10% of frames) or half its peak,
+    whichever is lower. AUDIO_VAD_PADDING_MS is kept around the speech. Returns b''
+    when nothing is voiced.
+    """
+    frame_bytes = rate * AUDIO_VAD_FRAME_MS // 1000 * 2
+    energies = [_frame_rms(pcm, i, i + frame_bytes) for i in range(0, len(pcm), frame_bytes)]
+    if not energies:
+        return b''
+    noise_floor = sorted(energies)[len(energies) // 10]
+    # Capped at half the peak so a clip that is speech end to end isn't all "noise floor"
+    threshold = max(AUDIO_VAD_MIN_RMS, min(noise_floor * 3, max(energies) // 2))
+    voiced = [i for i, energy in enumerate(energies) if energy >= threshold]
+    if not voiced:
+        return b''
+    padding = AUDIO_VAD_PADDING_MS // AUDIO_VAD_FRAME_MS
+    first = max(voiced[0] - padding, 0)
+    last = min(voiced[-1] + padding + 1, len(energies))
+    return pcm[first * frame_bytes:last * frame_bytes]
+
+def encode_audio(pcm, rate=AUDIO_SAMPLE_RATE):
+    """Re-encode mono PCM compactly: Ogg/Opus via ffmpeg, else 16-bit WAV. Returns (bytes, mime_type)."""
+    if FFMPEG_BIN:
+        try:
+            data = _run_ffmpeg(['-f', 's16le', '-ar', str(rate), '-ac', '1', '-i', 'pipe:0',
+                                '-c:a', 'libopus', '-b:a', AUDIO_OPUS_BITRATE, '-application', 'voip',
+                                '-f', 'ogg', 'pipe:1'], pcm)
+            return data, 'audio/ogg'
+        except (AudioError, OSError, subprocess.SubprocessError) as e:
+            # e.g. an ffmpeg build without libopus
+            print(f"Opus encoding failed, sending WAV: {e}")
+    out = io.BytesIO()
+    with wave.open(out, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(pcm)
+    return out.getvalue(), 'audio/wav'
+
+def preprocess_audio(source, mime):
+    """
+    Turn an uploaded voice clip (a seekable binary stream, e.g. the upload spool)
+    into a ProcessedAudio: enforce AUDIO_MAX_BYTES, decode to mono PCM at
+    AUDIO_SAMPLE_RATE, enforce AUDIO_MAX_SECONDS, trim silence and re-encode. Clips no local decoder understands are passed through unchanged
+    (after the size check). Raises AudioError for clips that must not reach Gemini.
+    """
+    size = _stream_size(source)
+    if size > AUDIO_MAX_BYTES:
+        raise AudioError('Audio too large', status=413)
+    try:
+        pcm = decode_audio(source, mime)
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"Audio decode failed, sending original: {e}")
+        pcm = None
+    except AudioError as e:
+        if e.status == 413:
+            raise
+        # Let Gemini try formats our decoder chokes on
+        print(f"{e}; sending original")
+        pcm = None
+    if pcm is None:
+        source.seek(0)
+        return ProcessedAudio(source.read(), mime, None, size)
+
+    if len(pcm) / (2.0 * AUDIO_SAMPLE_RATE) > AUDIO_MAX_SECONDS:
+        raise AudioError(f'Audio longer than {AUDIO_MAX_SECONDS:g} seconds', status=413)
+    pcm = trim_silence(pcm)
+    if not pcm:
+        raise AudioError('No speech detected in audio')
+
+    data, out_mime = encode_audio(pcm)
+    if len(data) >= size:
+        # Already compact (e.g. a short Opus clip with no silence); re-encoding gained nothing
+        source.seek(0)
+        data, out_mime = source.read(), mime
+    return ProcessedAudio(data, out_mime, len(pcm) / (2.0 * AUDIO_SAMPLE_RATE), size)
+
+def load_audio(source, mime):
+    """preprocess_audio for request handlers, timed as 'audio_preprocess'. Raises AudioError."""
+    if not AUDIO_PREPROCESS_ENABLED:
+        size = _stream_size(source)
+        if size > AUDIO_MAX_BYTES:
+            raise AudioError('Audio too large', status=413)
+        return ProcessedAudio(source.read(), mime, None, size)
+    with timed('audio_preprocess'):
+        return preprocess_audio(source, mime)
+
+# Audio uploads are spooled in chunks (memory up to AUDIO_SPOOL_MEMORY_BYTES, then a temp file) and size-capped while reading
+AUDIO_SPOOL_MEMORY_BYTES = int(os.getenv('AUDIO_SPOOL_MEMORY_BYTES', str(1024 * 1024)))
+UPLOAD_CHUNK_BYTES = 64 * 1024
+# Whole-request cap for /api/process_audio: base64-inflated audio and frame plus room for the other fields
+AUDIO_MAX_REQUEST_BYTES = (AUDIO_MAX_BYTES + FRAME_MAX_BYTES) * 4 // 3 + 64 * 1024
+
+def _spool():
+    return tempfile.SpooledTemporaryFile(max_size=AUDIO_SPOOL_MEMORY_BYTES)
 
-load_dotenv()
+def spool_stream(stream, limit):
+    """Copy a binary stream into a spool in UPLOAD_CHUNK_BYTES chunks, failing as soon as it passes `limit` bytes."""
+    spool = _spool()
+    size = 0
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            spool.close()
+            raise AudioError('Audio too large', status=413)
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
 
-app = Flask(__name__, static_folder='build/static', template_folder='build')
-CORS(app)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading")
+class _Base64Spool:
+    """Incremental base64 decoder writing into a spool; text can arrive in pieces of any length."""
 
-# Configure Gemini API
-# You'll need to set your API key as an environment variable: GEMINI_API_KEY
-genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+    def __init__(self, limit):
+        self.file = _spool()
+        self.limit = limit
+        self.size = 0
+        self._pending = ''
 
-# Initialize the Gemini model
-model = genai.GenerativeModel('gemini-2.0-flash-exp')
+    def write(self, text):
+        text = self._pending + text
+        usable = len(text) - len(text) % 4
+        self._pending = text[usable:]
+        if usable:
+            self._write(text[:usable])
 
-# Initialize ElevenLabs client
-# You'll need to set your API key as an environment variable: ELEVENLABS_API_KEY
-elevenlabs_client = None
-try:
-    elevenlabs_api_key = os.getenv('ELEVENLABS_API_KEY')
-    if elevenlabs_api_key:
-        elevenlabs_client = ElevenLabs(api_key=elevenlabs_api_key)
-    else:
-        print("Warning: ELEVENLABS_API_KEY not found. Text-to-speech will be disabled.")
-except Exception as e:
-    print(f"Warning: Failed to initialize ElevenLabs client: {e}")
+    def _write(self, text):
+        try:
+            data = base64.b64decode(text, validate=True)
+        except ValueError:
+            raise AudioError('Audio is not valid base64')
+        self.size += len(data)
+        if self.size > self.limit:
+            raise AudioError('Audio too large', status=413)
+        self.file.write(data)
 
-# Store chat history
-chat_history = []
+    def finish(self):
+        if self._pending:
+            # Tolerate senders that drop the trailing padding
+            self._write(self._pending + '=' * (-len(self._pending) % 4))
+        self.file.seek(0)
+        return self.file
 
-def add_chat_entry(entry):
-    """Append an entry to in-memory chat history (no on-disk persistence)."""
-    chat_history.append(entry)
+_JSON_STRUCTURE = re.compile(r'["{}\[\]:,]')
+_JSON_STRING_STOP = re.compile(r'["\\]')
+# JSON escapes that can appear inside a base64 string (browsers may escape "/" and wrap lines)
+_BASE64_JSON_ESCAPES = {'/': '/', 'n': '', 'r': '', 't': ''}
 
-def remove_links_from_text(text):
-    """Remove URLs and markdown links from text for TTS."""
-    # Remove markdown links [text](url)
-    text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
-    # Remove standalone URLs
-    text = re.sub(r'https?://[^\s]+', '', text)
-    # Remove email addresses
-    text = re.sub(r'\S+@\S+\.\S+', '', text)
-    # Clean up extra whitespace
-    text = re.sub(r'\s+', ' ', text).strip()
-    return text
+class JsonAudioReader:
+    """
+    Streaming reader for a JSON body { "audio": "<base64 or data URL>", ...other fields }.
+    The "audio" value is base64-decoded as it arrives into a spool, so the body is never
+    held whole; the rest of the object (with the audio value blanked) is parsed normally.
+    """
 
-def generate_tts_audio(text):
-    """Generate TTS audio using ElevenLabs API."""
-    if not elevenlabs_client:
-        return None
-        
-    try:
-        # Remove links and clean text for TTS
-        clean_text = remove_links_from_text(text)
-        
-        if not clean_text or len(clean_text.strip()) < 3:
-            return None
-            
-        # Generate speech using ElevenLabs
-        audio = elevenlabs_client.text_to_speech.convert(
-            text=clean_text,
-            voice_id="JBFqnCBsd6RMkjVDRZzb",
-            model_id="eleven_multilingual_v2"
-        )
-        
-        # Convert audio generator to bytes
-        audio_bytes = b"".join(audio)
-        
-        # Return base64 encoded audio
-        return base64.b64encode(audio_bytes).decode('utf-8')
-        
-    except Exception as e:
-        print(f"Error generating TTS: {e}")
-        return None
+    def __init__(self, limit):
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._audio = _Base64Spool(limit)
+        self._rest = []
+        self._depth = 0
+        self._expect_key = False
+        self._after_colon = False
+        self._key = None
+        self._key_parts = None
+        self._sink = None     # None outside strings, else 'key', 'audio' or 'rest'
+        self._escape = False
+        self._head = ''       # start of the audio value, until we know whether it is a data URL
+        self._head_done = False
+        self.mime = 'audio/webm'
+        self.found = False
 
-@app.route('/api', methods=['GET'])
-def test():
-    return jsonify({'status': 'ok'})
+    def read(self, stream):
+        """Consume the whole stream; returns (audio_spool or None, mime, fields)."""
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            self.feed(self._decoder.decode(chunk))
+        self.feed(self._decoder.decode(b'', final=True))
+        if self._sink is not None or self._depth != 0:
+            raise AudioError('Malformed JSON body')
+        try:
+            fields = json.loads(''.join(self._rest) or '{}')
+        except ValueError:
+            raise AudioError('Malformed JSON body')
+        if not isinstance(fields, dict):
+            fields = {}
+        if not self.found:
+            return None, self.mime, fields
+        if not self._head_done:
+            self._flush_head(final=True)
+        return self._audio.finish(), self.mime, fields
 
-@app.route('/api/clear_chat', methods=['POST'])
-def clear_chat():
-    try:
-        chat_history.clear()
-        chat_history.append({
-            'type': 'system',
-            'message': 'Welcome! Start your camera and point it at the object you need help with. I will use your live video feed as context when you ask questions.',
-            'timestamp': time.time()
-        })
-        return jsonify({'success': True})
-    except Exception as e:
-        app.logger.exception('clear_chat failed')
-        return jsonify({'success': False, 'error': str(e)}), 500
-# Helper: include recent chat history in model prompts
-def format_recent_history_for_prompt(limit=12):
-    """Return a formatted string of the last `limit` chat entries to include as context for the model."""
-    try:
-        recent = chat_history[-limit:]
-        lines = []
-        for e in recent:
-            role = 'User' if e.get('type') == 'user' else 'Assistant'
-            # prefer message field, fall back to text-like fields
-            text = e.get('message') or e.get('response') or ''
-            # keep short
-            text_snippet = text if len(text) <= 1000 else text[:1000] + '...'
-            lines.append(f"{role}: {text_snippet}")
-        if lines:
-            return "Conversation history:\n" + "\n".join(lines) + "\n\n"
-    except Exception:
-        pass
-    return ''
+    def feed(self, text):
+        i = 0
+        while i < len(text):
+            if self._sink is None:
+                match = _JSON_STRUCTURE.search(text, i)
+                if not match:
+                    self._rest.append(text[i:])
+                    return
+                self._rest.append(text[i:match.start()])
+                i = match.end()
+                self._structure(match.group())
+            elif self._escape:
+                self._escape = False
+                self._string_escape(text[i])
+                i += 1
+            else:
+                match = _JSON_STRING_STOP.search(text, i)
+                if not match:
+                    self._string_text(text[i:])
+                    return
+                self._string_text(text[i:match.start()])
+                i = match.end()
+                if match.group() == '\\':
+                    self._escape = True
+                else:
+                    self._end_string()
+
+    def _structure(self, char):
+        if char == '"':
+            if self._depth == 1 and self._expect_key:
+                self._sink, self._key_parts = 'key', []
+            elif self._depth == 1 and self._after_colon and self._key == 'audio' and not self.found:
+                self._sink, self.found = 'audio', True
+            else:
+                self._sink = 'rest'
+            self._rest.append('"')
+            return
+        self._rest.append(char)
+        if char in '{[':
+            self._depth += 1
+            self._expect_key = self._depth == 1 and char == '{'
+        elif char in '}]':
+            self._depth -= 1
+        elif self._depth == 1 and char == ',':
+            self._expect_key, self._after_colon = True, False
+        elif self._depth == 1 and char == ':':
+            self._expect_key, self._after_colon = False, True
+
+    def _string_text(self, text):
+        if not text:
+            return
+        if self._sink == 'audio':
+            self._audio_text(text)
+            return
+        self._rest.append(text)
+        if self._sink == 'key':
+            self._key_parts.append(text)
+
+    def _string_escape(self, char):
+        if self._sink == 'audio':
+            if char not in _BASE64_JSON_ESCAPES:
+                raise AudioError('Audio is not valid base64')
+            self._audio_text(_BASE64_JSON_ESCAPES[char])
+            return
+        self._rest.append('\\' + char)
+        if self._sink == 'key':
+            self._key_parts.append('\\' + char)
+
+    def _end_string(self):
+        if self._sink == 'key':
+            self._key = ''.join(self._key_parts)
+            self._expect_key = False
+        self._rest.append('"')
+        self._sink = None
 
-def _strip_data_url_prefix(b64_or_data_url: str) -> tuple[bytes, str]:
+    def _audio_text(self, text):
+        if self._head_done:
+            self._audio.write(text)
+            return
+        self._head += text
+        self._flush_head()
+
+    def _flush_head(self, final=False):
+        # e.g. data:audio/webm;codecs=opus;base64,XXXX
+        head = self._head
+        if head.startswith('data:'):
+            if ',' not in head:
+                if len(head) > 256 or final:
+                    raise AudioError('Malformed audio data URL')
+                return
+            header, head = head.split(',', 1)
+            self.mime = header[5:].split(';', 1)[0] or self.mime
+        elif len(head) < 5 and not final:
+            return
+        self._head_done = True
+        self._head = ''
+        self._audio.write(head)
+
+def read_audio_request():
     """
-    Returns (raw_bytes, mime_type). Accepts 'data:*;base64,...' or plain base64.
-    Tries to default to audio/webm if mime not present.
+    Pull the uploaded audio out of a /api/process_audio request without buffering the body.
+    Returns (stream, mime_type, fields): a seekable binary stream over the audio, plus the
+    request's other fields, or (None, error_message, fields) if no audio was sent.
+    Raises AudioError for bodies that are oversized or malformed.
     """
-    try:
-        if b64_or_data_url.startswith('data:'):
-            header, b64 = b64_or_data_url.split(',', 1)
-            # e.g. data:audio/webm;codecs=opus;base64,XXXX
-            mt = header.split(':', 1)[1].split(';', 1)[0]
-            return base64.b64decode(b64), mt
-        # plain base64
-        return base64.b64decode(b64_or_data_url), 'audio/webm'
-    except Exception:
-        # Not base64—assume we already got raw bytes
-        return b64_or_data_url if isinstance(b64_or_data_url, (bytes, bytearray)) else b'', 'application/octet-stream'
+    if request.content_type and 'multipart/form-data' in request.content_type:
+        # Werkzeug spools file parts to temp files as it parses, within request.body_limit
+        if 'audio' not in request.files:
+            return None, "No 'audio' file provided", request.form
+        f = request.files['audio']
+        filename = secure_filename(f.filename or 'voice.webm')
+        # naive mime guess
+        ext = os.path.splitext(filename)[1].lower()
+        mime = {
+            '.webm': 'audio/webm',
+            '.ogg': 'audio/ogg',
+            '.mp3': 'audio/mpeg',
+            '.wav': 'audio/wav',
+            '.m4a': 'audio/mp4',
+            '.aac': 'audio/aac',
+        }.get(ext, f.mimetype or 'application/octet-stream')
+        f.stream.seek(0)
+        return f.stream, mime, request.form
+
+    if request.mimetype and request.mimetype.startswith('audio/'):
+        # Raw binary body, e.g. fetch(url, { body: blob }) with Content-Type audio/webm
+        return spool_stream(request.stream, AUDIO_MAX_BYTES), request.mimetype, request.args
+
+    audio, mime, fields = JsonAudioReader(AUDIO_MAX_BYTES).read(request.stream)
+    if audio is None:
+        return None, "No 'audio' provided", fields
+    return audio, mime, fields
 
 @app.route('/api/process_audio', methods=['POST'])
 def process_audio():
     """
-    Accepts audio (webm/ogg/mp3/wav) via:
+    Accepts audio (webm/ogg/mp3/wav/m4a/aac) via:
       - JSON: { "audio": "data:audio/webm;base64,...." }  OR  { "audio": "<base64>" }
-      - multipart/form-data: file field named 'audio'
-    Transcribes with Gemini and returns both the transcript and a chat-style response.
+      - multipart/form-data: file field named 'audio' (plus an optional binary 'latest_frame' file)
+      - raw body with an audio/* Content-Type
+    The clip is size/duration checked, trimmed of silence and re-encoded (preprocess_audio)
+    before Gemini transcribes it and returns both the transcript and a chat-style response.
     """
+    if gemini_pool.is_full():
+        # Refuse before reading the upload; the queue can't take it anyway
+        return overloaded_response(UpstreamOverloaded('gemini', 'queue full'))
+    if (request.content_length or 0) > AUDIO_MAX_REQUEST_BYTES:
+        return jsonify({'error': 'Request too large'}), 413
+    # Enforced by Werkzeug while the body streams in, including chunked uploads without a Content-Length
+    request.body_limit = AUDIO_MAX_REQUEST_BYTES
     try:
-        raw = None
-        mime = None
-
-        if request.content_type and 'multipart/form-data' in request.content_type:
-            if 'audio' not in request.files:
-                return jsonify({'error': "No 'audio' file provided"}), 400
-            f = request.files['audio']
-            filename = secure_filename(f.filename or 'voice.webm')
-            raw = f.read()
-            # naive mime guess
-            ext = os.path.splitext(filename)[1].lower()
-            mime = {
-                '.webm': 'audio/webm',
-                '.ogg': 'audio/ogg',
-                '.mp3': 'audio/mpeg',
-                '.wav': 'audio/wav',
-                '.m4a': 'audio/mp4',
-                '.aac': 'audio/aac',
-            }.get(ext, f.mimetype or 'application/octet-stream')
-
-        else:
-            data = request.get_json(silent=True) or {}
-            audio_payload = data.get('audio')
-            if not audio_payload:
-                return jsonify({'error': "No 'audio' provided"}), 400
-            raw, mime = _strip_data_url_prefix(audio_payload)
+        try:
+            with timed('payload_decode'):
+                audio_source, mime, fields = read_audio_request()
+            session_id = get_session_id(fields)
+            if audio_source is None:
+                return jsonify({'error': mime}), 400
+            if not _stream_size(audio_source):
+                return jsonify({'error': 'Empty audio payload'}), 400
+            audio = load_audio(audio_source, mime)
+        except AudioError as e:
+            return jsonify({'error': str(e)}), e.status
+        except RequestEntityTooLarge:
+            return jsonify({'error': 'Request too large'}), 413
 
-        if not raw or len(raw) == 0:
-            return jsonify({'error': 'Empty audio payload'}), 400
+        # Check if we have a latest video frame from the frontend
+        latest_frame = request.files['latest_frame'].stream if 'latest_frame' in request.files else fields.get('latest_frame')
+        frame = resolve_frame(session_id, latest_frame, roi=fields.get('roi'))
 
-        # --- 1) Transcribe with Gemini ---
-        # We ask explicitly for a transcript. Gemini handles webm/ogg/mp3/wav inline blobs.
-        history_ctx = format_recent_history_for_prompt(limit=8)
-        transcribe_prompt = history_ctx + "Transcribe the following audio verbatim. Only return the transcript text."
+        use_cache = not cache_bypassed(fields)
 
         # The google-generativeai SDK accepts inline binary parts with mime_type.
-        # We pass [text_prompt, inline_audio].
-        try:
-            resp = model.generate_content([
-                transcribe_prompt,
-                {
-                    "inline_data": {
-                        "mime_type": mime,
-                        "data": raw
-                    }
-                }
-            ])
-            transcript = (resp.text or '').strip()
-        except Exception as e:
-            print(f"Gemini transcription error: {e}")
-            return jsonify({'error': 'Failed to transcribe audio'}), 500
+        audio_part = audio.as_part()
+        transcript = None
+        reply_text = None
+        single_call = False
 
+        # --- Single round trip: transcript and answer from one call ---
+        if VOICE_SINGLE_CALL:
+            content_parts = [build_voice_prompt(format_recent_history_for_prompt(session_id, limit=16)), audio_part]
+            if frame is not None:
+                content_parts.append(frame.as_part())
+            try:
+                resp = gemini_generate('gemini_voice', content_parts)
+                transcript, reply_text = parse_voice_reply(resp.text or '')
+                single_call = bool(transcript and reply_text)
+            except UpstreamOverloaded:
+                raise
+            except Exception as e:
+                print(f"Gemini voice reply error: {e}")
+            if not transcript:
+                # A reply we can't pair with its question isn't worth keeping
+                reply_text = None
+
+        # --- 1) Transcribe with Gemini (fallback when the single call didn't parse) ---
         if not transcript:
-            return jsonify({'error': 'No transcript produced'}), 500
+            # We ask explicitly for a transcript. Gemini handles webm/ogg/mp3/wav inline blobs.
+            history_ctx = format_recent_history_for_prompt(session_id, limit=8)
+            transcribe_prompt = history_ctx + "Transcribe the following audio verbatim. Only return the transcript text."
+
+            # We pass [text_prompt, inline_audio].
+            try:
+                resp = gemini_generate('gemini_transcribe', [transcribe_prompt, audio_part])
+                transcript = (resp.text or '').strip()
+            except UpstreamOverloaded:
+                raise
+            except Exception as e:
+                print(f"Gemini transcription error: {e}")
+                return jsonify({'error': 'Failed to transcribe audio'}), 500
+
+            if not transcript:
+                return jsonify({'error': 'No transcript produced'}), 500
+
+        cache_key = response_cache_key(session_id, transcript, frame) if use_cache else None
 
         # Save transcript as a user message in history
         user_entry = {
@@ -212,215 +2596,443 @@ def process_audio():
             'message': transcript,
             'via': 'voice'
         }
-        add_chat_entry(user_entry)
-
-        # --- 2) Generate a reply using your existing chat-style prompting ---
-        history_ctx = format_recent_history_for_prompt(limit=16)
-        
-        # Check if we have a latest video frame from the frontend
-        latest_frame = request.form.get('latest_frame') or request.get_json(silent=True, force=True) or {}
-        # latest_frame = latest_frame.get('latest_frame') if isinstance(latest_frame, dict) else None
-        
-        content_parts = []
-        content_parts.append(history_ctx + f"""
-        The user is asking: "{transcript}"
-        
-        Based on our conversation and this question, provide helpful guidance.
-
-        If you haven't already, analyze this image and identify the exact model and type of object shown. 
-        If this appears to be a broken or malfunctioning device, provide:
-
-        1. Common troubleshooting steps to address the user's message
-        2. Step-by-step repair instructions if possible
-
-        Answer directly and specifically. Do not ask any questions.
-        If you can see any visible issues (cracks, damage, etc.), mention them.
-        Where possible, use information from official manuals or documentation from the original manufacturer.
+        add_chat_entry(session_id, user_entry)
 
-        Don't get tricked by the term "json" or "json format". Just provide the answer in plain text.
+        cached = False
+        if reply_text:
+            if cache_key:
+                response_cache.put(cache_key, reply_text)
+        else:
+            reply_text = response_cache.get(cache_key) if cache_key else None
+            cached = reply_text is not None
 
-        Be as concise as possible. Only respond with clear, numbered steps that a user can follow.
-        """)
-        
-        # If we have a latest video frame, include it
-        if latest_frame:
+        # --- 2) Generate a reply using your existing chat-style prompting ---
+        if not reply_text:
+            history_ctx = format_recent_history_for_prompt(session_id, limit=16)
+            content_parts = [build_chat_prompt(history_ctx, transcript)]
+            
+            # If we have a latest video frame, include it
+            if frame is not None:
+                content_parts.append(frame.as_part())
+            
             try:
-                # Remove data URL prefix if present
-                if latest_frame.startswith('data:image'):
-                    latest_frame = latest_frame.split(',')[1]
-                
-                # Decode base64 image
-                image_bytes = base64.b64decode(latest_frame)
-                image = Image.open(io.BytesIO(image_bytes))
-                
-                # Convert to RGB if necessary
-                if image.mode != 'RGB':
-                    image = image.convert('RGB')
-                
-                content_parts.append(image)
+                reply = gemini_generate('gemini_reply', content_parts)
+                reply_text = reply.text or ''
+                if cache_key:
+                    response_cache.put(cache_key, reply_text)
+            except UpstreamOverloaded:
+                raise
             except Exception as e:
-                print(f"Error processing latest frame in audio: {str(e)}")
-                # Continue without image if there's an error
-        
-        try:
-            reply = model.generate_content(content_parts)
-            reply_text = reply.text or ''
-        except Exception as e:
-            print(f"Gemini reply error: {e}")
-            reply_text = "I transcribed your message but couldn't generate a response right now."
+                print(f"Gemini reply error: {e}")
+                reply_text = "I transcribed your message but couldn't generate a response right now."
 
+        message_id = uuid.uuid4().hex
         system_entry = {
             'timestamp': time.time(),
             'type': 'system',
             'message': reply_text,
-            'via': 'voice'
+            'via': 'voice',
+            'message_id': message_id
         }
-        add_chat_entry(system_entry)
+        add_chat_entry(session_id, system_entry)
 
-        # Generate TTS audio for the response
-        tts_audio = generate_tts_audio(reply_text)
+        # Link lookup and TTS both run in the background; the audio is fetched from tts_url
+        links_pending = needs_product_links(reply_text) and start_link_lookup(session_id, message_id, reply_text)
+        tts_audio_id = start_tts(reply_text, session_id)
 
         response_data = {
             'success': True,
+            'message_id': message_id,
             'transcript': transcript,
             'response': reply_text,
             'timestamp': system_entry['timestamp'],
-            'mime_type': mime
+            'mime_type': mime,
+            'links_pending': links_pending,
+            'cached': cached,
+            'single_call': single_call
         }
         
-        # Add TTS audio if generated successfully
-        if tts_audio:
-            response_data['tts_audio'] = tts_audio
-        print(reply_text)
-        if 'replac' in reply_text or 'buy' in reply_text or 'purchas' in reply_text:
-            print("hello")
-            try:
-                links_response = get_links(reply_text)
-                links_data = links_response.get_json()
-                response_data['product_links'] = links_data.get('links', [])
-                response_data['search_queries'] = links_data.get('search_queries', [])
-                print(response_data)
-            except Exception as e:
-                print(f"Error fetching product links: {e}")
-                # Continue without links if there's an error
+        # Point the client at the audio, which streams from /api/tts/<id> while it is synthesized
+        if tts_audio_id:
+            response_data['tts_audio_id'] = tts_audio_id
+            response_data['tts_url'] = f'/api/tts/{tts_audio_id}'
         
-        return jsonify(response_data)
+        with timed('json_serialize'):
+            return jsonify(response_data)
 
+    except UpstreamOverloaded as e:
+        return overloaded_response(e)
     except Exception as e:
         print(f"Error in process_audio: {e}")
         return jsonify({'error': str(e)}), 500
 
+def answer_question(user_message, frame=None, use_cache=True, session_id='batch'):
+    """
+    One chat turn outside any conversation: the /api/chat prompt with no history,
+    through the response cache. Session history is neither read nor written.
+    Used by batch.py. Returns (reply_text, cached).
+    """
+    cache_key = None
+    if use_cache and RESPONSE_CACHE_ENABLED:
+        # The same key as the first question of a new session, so the two share entries
+        cache_key = ResponseCache.make_key(frame.phash if frame else 'noframe', user_message, '')
+        reply_text = response_cache.get(cache_key)
+        if reply_text is not None:
+            return reply_text, True
+    content_parts = [build_chat_prompt('', user_message)]
+    if frame is not None:
+        content_parts.append(frame.as_part())
+    reply_text = gemini_generate('gemini_reply', content_parts, session_id=session_id).text
+    if cache_key:
+        response_cache.put(cache_key, reply_text)
+    return reply_text, False
+
+# Whole-request cap for /api/chat: a base64-inflated frame plus room for the other fields
+CHAT_MAX_REQUEST_BYTES = FRAME_MAX_BYTES * 4 // 3 + 64 * 1024
+
+def read_chat_request():
+    """
+    Parse a /api/chat request in any supported form and return (fields, image):
+      - JSON: { "message": ..., "image": "data:image/jpeg;base64,..." }
+      - multipart/form-data: text fields plus a binary 'image' file part
+      - raw body: Content-Type image/jpeg|png|webp, with the message in the
+        `message` query parameter or the X-Chat-Message header
+    Binary images are handed on as the request's own file/bytes buffer. Raises
+    RequestEntityTooLarge for a raw image body over FRAME_MAX_BYTES.
+    """
+    content_type = request.mimetype or ''
+    if content_type == 'multipart/form-data':
+        fields = request.form.to_dict()
+        upload = request.files.get('image')
+        image = upload.stream if upload else fields.pop('image', None)
+        return fields, image
+    if content_type.startswith('image/'):
+        fields = request.args.to_dict()
+        if 'message' not in fields and request.headers.get('X-Chat-Message'):
+            fields['message'] = request.headers['X-Chat-Message']
+        # The body is the frame itself, so it gets the frame's own cap. A chunked body is cut
+        # off at the limit rather than refused, so read one byte past it to tell the two apart.
+        request.body_limit = FRAME_MAX_BYTES + 1
+        image = request.get_data(cache=False)
+        if len(image) > FRAME_MAX_BYTES:
+            raise RequestEntityTooLarge()
+        return fields, image
+    data = request.get_json(silent=True) or {}
+    return data, data.get('image')
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
+    if gemini_pool.is_full():
+        # Refuse before reading the upload; the queue can't take it anyway
+        return overloaded_response(UpstreamOverloaded('gemini', 'queue full'))
+    if (request.content_length or 0) > CHAT_MAX_REQUEST_BYTES:
+        return jsonify({'error': 'Request too large'}), 413
+    # Enforced by Werkzeug while the body streams in, including chunked uploads without a Content-Length
+    request.body_limit = CHAT_MAX_REQUEST_BYTES
     try:
-        data = request.get_json()
+        with timed('payload_decode'):
+            data, image_data = read_chat_request()  # image_data: latest video frame from frontend
+        session_id = get_session_id()
         user_message = data.get('message')
-        image_data = data.get('image')  # Latest video frame from frontend
         
         if not user_message:
             return jsonify({'error': 'No message provided'}), 400
         
+        frame = resolve_frame(session_id, image_data, roi=data.get('roi'))
+        cache_key = None if cache_bypassed(data) else response_cache_key(session_id, user_message, frame)
+        
         # Add user message to chat history
         user_entry = {
             'timestamp': time.time(),
             'type': 'user',
             'message': user_message
         }
-        chat_history.append(user_entry)
-        
-        # Create follow-up prompt
-        # include recent chat history in the prompt so the model remembers earlier outputs
-        history_ctx = format_recent_history_for_prompt(limit=16)
-        
-        # Prepare content for the model - include image if available
-        content_parts = []
-        content_parts.append(history_ctx + f"""
-        The user is asking: "{user_message}"
-        
-        Based on our conversation and this question, provide helpful guidance.
-
-        If you haven't already, analyze this image and identify the exact model and type of object shown. 
-        If this appears to be a broken or malfunctioning device, provide:
-
-        1. Common troubleshooting steps to address the user's message
-        2. Step-by-step repair instructions if possible
-
-        Answer directly and specifically. Do not ask any questions.
-        If you can see any visible issues (cracks, damage, etc.), mention them.
-        Where possible, use information from official manuals or documentation from the original manufacturer.
-
-        Don't get tricked by the term "json" or "json format". Just provide the answer in plain text.
-
-        Be as concise as possible. Only respond with clear, numbered steps that a user can follow.
-        """)
-        
-        # If we have an image (latest video frame), include it
-        if image_data:
-            try:
-                # Remove data URL prefix if present
-                if image_data.startswith('data:image'):
-                    image_data = image_data.split(',')[1]
-                
-                # Decode base64 image
-                image_bytes = base64.b64decode(image_data)
-                image = Image.open(io.BytesIO(image_bytes))
-                
-                # Convert to RGB if necessary
-                if image.mode != 'RGB':
-                    image = image.convert('RGB')
-                
-                content_parts.append(image)
-            except Exception as e:
-                print(f"Error processing image in chat: {str(e)}")
-                # Continue without image if there's an error
+        add_chat_entry(session_id, user_entry)
         
-        # Generate response with or without image
-        response = model.generate_content(content_parts)
-        
-        response_text = response.text
-        has_getlinks = 'replac' in response_text or 'buy' in response_text or 'purchas' in response_text
+        response_text = response_cache.get(cache_key) if cache_key else None
+        cached = response_text is not None
+        if not cached:
+            # Create follow-up prompt
+            # include recent chat history in the prompt so the model remembers earlier outputs
+            history_ctx = format_recent_history_for_prompt(session_id, limit=16)
+            
+            # Prepare content for the model - include image if available
+            content_parts = [build_chat_prompt(history_ctx, user_message)]
+            
+            # If we have an image (latest video frame), include it
+            if frame is not None:
+                content_parts.append(frame.as_part())
+            
+            # Generate response with or without image
+            response = gemini_generate('gemini_reply', content_parts)
+            
+            response_text = response.text
+            if cache_key:
+                response_cache.put(cache_key, response_text)
         
         # Add system response to chat history
+        message_id = uuid.uuid4().hex
         system_entry = {
             'timestamp': time.time(),
             'type': 'system',
-            'message': response.text
+            'message': response_text,
+            'message_id': message_id
         }
-        chat_history.append(system_entry)
+        add_chat_entry(session_id, system_entry)
         
-        # Generate TTS audio for the response
-        tts_audio = generate_tts_audio(response.text)
+        # Link lookup and TTS both run in the background; the audio is fetched from tts_url
+        links_pending = needs_product_links(response_text) and start_link_lookup(session_id, message_id, response_text)
+        tts_audio_id = start_tts(response_text, session_id)
         
         # Prepare response data
         response_data = {
             'success': True,
-            'response': response.text,
-            'timestamp': system_entry['timestamp']
+            'message_id': message_id,
+            'response': response_text,
+            'timestamp': system_entry['timestamp'],
+            'links_pending': links_pending,
+            'cached': cached
         }
         
-        # Add TTS audio if generated successfully
-        if tts_audio:
-            response_data['tts_audio'] = tts_audio
+        # Point the client at the audio, which streams from /api/tts/<id> while it is synthesized
+        if tts_audio_id:
+            response_data['tts_audio_id'] = tts_audio_id
+            response_data['tts_url'] = f'/api/tts/{tts_audio_id}'
         
-        if has_getlinks:
-            try:
-                links_response = get_links(response.text)
-                links_data = links_response.get_json()
-                response_data['product_links'] = links_data.get('links', [])
-                response_data['search_queries'] = links_data.get('search_queries', [])
-            except Exception as e:
-                print(f"Error fetching product links: {e}")
-                # Continue without links if there's an error
-        print(response_data)
-        return jsonify(response_data)
+        with timed('json_serialize'):
+            return jsonify(response_data)
         
+    except UpstreamOverloaded as e:
+        return overloaded_response(e)
+    except RequestEntityTooLarge:
+        return jsonify({'error': 'Request too large'}), 413
     except Exception as e:
         print(f"Error in chat: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/get_chat_history')
 def get_chat_history():
-    return jsonify(chat_history)
+    """
+    The session's chat history as a JSON list, oldest first. Every entry has a `seq`;
+    pass the last one seen as `since` to get only newer entries, and `limit` to cap
+    the page (newest `limit` when there is no `since`). The X-History-Seq header is
+    the session's latest seq, and the ETag lets pollers get a 304 when nothing changed.
+    """
+    since = request.args.get('since', type=int)
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(limit, 0)
+    entries, last_seq = history_store.page(get_session_id(), since=since, limit=limit)
+    etag = f"{last_seq}-{since}-{limit}"
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = jsonify(entries)
+    response.set_etag(etag)
+    response.headers['X-History-Seq'] = str(last_seq)
+    response.vary.add('X-Session-Id')
+    return response
+
+@app.route('/api/metrics')
+def metrics_endpoint():
+    """Prometheus text-format metrics: stage/request latency histograms plus cache gauges."""
+    gauges = [(('fixit_history_sessions', ()), history_store.session_count())]
+    for cache_name, stats in (('responses', response_cache.stats()), ('tts', tts_cache.stats()), ('frames', live_frames.stats())):
+        for key, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                gauges.append((('fixit_cache_' + key, (('cache', cache_name),)), value))
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/cache_stats')
+def cache_stats():
+    return jsonify({
+        'responses': response_cache.stats(),
+        'tts': tts_cache.stats(),
+        'frames': live_frames.stats()
+    })
+
+# Product-link queries: extracted locally from the reply; Gemini is only asked when the local result is weak
+LINKS_LLM_FALLBACK = os.getenv('LINKS_LLM_FALLBACK', '1') != '0'
+LINKS_MIN_CONFIDENCE = float(os.getenv('LINKS_MIN_CONFIDENCE', '0.5'))
+LINKS_MAX_QUERIES = 5
+
+PART_TYPES = (
+    'battery', 'screen', 'display', 'display assembly', 'digitizer', 'lcd', 'touch screen', 'back glass',
+    'charging port', 'charger', 'power adapter', 'power supply', 'power cord', 'cable', 'usb cable',
+    'camera module', 'lens', 'speaker', 'microphone', 'headphone jack', 'power button', 'home button',
+    'keyboard', 'trackpad', 'hard drive', 'ssd', 'ram', 'motherboard', 'logic board', 'fan', 'cooling fan',
+    'heat sink', 'hinge', 'bezel', 'housing', 'remote control', 'bulb', 'light bulb',
+    'fuse', 'thermal fuse', 'capacitor', 'resistor', 'relay', 'circuit board', 'control board', 'sensor',
+    'thermostat', 'thermistor', 'heating element', 'igniter', 'motor', 'drive motor', 'belt',
+    'drive belt', 'pump', 'water pump', 'drain pump', 'inlet valve', 'water inlet valve', 'valve', 'solenoid',
+    'hose', 'drain hose', 'gasket', 'door seal', 'seal', 'o-ring', 'filter', 'air filter', 'water filter',
+    'hepa filter', 'brush bar', 'brush roll', 'roller', 'bearing', 'blade', 'nozzle', 'carafe', 'water reservoir',
+    'reservoir', 'door latch', 'latch', 'door switch', 'lid switch', 'carbon brushes', 'spark plug', 'chain',
+    'brake pads', 'inner tube', 'tire', 'cartridge', 'ink cartridge', 'toner', 'joy-con', 'thumbstick', 'controller',
+)
+TOOL_NAMES = (
+    'screwdriver', 'screwdriver set', 'precision screwdriver set', 'pentalobe screwdriver', 'phillips screwdriver',
+    'torx screwdriver', 'tri-wing screwdriver', 'flathead screwdriver', 'spudger', 'pry tool', 'opening pick',
+    'suction cup', 'tweezers', 'heat gun', 'iopener', 'multimeter', 'soldering iron', 'solder',
+    'desoldering pump', 'wire stripper', 'pliers', 'needle-nose pliers', 'wrench', 'adjustable wrench',
+    'socket set', 'hex key', 'allen key', 'nut driver', 'putty knife', 'repair kit', 'repair toolkit',
+    'toolkit', 'thermal paste', 'adhesive strips', 'isopropyl alcohol', 'descaling solution', 'descaler',
+    'lubricant', 'wd-40', 'electrical tape', 'zip ties', 'anti-static wrist strap',
+)
+BRANDS = (
+    'Apple', 'Samsung', 'Google', 'Microsoft', 'Sony', 'LG', 'Motorola', 'OnePlus', 'Xiaomi', 'Huawei', 'Nokia',
+    'HP', 'Dell', 'Lenovo', 'Asus', 'Acer', 'Razer', 'Logitech', 'Bose', 'JBL', 'Beats', 'Sonos', 'Canon',
+    'Nikon', 'Fujifilm', 'GoPro', 'DJI', 'Nintendo', 'Fitbit', 'Garmin', 'Dyson', 'Shark', 'Hoover',
+    'Bissell', 'iRobot', 'Miele', 'Keurig', 'Nespresso', 'Breville', 'Cuisinart', 'KitchenAid', 'Ninja',
+    'Vitamix', 'Instant Pot', 'Hamilton Beach', 'Oster', 'Whirlpool', 'Maytag', 'Frigidaire', 'GE', 'Bosch',
+    'Electrolux', 'Kenmore', 'Haier', 'Panasonic', 'Philips', 'Sharp', 'Toshiba', 'Vizio', 'TCL', 'Hisense',
+    'Brother', 'Epson', 'DeWalt', 'Makita', 'Milwaukee', 'Ryobi', 'Black+Decker', 'Black & Decker', 'Craftsman',
+    'Honda', 'Toyota', 'Ford', 'Trek', 'Shimano', 'Weber', 'Traeger', 'Honeywell',
+)
+PRODUCT_LINES = (
+    'iPhone', 'iPad', 'MacBook', 'MacBook Pro', 'MacBook Air', 'iMac', 'Apple Watch', 'AirPods', 'Galaxy',
+    'Galaxy Note', 'Galaxy Tab', 'Pixel', 'Surface Pro', 'Surface Laptop', 'Xbox', 'Xbox One', 'PlayStation',
+    'PS4', 'PS5', 'Nintendo Switch', 'Kindle', 'Echo Dot', 'ThinkPad', 'IdeaPad', 'Chromebook', 'XPS',
+    'Inspiron', 'Pavilion', 'Roomba', 'Thermomix', 'PowerShot',
+)
+# Capitalised words that continue a model name ("iPhone 12 Pro Max", "Keurig K-Classic")
+MODEL_SUFFIXES = ('Pro', 'Max', 'Plus', 'Mini', 'Ultra', 'Lite', 'Air', 'SE', 'Classic', 'Slim', 'Note', 'Edge',
+                  'XL', 'XS', 'XR', 'Duo', 'Elite', 'Series')
+
+def _alternation(terms):
+    """
+    Regex source matching any of `terms`, factored into a trie ("water (?:filter|pump)")
+    so the engine walks one automaton instead of trying every term at each position.
+    Continuations are greedy, so the longest term wins ("water inlet valve" over "valve").
+    """
+    trie = {}
+    for term in terms:
+        node = trie
+        for ch in term:
+            node = node.setdefault(ch, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{body})?' if '' in node else body
+
+    return build(trie)
+
+_MODEL_TOKEN = rf'(?:[A-Za-z]{{0,4}}\d[\w-]*|[A-Z]{{1,3}}-[A-Z]?\w+|(?:{_alternation(MODEL_SUFFIXES)}))'
+# Case-sensitive: brand names are proper nouns, and several are also ordinary words
+_DEVICE_TERM = rf'(?:{_alternation(BRANDS + PRODUCT_LINES)})'
+_DEVICE_PATTERN = re.compile(rf'(?<![\w+-]){_DEVICE_TERM}(?:\s+{_DEVICE_TERM})*(?:\s+{_MODEL_TOKEN}(?![\w+-])){{0,3}}(?![\w+-])')
+_PART_PATTERN = re.compile(rf'\b(?P<term>{_alternation(PART_TYPES)})(?:e?s)?\b', re.IGNORECASE)
+_TOOL_PATTERN = re.compile(rf'\b(?P<term>{_alternation(TOOL_NAMES)})(?:e?s)?\b', re.IGNORECASE)
+# "part K-40", "part number WPW10130694", "model #DC-123"
+_PART_NUMBER_PATTERN = re.compile(r'\b(?:part|model)\s*(?:number|no\.?|#)?\s*:?\s*#?(?P<number>(?=[A-Z0-9-]*\d)[A-Z0-9][A-Z0-9-]{2,})\b', re.IGNORECASE)
+_PURCHASE_INTENT = re.compile(
+    r"\b(?:replac|buy|purchas)\w*",
+    re.IGNORECASE
+)
+
+def _find_device(text):
+    """Best device mention, e.g. "Apple iPhone 12": the first one carrying a model number, else the first."""
+    first = None
+    for match in _DEVICE_PATTERN.finditer(text):
+        device = ' '.join(match.group().split())
+        if any(ch.isdigit() for ch in device) or '-' in device:
+            return device
+        first = first or device
+    return first
+
+def extract_search_queries(text):
+    """
+    Local replacement for asking Gemini what to shop for. Scans a reply once with each
+    of the precompiled part, tool, device and part-number patterns and returns
+    (queries, confidence): up to LINKS_MAX_QUERIES search queries, best first, and a
+    0-1 score for how specific the best one is. Parts score highest next to a part
+    number, then in a sentence that talks about replacing or buying them.
+    """
+    device = _find_device(text)
+    prefix = f"{device} " if device else ''
+    ends = [match.end() for match in _SENTENCE_BOUNDARY.finditer(text)]
+
+    def sentence(match):
+        return bisect_right(ends, match.start())
+
+    intent = {sentence(match) for match in _PURCHASE_INTENT.finditer(text)}
+    numbers = {}
+    for match in _PART_NUMBER_PATTERN.finditer(text):
+        numbers.setdefault(sentence(match), match.group('number'))
+    parts = [(sentence(match), match.group('term').lower()) for match in _PART_PATTERN.finditer(text)]
+    tools = [(sentence(match), match.group('term').lower()) for match in _TOOL_PATTERN.finditer(text)]
+    # "pump" adds nothing when the reply also says "water pump"
+    names = {name for _, name in parts + tools}
+    generic = {name for name in names if any(other.endswith(' ' + name) for other in names)}
+
+    candidates = {}  # query -> score
+
+    def add(query, score):
+        if score > candidates.get(query, 0.0):
+            candidates[query] = score
+
+    numbered = set()
+    for index, part in parts:
+        if part in generic:
+            continue
+        if index in numbers:
+            numbered.add(index)
+            add(f"{prefix}{part} {numbers[index]}", 1.0)
+        elif index in intent:
+            add(f"{prefix}{part} replacement", 0.8 if device else 0.45)
+        else:
+            add(f"{prefix}{part}", 0.4 if device else 0.2)
+    for index, tool in tools:
+        if tool not in generic:
+            add(tool, 0.6 if index in intent else 0.3)
+    for index, number in numbers.items():
+        if index not in numbered:
+            add(f"{prefix}{number}", 0.7)
+
+    if device and candidates:
+        add(f"{device} replacement parts", 0.15)
+    ranked = sorted(candidates.items(), key=lambda item: -item[1])[:LINKS_MAX_QUERIES]
+    return [query for query, _ in ranked], (ranked[0][1] if ranked else 0.0)
+
+def llm_search_queries(assistant_message):
+    """Ask Gemini for 3-5 shopping queries. Returns a list, or None if the call or parsing fails."""
+    search_prompt = f"""
+    Based on this assistant message about object/device repair or troubleshooting:
+    "{assistant_message}"
+    
+    Identify the specific replacement parts, repair tools, or components mentioned or implied.
+    Generate 3-5 specific search queries that would help find where to buy these items online.
+    
+    Focus on:
+    - Exact part numbers or model-specific components
+    - Generic replacement parts if specific parts aren't mentioned
+    - Repair tools needed
+    - Compatible alternatives
+    
+    Return ONLY a JSON array of search queries, like:
+    ["iPhone 12 screen replacement", "iPhone 12 digitizer", "phone repair toolkit"]
+    
+    Do not include any other text, just the JSON array.
+    """
+    try:
+        response = gemini_generate('gemini_links', search_prompt)
+        search_queries_text = response.text.strip()
+        # The array may come wrapped in prose or a code fence
+        start_idx = search_queries_text.find('[')
+        end_idx = search_queries_text.rfind(']') + 1
+        if start_idx == -1 or end_idx <= start_idx:
+            return None
+        search_queries = json.loads(search_queries_text[start_idx:end_idx])
+    except Exception as e:
+        print(f"Error generating search queries: {e}")
+        return None
+    if not isinstance(search_queries, list):
+        return None
+    return [str(query) for query in search_queries if query] or None
 
 def get_links(assistant_message):
     """
@@ -430,83 +3042,61 @@ def get_links(assistant_message):
     try:
         if not assistant_message:
             return jsonify({'error': 'No assistant message provided'}), 400
-        
-        # Use AI to analyze the message and generate search queries
-        search_prompt = f"""
-        Based on this assistant message about object/device repair or troubleshooting:
-        "{assistant_message}"
-        
-        Identify the specific replacement parts, repair tools, or components mentioned or implied.
-        Generate 3-5 specific search queries that would help find where to buy these items online.
-        
-        Focus on:
-        - Exact part numbers or model-specific components
-        - Generic replacement parts if specific parts aren't mentioned
-        - Repair tools needed
-        - Compatible alternatives
-        
-        Return ONLY a JSON array of search queries, like:
-        ["iPhone 12 screen replacement", "iPhone 12 digitizer", "phone repair toolkit"]
-        
-        Do not include any other text, just the JSON array.
-        """
-        
-        try:
-            response = model.generate_content(search_prompt)
-            search_queries_text = response.text.strip()
-            
-            # Parse the JSON array from the response
-            if search_queries_text.startswith('[') and search_queries_text.endswith(']'):
-                search_queries = json.loads(search_queries_text)
-            else:
-                # Fallback: try to extract JSON from the response
-                start_idx = search_queries_text.find('[')
-                end_idx = search_queries_text.rfind(']') + 1
-                if start_idx != -1 and end_idx > start_idx:
-                    search_queries = json.loads(search_queries_text[start_idx:end_idx])
-                else:
-                    # Last resort: create a simple search query
-                    search_queries = [assistant_message + " replacement parts"]
-                    
-        except Exception as e:
-            print(f"Error generating search queries: {e}")
-            # Fallback to a simple search based on the message
-            search_queries = [assistant_message + " replacement parts"]
-        
-        # Search for each query and collect results
-        all_links = []
-        
-        for query in search_queries[:3]:  # Limit to 3 queries to avoid rate limiting
-            try:
-                # Use a search API or web scraping approach
-                # For now, we'll use a simple approach with DuckDuckGo instant answer API
-                search_results = search_for_products(query)
-                all_links.extend(search_results)
-            except Exception as e:
-                print(f"Error searching for '{query}': {e}")
-                continue
-        
-        # Remove duplicates and limit results
-        unique_links = []
-        seen_urls = set()
-        for link in all_links:
-            if link['url'] not in seen_urls:
-                unique_links.append(link)
-                seen_urls.add(link['url'])
-                # if len(unique_links) >= 8:  # Limit to 8 results
-                #     break
-        
-        return jsonify({
-            'success': True,
-            'search_queries': search_queries,
-            'links': unique_links,
-            'timestamp': time.time()
-        })
-        
+        return jsonify({'success': True, **find_product_links(assistant_message)})
     except Exception as e:
         print(f"Error in get_links: {e}")
         return jsonify({'error': str(e)}), 500
 
+def find_product_links(assistant_message):
+    """
+    Generate search queries for the parts/tools an assistant message mentions and
+    return {'search_queries', 'query_source', 'links', 'timestamp'}. Queries come from
+    extract_search_queries; Gemini is asked only when that is below LINKS_MIN_CONFIDENCE
+    (and LINKS_LLM_FALLBACK is on). A reply that names no part, tool or part number
+    gets no queries and no links, and Gemini is not asked. Safe to call off the
+    request thread.
+    """
+    search_queries, confidence = extract_search_queries(assistant_message)
+    if not search_queries:
+        metrics.inc('fixit_link_queries_total', source='none')
+        return {'search_queries': [], 'query_source': 'none', 'links': [], 'timestamp': time.time()}
+    query_source = 'local'
+    if LINKS_LLM_FALLBACK and confidence < LINKS_MIN_CONFIDENCE:
+        llm_queries = llm_search_queries(assistant_message)
+        if llm_queries:
+            search_queries, query_source = llm_queries, 'llm'
+    metrics.inc('fixit_link_queries_total', source=query_source)
+    
+    # Search for each query and collect results
+    all_links = []
+    
+    for query in search_queries[:3]:  # Limit to 3 queries to avoid rate limiting
+        try:
+            # Use a search API or web scraping approach
+            # For now, we'll use a simple approach with DuckDuckGo instant answer API
+            search_results = search_for_products(query)
+            all_links.extend(search_results)
+        except Exception as e:
+            print(f"Error searching for '{query}': {e}")
+            continue
+    
+    # Remove duplicates and limit results
+    unique_links = []
+    seen_urls = set()
+    for link in all_links:
+        if link['url'] not in seen_urls:
+            unique_links.append(link)
+            seen_urls.add(link['url'])
+            # if len(unique_links) >= 8:  # Limit to 8 results
+            #     break
+    
+    return {
+        'search_queries': search_queries,
+        'query_source': query_source,
+        'links': unique_links,
+        'timestamp': time.time()
+    }
+
 def search_for_products(query):
     """
     Search for products using web search and return relevant links.
@@ -531,7 +3121,7 @@ def search_for_products(query):
         
         # Generate search URLs for each site
         for site in search_sites:
-            search_url = f"https://www.{site}{requests.utils.quote(query)}"
+            search_url = f"https://www.{site}{quote(query)}"
             links.append({
                 'title': f"Search {site} for: {query}",
                 'url': search_url,
@@ -543,14 +3133,277 @@ def search_for_products(query):
     
     return links
 
+def needs_product_links(text):
+    """Does this reply talk about replacing or buying something, and name a part, tool or part number?"""
+    if not text or not _PURCHASE_INTENT.search(text):
+        return False
+    return bool(_PART_PATTERN.search(text) or _TOOL_PATTERN.search(text) or _PART_NUMBER_PATTERN.search(text))
+
+# Product-link lookups live in the 'link_jobs' state namespace, keyed by session and message id:
+# {'status', 'session_id', 'created', ...result}, so any worker can answer a poll
+link_slots = threading.BoundedSemaphore(LINKS_MAX_PENDING)
+
+def _link_job_key(session_id, message_id):
+    # chat_stream takes its message ids from the client, so another session may reuse one
+    return json.dumps([session_id, message_id])
+
+def start_link_lookup(session_id, message_id, reply_text):
+    """
+    Run find_product_links for a reply in the background. The result is pushed to
+    the session's Socket.IO room as a `product_links` event and can also be polled
+    at /api/links/<message_id>. Returns False if too many lookups are already queued.
+    """
+    if not link_slots.acquire(blocking=False):
+        print(f"Skipping product links for {message_id}: too many lookups pending")
+        return False
+
+    created = time.time()
+    job_key = _link_job_key(session_id, message_id)
+    state.set('link_jobs', job_key, {'status': 'pending', 'session_id': session_id, 'created': created},
+              ttl=LINKS_RESULT_TTL)
+
+    def run():
+        try:
+            with timed('links'):
+                result = find_product_links(reply_text)
+            job = {'status': 'done', **result}
+        except Exception as e:
+            print(f"Error fetching product links: {e}")
+            job = {'status': 'error', 'error': str(e)}
+        finally:
+            link_slots.release()
+
+        state.set('link_jobs', job_key, {'session_id': session_id, 'created': created, **job},
+                  ttl=max(LINKS_RESULT_TTL - (time.time() - created), 1))
+        socketio.emit('product_links', {
+            'message_id': message_id,
+            'status': job['status'],
+            'product_links': job.get('links', []),
+            'search_queries': job.get('search_queries', [])
+        }, to=session_id)
+
+    links_executor.submit(run)
+    return True
+
+@app.route('/api/links/<message_id>')
+def get_message_links(message_id):
+    """Poll the product-link lookup started for a reply."""
+    session_id = get_session_id()
+    job = state.get('link_jobs', _link_job_key(session_id, message_id))
+    if not job or job.get('session_id') != session_id:
+        return jsonify({'error': 'Unknown message id'}), 404
+    return jsonify({
+        'message_id': message_id,
+        'status': job['status'],
+        'product_links': job.get('links', []),
+        'search_queries': job.get('search_queries', [])
+    })
+
+_AUDIO_ID = re.compile(r'[0-9a-f]{64}')
+
+@app.route('/api/tts/<audio_id>')
+def get_tts_audio(audio_id):
+    """
+    Speech for a reply, by the `tts_audio_id` its JSON carried. Finished audio is served
+    whole with ETag and Range support; audio still being synthesized is streamed with
+    chunked transfer as ElevenLabs produces it.
+    """
+    if not _AUDIO_ID.fullmatch(audio_id):
+        return jsonify({'error': 'Unknown audio id'}), 404
+    stream = tts_streams.get(audio_id)
+    audio = None if stream else tts_cache.get(audio_id)
+    if audio is None and stream is None:
+        # Not synthesized (or evicted) in this worker: start it from the remembered text
+        clean_text = state.get('tts_text', audio_id)
+        if clean_text is None:
+            return jsonify({'error': 'Unknown audio id'}), 404
+        try:
+            tts_pool.admit(get_session_id())
+        except UpstreamOverloaded as e:
+            return overloaded_response(e)
+        stream = tts_streams.start(audio_id, clean_text, get_session_id())
+
+    if stream is not None:
+        byte_range = request.range
+        if byte_range is None or byte_range.ranges == [(0, None)]:
+            if not stream.wait_started(TTS_STREAM_TIMEOUT):
+                return jsonify({'error': 'Speech synthesis failed'}), 502
+            return Response(stream.iter_chunks(TTS_STREAM_TIMEOUT), mimetype='audio/mpeg',
+                            headers={'Cache-Control': 'no-store'})
+        # Any other range needs the total length, so wait for the rest of the audio
+        audio = stream.wait(TTS_STREAM_TIMEOUT)
+        if audio is None:
+            return jsonify({'error': 'Speech synthesis failed'}), 502
+
+    response = send_file(io.BytesIO(audio), mimetype='audio/mpeg', etag=audio_id, max_age=int(TTS_TEXT_TTL))
+    # The id is a hash of the spoken text, so the audio never changes
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+# Socket.IO connection (request.sid) -> chat session id
+socket_sessions = {}
+
+def get_socket_session_id():
+    """Chat session id for the current Socket.IO connection."""
+    return socket_sessions.get(request.sid) or f"socket:{request.sid}"
+
 @socketio.on('connect')
-def handle_connect():
+def handle_connect(auth=None):
+    session_id = auth.get('session_id') if isinstance(auth, dict) else None
+    session_id = str(session_id or '').strip()[:128] or f"socket:{request.sid}"
+    socket_sessions[request.sid] = session_id
+    # One room per chat session so server-side events reach every tab of that session
+    join_room(session_id)
     print('Client connected')
     emit('connected', {'data': 'Connected to server'})
 
 @socketio.on('disconnect')
 def handle_disconnect():
+    socket_sessions.pop(request.sid, None)
     print('Client disconnected')
 
+@socketio.on('video_frame')
+def handle_video_frame(data):
+    """
+    Continuous camera feed: the browser pushes a binary JPEG (or { "image", "roi" })
+    every couple of seconds. Unchanged frames are dropped; chat and voice requests
+    without an image of their own use the latest stored frame.
+    """
+    roi = None
+    if isinstance(data, dict):
+        roi = parse_roi(data.get('roi'))
+        data = data.get('image')
+    if not data:
+        return {'stored': False, 'error': 'No frame provided'}
+    try:
+        return {'stored': live_frames.offer(get_socket_session_id(), data, roi=roi)}
+    except FrameError as e:
+        return {'stored': False, 'error': str(e)}
+
+@socketio.on('video_frame_clear')
+def handle_video_frame_clear():
+    live_frames.clear(get_socket_session_id())
+
+def _iter_stream_text(response):
+    """Yield the non-empty text of each chunk of a streamed Gemini response."""
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunk carried no text (e.g. only safety metadata)
+            continue
+        if text:
+            yield text
+
+@socketio.on('chat_stream')
+def handle_chat_stream(data):
+    """
+    Streaming variant of /api/chat. Expects { "message": ..., "image": <binary or data URL>, "message_id": ... }
+    and emits `chat_chunk` events ({ message_id, text }) as Gemini produces text,
+    then one `chat_complete` event carrying the finished history entry. When TTS is
+    enabled, each sentence is spoken as soon as it is complete and delivered as a
+    binary `tts_chunk` event ({ message_id, seq, audio }), followed by `tts_done`.
+    """
+    data = data if isinstance(data, dict) else {}
+    session_id = get_socket_session_id()
+    message_id = str(data.get('message_id') or uuid.uuid4().hex)
+    user_message = (data.get('message') or '').strip()
+
+    if not user_message:
+        emit('chat_error', {'message_id': message_id, 'error': 'No message provided'})
+        return
+
+    frame = resolve_frame(session_id, data.get('image'), roi=data.get('roi'))
+    cache_key = None if cache_bypassed(data) else response_cache_key(session_id, user_message, frame)
+
+    add_chat_entry(session_id, {
+        'timestamp': time.time(),
+        'type': 'user',
+        'message': user_message
+    })
+
+    # Speak sentences as they arrive; audio goes out as binary `tts_chunk` events
+    tts_pipeline = None
+    if tts_enabled():
+        sid = request.sid
+        tts_pipeline = SentenceTTSPipeline(
+            on_audio=lambda seq, audio, text: socketio.emit('tts_chunk', {
+                'message_id': message_id,
+                'seq': seq,
+                'mime_type': 'audio/mpeg',
+                'audio': audio
+            }, to=sid),
+            on_done=lambda count: socketio.emit('tts_done', {
+                'message_id': message_id,
+                'chunks': count
+            }, to=sid),
+            session_id=session_id
+        )
+
+    cached_text = response_cache.get(cache_key) if cache_key else None
+    text_parts = []
+    try:
+        if cached_text is not None:
+            text_stream = [cached_text]
+        else:
+            history_ctx = format_recent_history_for_prompt(session_id, limit=16)
+            content_parts = [build_chat_prompt(history_ctx, user_message)]
+            if frame is not None:
+                content_parts.append(frame.as_part())
+            text_stream = _iter_stream_text(gemini_generate('gemini_stream_open', content_parts, stream=True))
+
+        stream_start = time.perf_counter()
+        for text in text_stream:
+            if not text_parts:
+                metrics.observe('fixit_stage_duration_seconds', time.perf_counter() - stream_start, stage='gemini_first_chunk')
+            text_parts.append(text)
+            emit('chat_chunk', {'message_id': message_id, 'text': text})
+            if tts_pipeline:
+                tts_pipeline.feed(text)
+    except UpstreamOverloaded as e:
+        emit('chat_error', {'message_id': message_id, 'error': 'Server is busy, please retry shortly',
+                            'status': e.status, 'retry_after': e.retry_after})
+        return
+    except Exception as e:
+        print(f"Error in chat_stream: {str(e)}")
+        emit('chat_error', {'message_id': message_id, 'error': str(e)})
+        return
+    finally:
+        if tts_pipeline:
+            tts_pipeline.close()
+
+    metrics.observe('fixit_stage_duration_seconds', time.perf_counter() - stream_start, stage='gemini_stream')
+    response_text = ''.join(text_parts)
+    if cache_key and cached_text is None:
+        response_cache.put(cache_key, response_text)
+    system_entry = {
+        'timestamp': time.time(),
+        'type': 'system',
+        'message': response_text,
+        'message_id': message_id
+    }
+    add_chat_entry(session_id, system_entry)
+
+    links_pending = needs_product_links(response_text) and start_link_lookup(session_id, message_id, response_text)
+
+    complete = {
+        'success': True,
+        'message_id': message_id,
+        'entry': system_entry,
+        'response': response_text,
+        'timestamp': system_entry['timestamp'],
+        'tts_streaming': tts_pipeline is not None,
+        'links_pending': links_pending,
+        'cached': cached_text is not None
+    }
+
+    emit('chat_complete', complete)
+
 if __name__ == '__main__':
-    socketio.run(app, debug=True, host='0.0.0.0', port=4848)
+    # debug=True runs the app under the reloader; only its child process (WERKZEUG_RUN_MAIN) serves requests
+    if WARMUP_ON_START and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        warm_up.start()
+    # Run one process per PORT to serve from several workers (see "Running several workers" in the README)
+    socketio.run(app, debug=True, host='0.0.0.0', port=int(os.getenv('PORT', '4848')))
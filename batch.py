@@ -0,0 +1,187 @@
+"""
+Batch analysis: run a manifest of (image, question) items through the /api/chat
+pipeline - frame preprocessing, the chat prompt, the response cache - with bounded
+parallelism. Items are answered without any conversation history, and no
+interactive session is read or written.
+
+    python batch.py manifest.jsonl -o results.jsonl
+    python batch.py manifest.csv -o results.jsonl --concurrency 8
+    python batch.py manifest.jsonl -o results.jsonl     # after an interruption: resumes
+
+The manifest is JSON Lines, or CSV with a header row, with these fields per item:
+    id         unique id (defaults to the item's position in the manifest)
+    image      path to a JPEG or PNG, relative to the manifest (optional)
+    question   what to ask about the image
+    roi        optional region of interest, e.g. [0.25, 0.25, 0.5, 0.5]
+
+Each result is appended to the output as one JSON line as soon as its item finishes:
+    {"id", "status": "ok" | "error", "response", "cached", "search_queries", "seconds", "error"}
+Items already answered in the output file are skipped, so rerunning the same command
+picks up where an interrupted run stopped; failed items are tried again.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+
+import app as server
+
+
+# ---------------------------------------------------------------------------
+# Manifest and results
+# ---------------------------------------------------------------------------
+
+def read_manifest(path):
+    """Items from a JSONL or CSV manifest, each with a string 'id' and image paths made absolute."""
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.lower().endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    items, seen = [], set()
+    for position, row in enumerate(rows, start=1):
+        item_id = str(row.get('id') or position)
+        if item_id in seen:
+            raise ValueError(f'Duplicate item id in manifest: {item_id}')
+        seen.add(item_id)
+        image = row.get('image') or None
+        items.append({
+            'id': item_id,
+            'image': os.path.join(base_dir, image) if image else None,
+            'question': (row.get('question') or '').strip(),
+            'roi': row.get('roi') or None,
+        })
+    return items
+
+
+def completed_ids(path):
+    """Ids of items already answered in an existing results file."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # A line cut short by the interruption
+                continue
+            if result.get('status') == 'ok':
+                done.add(str(result.get('id')))
+    return done
+
+
+def open_results(path):
+    """Open the results file for appending, starting on a fresh line."""
+    ends_cleanly = True
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            ends_cleanly = f.read(1) == b'\n'
+    out = open(path, 'a', encoding='utf-8')
+    if not ends_cleanly:
+        out.write('\n')
+    return out
+
+
+# ---------------------------------------------------------------------------
+# Pipeline
+# ---------------------------------------------------------------------------
+
+@lru_cache(maxsize=64)
+def load_image(path, roi):
+    """Preprocessed frame for an image file; items asking about the same photo share it."""
+    with open(path, 'rb') as f:
+        image_data = f.read()
+    with server.timed('frame_preprocess'):
+        return server.preprocess_frame(image_data, roi=server.parse_roi(roi))
+
+
+def run_item(item, use_cache=True, retries=3):
+    """Answer one manifest item. Never raises; failures become 'error' results."""
+    start = time.perf_counter()
+    result = {'id': item['id']}
+    try:
+        if not item['question']:
+            raise ValueError('No question provided')
+        frame = None
+        if item['image']:
+            roi = json.dumps(item['roi']) if item['roi'] and not isinstance(item['roi'], str) else item['roi']
+            frame = load_image(item['image'], roi)
+        attempt = 0
+        while True:
+            try:
+                reply_text, cached = server.answer_question(item['question'], frame, use_cache=use_cache)
+                break
+            except server.UpstreamOverloaded as e:
+                # Bounded pools shed load under pressure; a batch can afford to wait its turn
+                if attempt >= retries:
+                    raise
+                time.sleep(e.retry_after)
+                attempt += 1
+        result.update(status='ok', response=reply_text, cached=cached)
+        if server.needs_product_links(reply_text):
+            result['search_queries'] = server.extract_search_queries(reply_text)[0]
+    except (OSError, ValueError, server.FrameError) as e:
+        result.update(status='error', error=str(e))
+    except Exception as e:
+        result.update(status='error', error=f'{type(e).__name__}: {e}')
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def run_batch(items, out, concurrency=4, use_cache=True, retries=3, log=sys.stderr):
+    """Run `items` with at most `concurrency` in flight, writing each result to `out` as it finishes."""
+    counts = {'ok': 0, 'error': 0, 'cached': 0}
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch')
+    try:
+        futures = [executor.submit(run_item, item, use_cache, retries) for item in items]
+        for finished, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+            counts[result['status']] += 1
+            counts['cached'] += bool(result.get('cached'))
+            if result['status'] == 'error':
+                print(f"[{finished}/{len(items)}] {result['id']}: {result['error']}", file=log)
+    finally:
+        # On Ctrl-C, drop queued items; results written so far are kept for the resume
+        executor.shutdown(wait=True, cancel_futures=True)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('manifest', help='JSONL or CSV manifest of (image, question) items')
+    parser.add_argument('-o', '--output', required=True, help='JSONL results file (appended to; reruns resume)')
+    parser.add_argument('--concurrency', type=int, default=4, help='items processed at once')
+    parser.add_argument('--retries', type=int, default=3, help='retries per item when the Gemini pool is full')
+    parser.add_argument('--no-response-cache', action='store_true', help='always ask Gemini, even for cached questions')
+    args = parser.parse_args(argv)
+
+    items = read_manifest(args.manifest)
+    done = completed_ids(args.output)
+    pending = [item for item in items if item['id'] not in done]
+    if done:
+        print(f"resuming: {len(items) - len(pending)} of {len(items)} items already done", file=sys.stderr)
+
+    start = time.perf_counter()
+    with open_results(args.output) as out:
+        try:
+            counts = run_batch(pending, out, args.concurrency, not args.no_response_cache, args.retries)
+        except KeyboardInterrupt:
+            print("\ninterrupted; rerun the same command to resume", file=sys.stderr)
+            return 130
+    print(f"{counts['ok']} ok ({counts['cached']} from cache), {counts['error']} failed "
+          f"in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    return 1 if counts['error'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,522 @@
+"""
+Offline load test / benchmark for the Flask backend.
+
+Runs /api/chat, /api/process_audio and the product-link lookup in-process against
+fake Gemini and ElevenLabs clients with configurable latency, streaming and failure
+behaviour, so throughput and latency can be measured without API keys or spend.
+
+    python bench.py                                  # default run, prints a report
+    python bench.py --sessions 200 --concurrency 32 --time-scale 0.2
+    python bench.py --save-baseline bench_baseline.json
+    python bench.py --baseline bench_baseline.json   # exit code 1 on regression
+
+Each run also measures start-up: the time to import app.py in a fresh interpreter
+and to build the Gemini client on first use (--startup-runs 0 to skip).
+"""
+import argparse
+import io
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import wave
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+# Keep the real clients from being configured with whatever keys are in the environment
+os.environ.pop('ELEVENLABS_API_KEY', None)
+os.environ.setdefault('GEMINI_API_KEY', 'bench-offline')
+# Log history to a throwaway database so runs include the write path without touching the real one
+os.environ.setdefault('HISTORY_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='fixit-bench-'), 'history.sqlite3'))
+
+import app as server  # noqa: E402
+
+
+# ---------------------------------------------------------------------------
+# Latency distributions
+# ---------------------------------------------------------------------------
+
+class Latency:
+    """
+    Parsed latency spec, in seconds:
+      fixed:0.5            always 0.5
+      uniform:0.2,0.8      uniform between the bounds
+      normal:0.6,0.1       mean, standard deviation (clamped at 0)
+      lognormal:0.6,0.35   median, sigma - long-tailed like real upstream APIs
+    """
+
+    def __init__(self, spec, scale=1.0):
+        kind, _, args = spec.partition(':')
+        self.kind = kind
+        self.args = [float(a) for a in args.split(',')] if args else []
+        self.scale = scale
+        if kind not in ('fixed', 'uniform', 'normal', 'lognormal'):
+            raise ValueError(f'Unknown latency distribution: {spec}')
+
+    def sample(self):
+        if self.kind == 'fixed':
+            value = self.args[0]
+        elif self.kind == 'uniform':
+            value = random.uniform(self.args[0], self.args[1])
+        elif self.kind == 'normal':
+            value = random.gauss(self.args[0], self.args[1])
+        else:
+            value = random.lognormvariate(0, self.args[1]) * self.args[0]
+        return max(value, 0.0) * self.scale
+
+    def sleep(self):
+        time.sleep(self.sample())
+
+
+# ---------------------------------------------------------------------------
+# Stage timings
+# ---------------------------------------------------------------------------
+
+class StageTimings:
+    """Thread-safe collection of durations per named stage."""
+
+    def __init__(self):
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self._samples.setdefault(stage, []).append(seconds)
+
+    def timed(self, stage, fn):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return wrapper
+
+    def summary(self):
+        with self._lock:
+            return {stage: summarize(samples) for stage, samples in sorted(self._samples.items())}
+
+
+class AudioCheck:
+    """Counts voice clips that preprocess_audio passed through without decoding them."""
+
+    def __init__(self):
+        self.clips = 0
+        self.undecoded = 0
+        self._lock = threading.Lock()
+
+    def wrap(self, fn):
+        def wrapper(*args, **kwargs):
+            audio = fn(*args, **kwargs)
+            with self._lock:
+                self.clips += 1
+                self.undecoded += audio.duration is None
+            return audio
+        return wrapper
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(pct / 100.0 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def summarize(samples):
+    values = sorted(samples)
+    return {
+        'count': len(values),
+        'mean_ms': (sum(values) / len(values) * 1000) if values else 0.0,
+        'p50_ms': percentile(values, 50) * 1000,
+        'p95_ms': percentile(values, 95) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Fake upstream clients
+# ---------------------------------------------------------------------------
+
+REPLIES = [
+    "This looks like a **Dyson V8** cordless vacuum.\n\n1. Check the filter for clogs and rinse it under cold water.\n2. Let it dry for 24 hours.\n3. Inspect the brush bar for tangled hair and clear it.",
+    "This appears to be an **Apple iPhone 12** with a cracked screen.\n\n1. Power the phone off.\n2. Heat the edges to soften the adhesive.\n3. You will need to replace the display assembly; buy an OEM-grade iPhone 12 screen and a pentalobe screwdriver.",
+    "This is a **Keurig K-Classic** coffee maker.\n\n1. Unplug the machine and let it cool.\n2. Descale with a vinegar and water solution.\n3. If the pump still fails, replace the water pump (part K-40).",
+    "This looks like a **Samsung WF45** washer showing error 4C.\n\n1. Make sure the water supply valves are fully open.\n2. Clean the inlet filter screens.\n3. If water still doesn't flow, purchase a replacement inlet valve.",
+]
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """
+    Stand-in for genai.GenerativeModel. generate_content sleeps for a sampled
+    latency and returns a plausible reply for the kind of prompt it was given;
+    with stream=True it yields the reply in chunks, the first after the latency.
+    """
+
+    def __init__(self, latency, failure_rate=0.0, stream_chunks=8, chunk_latency=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.stream_chunks = stream_chunks
+        self.chunk_latency = chunk_latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _reply_for(self, contents):
+        prompt = contents if isinstance(contents, str) else next(
+            (part for part in contents if isinstance(part, str)), '')
+        reply = random.choice(REPLIES)
+        if 'JSON array of search queries' in prompt:
+            return json.dumps(["replacement parts", "repair toolkit", "pentalobe screwdriver"])
+        if 'running summary' in prompt:
+            return 'User is repairing a household device; basic troubleshooting steps were given.'
+        if 'Transcribe the following audio' in prompt:
+            return 'Why does it make a grinding noise when I turn it on?'
+        if '"transcript"' in prompt:
+            return json.dumps({'transcript': 'Why does it make a grinding noise when I turn it on?', 'reply': reply})
+        return reply
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        with self._lock:
+            self.calls += 1
+        self.latency.sleep()
+        if random.random() < self.failure_rate:
+            raise RuntimeError('Fake Gemini failure')
+        text = self._reply_for(contents)
+        if not stream:
+            return FakeResponse(text)
+        return self._stream(text)
+
+    def _stream(self, text):
+        size = max(len(text) // self.stream_chunks, 1)
+        for start in range(0, len(text), size):
+            if start and self.chunk_latency:
+                self.chunk_latency.sleep()
+            yield FakeResponse(text[start:start + size])
+
+
+class _FakeTextToSpeech:
+    def __init__(self, owner):
+        self.owner = owner
+
+    def convert(self, text, voice_id, model_id):
+        owner = self.owner
+        owner.latency.sleep()
+        if random.random() < owner.failure_rate:
+            raise RuntimeError('Fake ElevenLabs failure')
+        # Roughly 1 KB of MP3 per 15 characters, delivered in 4 KB chunks
+        audio = os.urandom(max(len(text) * 1024 // 15, 1024))
+
+        def chunks():
+            for start in range(0, len(audio), 4096):
+                yield audio[start:start + 4096]
+        return chunks()
+
+
+class FakeElevenLabs:
+    """Stand-in for elevenlabs.client.ElevenLabs (only text_to_speech.convert)."""
+
+    def __init__(self, latency, failure_rate=0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.text_to_speech = _FakeTextToSpeech(self)
+
+
+# ---------------------------------------------------------------------------
+# Payloads
+# ---------------------------------------------------------------------------
+
+def make_frame(width=1280, height=720, seed=0):
+    """A 720p JPEG with enough texture to compress like a real camera frame."""
+    from PIL import Image, ImageDraw
+    rng = random.Random(seed)
+    image = Image.new('RGB', (width, height), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(400):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.rectangle([x, y, x + rng.randrange(10, 160), y + rng.randrange(10, 120)],
+                       fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    noise = Image.effect_noise((width, height), 24).convert('RGB')
+    image = Image.blend(image, noise, 0.2)
+    out = io.BytesIO()
+    image.save(out, format='JPEG', quality=80)
+    return out.getvalue()
+
+
+def make_audio(seconds=4, silence=0.75, rate=16000, seed=0):
+    """
+    A 16-bit mono WAV voice clip the server can really decode and trim: `silence` seconds
+    of low background noise either side of a syllable-modulated 220 Hz tone.
+    """
+    rng = random.Random(seed)
+    samples = array('h')
+    for i in range(int(seconds * rate)):
+        t = i / rate
+        noise = rng.randint(-40, 40)
+        if silence <= t < seconds - silence:
+            # ~4 "syllables" a second
+            envelope = 0.5 + 0.5 * math.sin(2 * math.pi * 4 * t)
+            samples.append(int(9000 * envelope * math.sin(2 * math.pi * 220 * t)) + noise)
+        else:
+            samples.append(noise)
+    out = io.BytesIO()
+    with wave.open(out, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(samples.tobytes())
+    return out.getvalue()
+
+
+# ---------------------------------------------------------------------------
+# Load generator
+# ---------------------------------------------------------------------------
+
+QUESTIONS = [
+    "What is this and why won't it turn on?",
+    "How do I fix this?",
+    "What part do I need to replace, and where can I buy it?",
+    "Is it safe to open it myself?",
+]
+
+
+def run_session(client, session_index, turns, frames, audio, results):
+    headers = {'X-Session-Id': f'bench-{session_index}'}
+    for turn in range(turns):
+        frame = frames[(session_index + turn) % len(frames)]
+        if turn % 3 == 2:
+            endpoint = '/api/process_audio'
+            data = {
+                'audio': (io.BytesIO(audio), 'voice.wav', 'audio/wav'),
+                'latest_frame': (io.BytesIO(frame), 'frame.jpg', 'image/jpeg'),
+            }
+        else:
+            endpoint = '/api/chat'
+            data = {
+                'message': QUESTIONS[(session_index + turn) % len(QUESTIONS)],
+                'image': (io.BytesIO(frame), 'frame.jpg', 'image/jpeg'),
+            }
+        start = time.perf_counter()
+        response = client.post(endpoint, data=data, headers=headers, content_type='multipart/form-data')
+        elapsed = time.perf_counter() - start
+        results.record(endpoint, elapsed)
+        if response.status_code != 200:
+            results.record(f'{endpoint} errors', elapsed)
+            continue
+        # Fetch the reply's audio the way the browser does, after the text has arrived
+        tts_url = (response.get_json(silent=True) or {}).get('tts_url')
+        if tts_url:
+            start = time.perf_counter()
+            tts_response = client.get(tts_url, headers=headers)
+            elapsed = time.perf_counter() - start
+            results.record('/api/tts', elapsed)
+            if tts_response.status_code != 200:
+                results.record('/api/tts errors', elapsed)
+
+
+def run_benchmark(args):
+    scale = args.time_scale
+    gemini = FakeGenerativeModel(Latency(args.gemini_latency, scale), failure_rate=args.gemini_failure_rate,
+                                 stream_chunks=args.stream_chunks, chunk_latency=Latency(args.chunk_latency, scale))
+    tts = FakeElevenLabs(Latency(args.tts_latency, scale), failure_rate=args.tts_failure_rate)
+
+    stages = StageTimings()
+    requests_timing = StageTimings()
+
+    # Swap in the fakes and time each stage
+    server.model = gemini
+    server.elevenlabs_client = tts
+    gemini.generate_content = stages.timed('gemini', gemini.generate_content)
+    tts.text_to_speech.convert = stages.timed('tts', tts.text_to_speech.convert)
+    server.preprocess_frame = stages.timed('frame_preprocess', server.preprocess_frame)
+    # The bench clip is a plain WAV, so it must always be decoded and trimmed, ffmpeg or not
+    audio_check = AudioCheck()
+    server.preprocess_audio = stages.timed('audio_preprocess', audio_check.wrap(server.preprocess_audio))
+    server.format_recent_history_for_prompt = stages.timed('history_format', server.format_recent_history_for_prompt)
+    server.find_product_links = stages.timed('links', server.find_product_links)
+    if args.no_response_cache:
+        server.RESPONSE_CACHE_ENABLED = False
+
+    frames = [make_frame(seed=i) for i in range(args.distinct_frames)]
+    audio = make_audio()
+    client = server.app.test_client()
+
+    tracemalloc.start()
+    memory_before, _ = tracemalloc.get_traced_memory()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [pool.submit(run_session, client, i, args.turns, frames, audio, requests_timing)
+                   for i in range(args.sessions)]
+        for future in futures:
+            future.result()
+    wall = time.perf_counter() - start
+
+    # Let background work (links, summaries) finish before measuring memory
+    server.links_executor.shutdown(wait=True)
+    server.summary_executor.shutdown(wait=True)
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    request_summary = requests_timing.summary()
+    # Audio fetches ride along with the replies they belong to, so they don't count as requests
+    total_requests = sum(v['count'] for k, v in request_summary.items()
+                         if not k.endswith('errors') and not k.startswith('/api/tts'))
+    return {
+        'config': {
+            'sessions': args.sessions,
+            'turns': args.turns,
+            'concurrency': args.concurrency,
+            'time_scale': scale,
+            'gemini_latency': args.gemini_latency,
+            'tts_latency': args.tts_latency,
+            'response_cache': not args.no_response_cache,
+        },
+        'wall_seconds': wall,
+        'requests': total_requests,
+        'requests_per_second': total_requests / wall if wall else 0.0,
+        'endpoints': request_summary,
+        'stages': stages.summary(),
+        'upstream_calls': {'gemini': gemini.calls},
+        'audio': {'clips': audio_check.clips, 'undecoded': audio_check.undecoded},
+        'memory': {
+            'growth_bytes': memory_after - memory_before,
+            'peak_bytes': memory_peak,
+            'sessions': server.history_store.session_count(),
+            'growth_per_session_bytes': (memory_after - memory_before) / max(args.sessions, 1),
+        },
+    }
+
+
+# ---------------------------------------------------------------------------
+# Start-up time
+# ---------------------------------------------------------------------------
+
+STARTUP_PROBE = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.get_model()
+print(json.dumps({'import': imported - start, 'gemini_client': time.perf_counter() - imported}))
+"""
+
+
+def measure_startup(runs):
+    """Import app.py in `runs` fresh interpreters; time the import and the first get_model() (SDK import)."""
+    samples = {'import': [], 'gemini_client': []}
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', STARTUP_PROBE], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True)
+        # app.py may print warnings first; the timings are the last line
+        timings = json.loads(result.stdout.strip().splitlines()[-1])
+        for name, seconds in timings.items():
+            samples[name].append(seconds)
+    return {name: summarize(values) for name, values in samples.items()}
+
+
+# ---------------------------------------------------------------------------
+# Reporting and baselines
+# ---------------------------------------------------------------------------
+
+def print_report(report, out=sys.stdout):
+    print(f"requests: {report['requests']}  wall: {report['wall_seconds']:.2f}s  "
+          f"throughput: {report['requests_per_second']:.1f} req/s", file=out)
+    for title, section in (('endpoint', report['endpoints']), ('stage', report['stages']),
+                           ('startup', report.get('startup', {}))):
+        if not section:
+            continue
+        print(f"\n{title:<28}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}", file=out)
+        for name, s in section.items():
+            print(f"{name:<28}{s['count']:>7}{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}{s['p99_ms']:>10.1f}", file=out)
+    memory = report['memory']
+    print(f"\nmemory growth: {memory['growth_bytes'] / 1024:.0f} KiB over {memory['sessions']} sessions "
+          f"({memory['growth_per_session_bytes'] / 1024:.1f} KiB/session), peak {memory['peak_bytes'] / 1024 / 1024:.1f} MiB",
+          file=out)
+
+
+def compare_to_baseline(report, baseline, tolerance):
+    """Return a list of human-readable regressions beyond `tolerance` (e.g. 0.15 = 15%)."""
+    regressions = []
+    if report['requests_per_second'] < baseline['requests_per_second'] * (1 - tolerance):
+        regressions.append(f"throughput {report['requests_per_second']:.1f} req/s "
+                           f"< baseline {baseline['requests_per_second']:.1f} req/s")
+    for section in ('endpoints', 'stages', 'startup'):
+        for name, current in report.get(section, {}).items():
+            previous = baseline.get(section, {}).get(name)
+            if not previous or not previous['p95_ms']:
+                continue
+            if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+                regressions.append(f"{name} p95 {current['p95_ms']:.1f} ms > baseline {previous['p95_ms']:.1f} ms")
+    growth = report['memory']['growth_per_session_bytes']
+    previous_growth = baseline.get('memory', {}).get('growth_per_session_bytes')
+    if previous_growth and growth > previous_growth * (1 + tolerance):
+        regressions.append(f"memory {growth / 1024:.1f} KiB/session > baseline {previous_growth / 1024:.1f} KiB/session")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=50, help='virtual users, each a multi-turn conversation')
+    parser.add_argument('--turns', type=int, default=4, help='turns per session (every third is a voice turn)')
+    parser.add_argument('--concurrency', type=int, default=16, help='sessions running at once')
+    parser.add_argument('--distinct-frames', type=int, default=8, help='different 720p frames to rotate through')
+    parser.add_argument('--gemini-latency', default='lognormal:0.8,0.35')
+    parser.add_argument('--chunk-latency', default='fixed:0.05', help='delay between streamed chunks')
+    parser.add_argument('--stream-chunks', type=int, default=8)
+    parser.add_argument('--tts-latency', default='lognormal:0.5,0.3')
+    parser.add_argument('--gemini-failure-rate', type=float, default=0.0)
+    parser.add_argument('--tts-failure-rate', type=float, default=0.0)
+    parser.add_argument('--time-scale', type=float, default=1.0, help='multiply every fake latency (e.g. 0.1 for quick runs)')
+    parser.add_argument('--no-response-cache', action='store_true', help='disable the response cache for the run')
+    parser.add_argument('--startup-runs', type=int, default=5, help='fresh interpreters to time app.py start-up in (0 to skip)')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--json', metavar='PATH', help='also write the full report as JSON')
+    parser.add_argument('--baseline', metavar='PATH', help='compare against a stored report; exit 1 on regression')
+    parser.add_argument('--save-baseline', metavar='PATH', help='store this run as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed regression vs baseline (fraction)')
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    report = run_benchmark(args)
+    if args.startup_runs > 0:
+        report['startup'] = measure_startup(args.startup_runs)
+    print_report(report)
+
+    audio = report['audio']
+    if audio['undecoded']:
+        # Timings from a run that skipped audio preprocessing would make a misleading baseline
+        print(f"\nERROR: {audio['undecoded']} of {audio['clips']} voice clips were sent on without being "
+              f"decoded and trimmed", file=sys.stderr)
+        return 1
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nbaseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(report, baseline, args.tolerance)
+        if regressions:
+            print('\nREGRESSIONS vs baseline:')
+            for line in regressions:
+                print(f'  - {line}')
+            return 1
+        print('\nno regressions vs baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
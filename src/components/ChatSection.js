@@ -1,7 +1,14 @@
 import React, { useState, useEffect, useRef, useCallback } from 'react';
 import ReactMarkdown from 'react-markdown';
+import { sessionHeaders } from '../session';
+import socket from '../socket';
 import './ChatSection.css';
 
+// The latest camera frame, unless the server already has it from the live feed
+const frameToUpload = () => (
+  window.latestVideoFrameOnServer ? null : (window.latestVideoFrame || null)
+);
+
 const ChatSection = () => {
   const [messages, setMessages] = useState([
     {
@@ -29,47 +36,101 @@ const ChatSection = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
   }, []);
 
-  // Function to play TTS audio
-  const playTTSAudio = useCallback((base64Audio) => {
+  // Play a reply's TTS audio; the browser streams it while the server is still synthesizing
+  const playTTSAudio = useCallback((ttsUrl) => {
     try {
-      if (!base64Audio) return;
-      
+      if (!ttsUrl) return;
+
       // Stop any currently playing audio
       if (audioRef.current) {
         audioRef.current.pause();
         audioRef.current.currentTime = 0;
       }
-      
-      // Create audio blob from base64
-      const audioData = atob(base64Audio);
-      const arrayBuffer = new ArrayBuffer(audioData.length);
-      const uint8Array = new Uint8Array(arrayBuffer);
-      
-      for (let i = 0; i < audioData.length; i++) {
-        uint8Array[i] = audioData.charCodeAt(i);
-      }
-      
-      const audioBlob = new Blob([arrayBuffer], { type: 'audio/mpeg' });
-      const audioUrl = URL.createObjectURL(audioBlob);
-      
-      // Create and play audio
-      const audio = new Audio(audioUrl);
+
+      const audio = new Audio(`https://stormhacks2025-hpwt.onrender.com${ttsUrl}`);
       audioRef.current = audio;
-      
+
       audio.play().catch(error => {
         console.warn('Could not play TTS audio:', error);
       });
-      
-      // Clean up URL after playing
-      audio.addEventListener('ended', () => {
-        URL.revokeObjectURL(audioUrl);
-      });
-      
     } catch (error) {
       console.warn('Error playing TTS audio:', error);
     }
   }, []);
 
+  // Sentence-by-sentence TTS: chunks arrive in order and play back to back
+  const ttsQueueRef = useRef([]);
+  const ttsMessageIdRef = useRef(null);
+
+  const playNextTTSChunk = useCallback(() => {
+    if (audioRef.current && !audioRef.current.paused && !audioRef.current.ended) return;
+    const next = ttsQueueRef.current.shift();
+    if (!next) return;
+
+    const audioUrl = URL.createObjectURL(next);
+    const audio = new Audio(audioUrl);
+    audioRef.current = audio;
+    audio.addEventListener('ended', () => {
+      URL.revokeObjectURL(audioUrl);
+      playNextTTSChunk();
+    });
+    audio.play().catch(error => {
+      console.warn('Could not play TTS audio:', error);
+      URL.revokeObjectURL(audioUrl);
+    });
+  }, []);
+
+  const enqueueTTSChunk = useCallback(({ message_id, audio, mime_type }) => {
+    if (!audio) return;
+    // A newer reply interrupts whatever is still being spoken
+    if (ttsMessageIdRef.current !== message_id) {
+      ttsMessageIdRef.current = message_id;
+      ttsQueueRef.current = [];
+      if (audioRef.current) {
+        audioRef.current.pause();
+        audioRef.current.currentTime = 0;
+      }
+    }
+    ttsQueueRef.current.push(new Blob([audio], { type: mime_type || 'audio/mpeg' }));
+    playNextTTSChunk();
+  }, [playNextTTSChunk]);
+
+  // Product links are looked up after the reply is sent. They arrive as a
+  // `product_links` socket event; without a socket connection, poll for them.
+  // The event can beat the HTTP response it belongs to, so links for a message
+  // that isn't shown yet are kept here until it is added.
+  const earlyLinksRef = useRef({});
+
+  const takeEarlyLinks = useCallback((messageId) => {
+    const links = earlyLinksRef.current[messageId];
+    delete earlyLinksRef.current[messageId];
+    return links;
+  }, []);
+
+  const pollProductLinks = useCallback(async (messageId, attempts = 10) => {
+    if (socket.connected || !messageId) return;
+    for (let i = 0; i < attempts; i++) {
+      await new Promise(resolve => setTimeout(resolve, 1500));
+      try {
+        const res = await fetch(`https://stormhacks2025-hpwt.onrender.com/api/links/${messageId}`, {
+          headers: sessionHeaders(),
+        });
+        if (!res.ok) return;
+        const data = await res.json();
+        if (data.status === 'pending') continue;
+        if (data.product_links && data.product_links.length > 0) {
+          setMessages(prev => prev.map(msg => (
+            msg.id === messageId ? { ...msg, product_links: data.product_links } : msg
+          )));
+        }
+        return;
+      } catch (error) {
+        console.warn('Error polling product links:', error);
+        return;
+      }
+    }
+  }, []);
+
   // perform the clear (called from modal "Clear Chat" button)
   const doClearChat = useCallback(async () => {
     const welcome = {
@@ -83,6 +144,7 @@ const ChatSection = () => {
 
     // stop any ongoing TTS audio
     try { 
+      ttsQueueRef.current = [];
       if (audioRef.current) {
         audioRef.current.pause();
         audioRef.current.currentTime = 0;
@@ -98,7 +160,10 @@ const ChatSection = () => {
 
     // server-side clear
     try {
-      const res = await fetch('https://stormhacks2025-hpwt.onrender.com/api/clear_chat', { method: 'POST' });
+      const res = await fetch('https://stormhacks2025-hpwt.onrender.com/api/clear_chat', {
+        method: 'POST',
+        headers: sessionHeaders(),
+      });
       const contentType = res.headers.get('content-type') || '';
       if (!res.ok) {
         console.error('Failed to clear chat on server:', res.status, res.statusText);
@@ -146,6 +211,70 @@ const ChatSection = () => {
     };
   }, []);
 
+  // Streaming replies: grow the placeholder message as chunks arrive
+  useEffect(() => {
+    const handleChunk = ({ message_id, text }) => {
+      setMessages(prev => prev.map(msg => (
+        msg.id === message_id ? { ...msg, message: msg.message + text } : msg
+      )));
+    };
+
+    const handleComplete = (result) => {
+      setMessages(prev => prev.map(msg => (
+        msg.id === result.message_id ? {
+          ...msg,
+          message: result.response || msg.message,
+          timestamp: result.timestamp || msg.timestamp,
+          product_links: result.product_links ?? msg.product_links,
+          streaming: false,
+        } : msg
+      )));
+      setIsSending(false);
+
+      // Play TTS audio if available
+      if (result.tts_url) {
+        playTTSAudio(result.tts_url);
+      }
+    };
+
+    const handleError = ({ message_id, error }) => {
+      console.error('Streaming chat error:', error);
+      setMessages(prev => prev.map(msg => (
+        msg.id === message_id ? {
+          ...msg,
+          message: 'Sorry, there was an error processing your message.',
+          streaming: false,
+        } : msg
+      )));
+      setIsSending(false);
+    };
+
+    const handleLinks = ({ message_id, product_links }) => {
+      if (!product_links || product_links.length === 0) return;
+      setMessages(prev => {
+        if (!prev.some(msg => msg.id === message_id)) {
+          earlyLinksRef.current[message_id] = product_links;
+          return prev;
+        }
+        return prev.map(msg => (msg.id === message_id ? { ...msg, product_links } : msg));
+      });
+    };
+
+    socket.on('chat_chunk', handleChunk);
+    socket.on('product_links', handleLinks);
+    socket.on('chat_complete', handleComplete);
+    socket.on('chat_error', handleError);
+    socket.on('tts_chunk', enqueueTTSChunk);
+
+    return () => {
+      socket.off('chat_chunk', handleChunk);
+      socket.off('product_links', handleLinks);
+      socket.off('chat_complete', handleComplete);
+      socket.off('chat_error', handleError);
+      socket.off('tts_chunk', enqueueTTSChunk);
+    };
+  }, [playTTSAudio, enqueueTTSChunk]);
+
   // useEffect(() => {
   //   const last = messages[messages.length - 1];
   //   if (isSending && last && last.type === 'system') {
@@ -156,11 +285,14 @@ const ChatSection = () => {
   // loadChatHistory moved above effect to avoid hook warnings
   const loadChatHistory = useCallback(async () => {
     try {
-      const response = await fetch('https://stormhacks2025-hpwt.onrender.com/api/get_chat_history');
+      const response = await fetch('https://stormhacks2025-hpwt.onrender.com/api/get_chat_history', {
+        headers: sessionHeaders(),
+      });
       const history = await response.json();
 
       if (Array.isArray(history) && history.length > 0) {
         setMessages(history.map(entry => ({
+          id: entry.message_id,
           type: entry.type,
           message: entry.message,
           timestamp: entry.timestamp,
@@ -188,34 +320,59 @@ const ChatSection = () => {
     setInputMessage('');
     setIsSending(true);
 
+    // Stream the reply over Socket.IO when connected; fall back to plain HTTP otherwise
+    if (socket.connected) {
+      const messageId = `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 8)}`;
+      setMessages(prev => [...prev, {
+        id: messageId,
+        type: 'system',
+        message: '',
+        timestamp: Date.now(),
+        streaming: true,
+      }]);
+      // Any frame not yet on the server goes out as a binary Socket.IO attachment
+      socket.emit('chat_stream', {
+        message,
+        message_id: messageId,
+        image: frameToUpload(),
+      });
+      return;
+    }
+
     try {
-      // Include the latest video frame if available
-      const requestBody = { message };
-      if (window.latestVideoFrame) {
-        requestBody.image = window.latestVideoFrame;
+      // Include the latest video frame if available, as a binary file part
+      const form = new FormData();
+      form.append('message', message);
+      const frame = frameToUpload();
+      if (frame) {
+        form.append('image', frame, 'frame.jpg');
       }
 
       const response = await fetch('https://stormhacks2025-hpwt.onrender.com/api/chat', {
         method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify(requestBody),
+        headers: sessionHeaders(),
+        body: form,
       });
 
       const result = await response.json();
 
       if (result.success) {
+        const earlyLinks = takeEarlyLinks(result.message_id);
         setMessages(prev => [...prev, {
+          id: result.message_id,
           type: 'system',
           message: result.response || '',
           timestamp: result.timestamp || Date.now(),
-          product_links: result.product_links,
+          product_links: result.product_links ?? earlyLinks,
         }]);
+
+        if (result.links_pending) {
+          pollProductLinks(result.message_id);
+        }
         
         // Play TTS audio if available
-        if (result.tts_audio) {
-          playTTSAudio(result.tts_audio);
+        if (result.tts_url) {
+          playTTSAudio(result.tts_url);
         }
       } else {
         throw new Error(result.error || 'Chat failed');
@@ -278,26 +435,33 @@ const ChatSection = () => {
           form.append('audio', blob, 'voice.webm');
           
           // Include the latest video frame if available
-          if (window.latestVideoFrame) {
-            form.append('latest_frame', window.latestVideoFrame);
+          const frame = frameToUpload();
+          if (frame) {
+            form.append('latest_frame', frame, 'frame.jpg');
           }
 
           const res = await fetch('https://stormhacks2025-hpwt.onrender.com/api/process_audio', {
             method: 'POST',
+            headers: sessionHeaders(),
             body: form
           });
           const data = await res.json();
 
           if (data && data.success) {
             // show transcript as the user's message and assistant reply
+            const earlyLinks = takeEarlyLinks(data.message_id);
             setMessages(prev => [...prev,
               { type: 'user', message: data.transcript, timestamp: Date.now() },
-              { type: 'system', message: data.response, timestamp: data.timestamp, product_links: data.product_links }
+              { id: data.message_id, type: 'system', message: data.response, timestamp: data.timestamp, product_links: data.product_links ?? earlyLinks }
             ]);
+
+            if (data.links_pending) {
+              pollProductLinks(data.message_id);
+            }
             
             // Play TTS audio if available
-            if (data.tts_audio) {
-              playTTSAudio(data.tts_audio);
+            if (data.tts_url) {
+              playTTSAudio(data.tts_url);
             }
           } else {
             throw new Error((data && data.error) || 'Voice transcription failed.');
@@ -351,7 +515,7 @@ const ChatSection = () => {
       </div>
 
       <div className="chat-messages">
-        {messages.map((msg, index) => (
+        {messages.filter(msg => !(msg.streaming && !msg.message)).map((msg, index) => (
           <div
             key={index}
             className={`message ${msg.type} ${msg.imageProcessed ? 'image-processed' : ''}`}
@@ -367,7 +531,7 @@ const ChatSection = () => {
             )}
           </div>
         ))}
-        {isSending && (
+        {isSending && !messages.some(msg => msg.streaming && msg.message) && (
           <div className="message system typing" aria-live="polite">
             <div className="typing-dots" aria-hidden="true">
              <span className="dot" />
@@ -1,4 +1,5 @@
 import React, { useState, useRef, useCallback, useEffect } from 'react';
+import socket from '../socket';
 import './VideoSection.css';
 
 const VideoSection = () => {
@@ -21,8 +22,9 @@ const VideoSection = () => {
     setStatus(prev => ({ ...prev, visible: false }));
   }, []);
 
+  // Captures the current frame as a binary JPEG Blob (no base64 data URL)
   const captureCurrentFrame = useCallback(() => {
-    if (!videoRef.current || !canvasRef.current) return null;
+    if (!videoRef.current || !canvasRef.current) return Promise.resolve(null);
     
     const video = videoRef.current;
     const canvas = canvasRef.current;
@@ -32,7 +34,7 @@ const VideoSection = () => {
     canvas.height = video.videoHeight;
     ctx.drawImage(video, 0, 0);
 
-    return canvas.toDataURL('image/jpeg', 0.8);
+    return new Promise(resolve => canvas.toBlob(resolve, 'image/jpeg', 0.8));
   }, []);
 
   const startContinuousRecording = useCallback(() => {
@@ -41,11 +43,21 @@ const VideoSection = () => {
     }
 
     // Capture frame every 2 seconds and store it globally for AI context
-    recordingIntervalRef.current = setInterval(() => {
-      const frameData = captureCurrentFrame();
+    recordingIntervalRef.current = setInterval(async () => {
+      const frameData = await captureCurrentFrame();
       if (frameData) {
         // Store the latest frame globally so AI can access it
         window.latestVideoFrame = frameData;
+        window.latestVideoFrameOnServer = false;
+
+        // Push it to the server's live frame buffer so questions don't have to upload it
+        if (socket.connected) {
+          socket.emit('video_frame', frameData, (ack) => {
+            if (ack && !ack.error && window.latestVideoFrame === frameData) {
+              window.latestVideoFrameOnServer = true;
+            }
+          });
+        }
       }
     }, 2000);
 
@@ -60,6 +72,10 @@ const VideoSection = () => {
     }
     setIsRecording(false);
     window.latestVideoFrame = null;
+    window.latestVideoFrameOnServer = false;
+    if (socket.connected) {
+      socket.emit('video_frame_clear');
+    }
     showStatus('Recording stopped', 'info');
   }, [showStatus]);
 
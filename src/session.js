@@ -0,0 +1,31 @@
+// Stable chat session id for this browser, sent with every API call so the
+// server keeps this conversation separate from everyone else's.
+const SESSION_STORAGE_KEY = 'fixit-session-id';
+
+const createSessionId = () => {
+  if (window.crypto && window.crypto.randomUUID) {
+    return window.crypto.randomUUID();
+  }
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 12)}`;
+};
+
+const loadSessionId = () => {
+  try {
+    let id = window.localStorage.getItem(SESSION_STORAGE_KEY);
+    if (!id) {
+      id = createSessionId();
+      window.localStorage.setItem(SESSION_STORAGE_KEY, id);
+    }
+    return id;
+  } catch (e) {
+    // localStorage can be unavailable (private mode); fall back to a per-page id
+    return createSessionId();
+  }
+};
+
+export const SESSION_ID = loadSessionId();
+
+export const sessionHeaders = (headers = {}) => ({
+  ...headers,
+  'X-Session-Id': SESSION_ID,
+});
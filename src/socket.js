@@ -0,0 +1,10 @@
+import { io } from 'socket.io-client';
+import { SESSION_ID } from './session';
+
+// Shared Socket.IO connection; the session id ties it to the same server-side
+// chat history as our HTTP requests.
+const socket = io('https://stormhacks2025-hpwt.onrender.com', {
+  auth: { session_id: SESSION_ID },
+});
+
+export default socket;
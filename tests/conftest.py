@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+# Keep the suite self-contained: in-memory history and state, no background warm-up
+os.environ.setdefault('HISTORY_DB_PATH', '')
+os.environ.setdefault('STATE_BACKEND', 'memory')
+os.environ.setdefault('WARMUP_ON_START', '0')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModel:
+    """
+    Stands in for the Gemini model: records every call and answers with `reply`, or
+    with the texts queued in `answers` first, one per call.
+    """
+
+    def __init__(self, reply='1. Unplug it and plug it back in.'):
+        self.reply = reply
+        self.answers = []
+        self.calls = []
+
+    def generate_content(self, contents, **kwargs):
+        self.calls.append(contents)
+        if self.answers:
+            return FakeResponse(self.answers.pop(0))
+        if isinstance(contents, list) and 'transcribe the audio' in str(contents[0]):
+            return FakeResponse('{"transcript": "how do I fix this", "reply": "%s"}' % self.reply)
+        return FakeResponse(self.reply)
+
+    def inline_parts(self, prefix):
+        """Inline data parts sent to the model whose mime type starts with `prefix`."""
+        return [part['inline_data'] for contents in self.calls if isinstance(contents, list)
+                for part in contents
+                if isinstance(part, dict) and part.get('inline_data', {}).get('mime_type', '').startswith(prefix)]
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    """A FakeModel in place of Gemini, with TTS turned off."""
+    model = FakeModel()
+    monkeypatch.setattr(app, 'model', model)
+    monkeypatch.setattr(app, 'elevenlabs_client', None)
+    monkeypatch.setattr(app, 'ELEVENLABS_API_KEY', None)
+    app.response_cache.clear()
+    return model
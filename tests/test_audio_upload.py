@@ -0,0 +1,197 @@
+import base64
+import io
+import json
+import math
+import random
+import wave
+from array import array
+
+import pytest
+
+import app
+
+AUDIO = bytes(range(256)) * 8
+AUDIO_B64 = base64.b64encode(AUDIO).decode('ascii')
+
+
+class ChunkedStream:
+    """A request stream that hands out at most `size` bytes per read, whatever is asked for."""
+
+    def __init__(self, data, size):
+        self._data = io.BytesIO(data)
+        self._size = size
+
+    def read(self, _n=-1):
+        return self._data.read(self._size)
+
+
+def read_body(body, chunk_size=None, limit=app.AUDIO_MAX_BYTES):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    stream = ChunkedStream(body, chunk_size) if chunk_size else io.BytesIO(body)
+    audio, mime, fields = app.JsonAudioReader(limit).read(stream)
+    return (audio.read() if audio else None), mime, fields
+
+
+def test_reads_audio_and_other_fields():
+    body = json.dumps({'session_id': 's1', 'audio': AUDIO_B64, 'no_cache': True})
+    audio, mime, fields = read_body(body)
+    assert audio == AUDIO
+    assert mime == 'audio/webm'
+    assert fields['session_id'] == 's1'
+    assert fields['no_cache'] is True
+    # The audio value itself is blanked, not kept in memory
+    assert fields['audio'] == ''
+
+
+def test_escaped_slashes_in_base64():
+    assert '/' in AUDIO_B64
+    body = '{"audio": "%s"}' % AUDIO_B64.replace('/', '\\/')
+    audio, _, _ = read_body(body)
+    assert audio == AUDIO
+
+
+def test_wrapped_base64_lines():
+    wrapped = '\\n'.join(AUDIO_B64[i:i + 76] for i in range(0, len(AUDIO_B64), 76))
+    audio, _, _ = read_body('{"audio": "%s"}' % wrapped)
+    assert audio == AUDIO
+
+
+def test_data_url_sets_mime():
+    body = json.dumps({'audio': 'data:audio/ogg;codecs=opus;base64,' + AUDIO_B64})
+    audio, mime, _ = read_body(body)
+    assert audio == AUDIO
+    assert mime == 'audio/ogg'
+
+
+def test_only_top_level_audio_key_is_decoded():
+    body = json.dumps({
+        'meta': {'audio': 'not base64!', 'tags': ['audio', {'audio': 'x'}]},
+        'audio': AUDIO_B64,
+        'note': 'an "audio" mention',
+    })
+    audio, _, fields = read_body(body)
+    assert audio == AUDIO
+    assert fields['meta'] == {'audio': 'not base64!', 'tags': ['audio', {'audio': 'x'}]}
+    assert fields['note'] == 'an "audio" mention'
+
+
+def test_audio_inside_a_value_string_is_not_a_key():
+    body = json.dumps({'question': 'audio', 'audio': AUDIO_B64})
+    audio, _, fields = read_body(body)
+    assert audio == AUDIO
+    assert fields['question'] == 'audio'
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64])
+def test_any_chunk_boundaries(chunk_size):
+    body = json.dumps({'question': 'café ☕', 'audio': 'data:audio/wav;base64,' + AUDIO_B64},
+                      ensure_ascii=False)
+    audio, mime, fields = read_body(body, chunk_size=chunk_size)
+    assert audio == AUDIO
+    assert mime == 'audio/wav'
+    assert fields['question'] == 'café ☕'
+
+
+def test_missing_padding_is_tolerated():
+    audio, _, _ = read_body('{"audio": "%s"}' % base64.b64encode(b'abcd').decode().rstrip('='))
+    assert audio == b'abcd'
+
+
+@pytest.mark.parametrize('body', ['[1, 2, 3]', '["audio", "AAAA"]', '"audio"', '42'])
+def test_non_object_body_has_no_audio(body):
+    audio, _, fields = read_body(body)
+    assert audio is None
+    assert fields == {}
+
+
+def test_no_audio_field():
+    audio, _, fields = read_body('{"question": "hi"}')
+    assert audio is None
+    assert fields == {'question': 'hi'}
+
+
+@pytest.mark.parametrize('body', [
+    '{"audio": "%s' % AUDIO_B64,
+    '{"audio": "AAAA"',
+    '{"audio": "AAAA", "x": }',
+])
+def test_malformed_json(body):
+    with pytest.raises(app.AudioError):
+        read_body(body)
+
+
+@pytest.mark.parametrize('value', ['AA!A', 'AA\\"AA', 'data:audio/webm;base64'])
+def test_invalid_audio_value(value):
+    with pytest.raises(app.AudioError):
+        read_body('{"audio": "%s"}' % value)
+
+
+def test_oversized_audio_is_rejected():
+    with pytest.raises(app.AudioError) as excinfo:
+        read_body(json.dumps({'audio': AUDIO_B64}), limit=len(AUDIO) - 1)
+    assert excinfo.value.status == 413
+
+
+# ---------------------------------------------------------------------------
+# Upload -> spool -> preprocess_audio, through the real request paths
+# ---------------------------------------------------------------------------
+
+def make_wav(speech=2.0, silence=1.0, rate=16000):
+    """16-bit mono WAV: `silence` seconds of quiet noise either side of a 220 Hz tone."""
+    rng = random.Random(0)
+    samples = array('h')
+    for i in range(int((speech + 2 * silence) * rate)):
+        t = i / rate
+        tone = 8000 * math.sin(2 * math.pi * 220 * t) if silence <= t < silence + speech else 0
+        samples.append(int(tone) + rng.randint(-30, 30))
+    out = io.BytesIO()
+    with wave.open(out, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(samples.tobytes())
+    return out.getvalue()
+
+
+WAV = make_wav()
+
+
+def post_wav(client, form):
+    if form == 'multipart':
+        return client.post('/api/process_audio', content_type='multipart/form-data',
+                           data={'audio': (io.BytesIO(WAV), 'voice.wav', 'audio/wav')})
+    if form == 'raw':
+        return client.post('/api/process_audio', data=WAV, content_type='audio/wav')
+    return client.post('/api/process_audio',
+                       json={'audio': 'data:audio/wav;base64,' + base64.b64encode(WAV).decode('ascii')})
+
+
+@pytest.mark.parametrize('form', ['multipart', 'raw', 'json'])
+def test_uploaded_wav_is_trimmed_without_ffmpeg(form, fake_model, monkeypatch):
+    monkeypatch.setattr(app, 'FFMPEG_BIN', None)
+    response = post_wav(app.app.test_client(), form)
+    assert response.status_code == 200, response.get_data(as_text=True)
+    assert response.get_json()['transcript'] == 'how do I fix this'
+    [sent] = fake_model.inline_parts('audio/')
+    assert sent['mime_type'] == 'audio/wav'
+    # About 1.9 s of the 2 s of silence is cut; the padding around the speech stays
+    assert len(sent['data']) < len(WAV) * 0.7
+    with wave.open(io.BytesIO(sent['data']), 'rb') as wav:
+        assert 2.0 <= wav.getnframes() / wav.getframerate() < 2.5
+
+
+def test_load_audio_decodes_a_spooled_upload(monkeypatch):
+    monkeypatch.setattr(app, 'FFMPEG_BIN', None)
+    spool = app.spool_stream(io.BytesIO(WAV), app.AUDIO_MAX_BYTES)
+    audio = app.load_audio(spool, 'audio/wav')
+    assert audio.duration is not None and audio.duration < 2.5
+    assert audio.original_size == len(WAV)
+
+
+def test_silent_upload_is_rejected(fake_model, monkeypatch):
+    monkeypatch.setattr(app, 'FFMPEG_BIN', None)
+    silent = make_wav(speech=0)
+    response = app.app.test_client().post('/api/process_audio', data=silent, content_type='audio/wav')
+    assert response.status_code == 400
+    assert not fake_model.calls
@@ -0,0 +1,112 @@
+import base64
+import io
+import uuid
+
+import pytest
+from PIL import Image
+
+import app
+
+
+def make_image(width=1280, height=720, fmt='JPEG', mode='RGB'):
+    image = Image.new(mode, (width, height))
+    for x in range(0, width, 80):
+        for y in range(0, height, 80):
+            image.paste((x % 256, y % 256, 120) + ((255,) if mode == 'RGBA' else ()), (x, y, x + 80, y + 80))
+    # Sensor noise, so the frame compresses like a camera image
+    noise = Image.effect_noise((width, height), 20).convert(mode)
+    image = Image.blend(image, noise, 0.15)
+    out = io.BytesIO()
+    image.save(out, format=fmt)
+    return out.getvalue()
+
+
+JPEG = make_image()
+
+
+def test_frame_is_downscaled_and_reencoded():
+    frame = app.preprocess_frame(JPEG, max_edge=768)
+    assert frame.mime_type == 'image/jpeg'
+    assert frame.size == (768, 432)
+    assert len(frame.data) < len(JPEG)
+    assert Image.open(io.BytesIO(frame.data)).size == (768, 432)
+    assert len(frame.phash) == 16
+
+
+def test_small_frames_are_not_upscaled():
+    assert app.preprocess_frame(make_image(320, 240)).size == (320, 240)
+
+
+def test_png_with_alpha_becomes_rgb_jpeg():
+    frame = app.preprocess_frame(make_image(fmt='PNG', mode='RGBA'))
+    image = Image.open(io.BytesIO(frame.data))
+    assert (image.format, image.mode) == ('JPEG', 'RGB')
+
+
+def test_every_payload_form_gives_the_same_frame():
+    data_url = 'data:image/jpeg;base64,' + base64.b64encode(JPEG).decode('ascii')
+    hashes = {app.preprocess_frame(payload).phash
+              for payload in (JPEG, bytearray(JPEG), io.BytesIO(JPEG), data_url, data_url.split(',', 1)[1])}
+    assert len(hashes) == 1
+
+
+def test_roi_crops_before_scaling():
+    frame = app.preprocess_frame(JPEG, max_edge=768, roi=app.parse_roi([0.5, 0.5, 0.25, 0.25]))
+    assert frame.size == (320, 180)
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('{"x": 0.1, "y": 0.2, "w": 0.5, "h": 0.5}', (0.1, 0.2, 0.5, 0.5)),
+    ([0.8, 0.8, 0.5, 0.5], (0.8, 0.8, 0.2, 0.2)),
+    (None, None),
+    ('not json', None),
+])
+def test_parse_roi(value, expected):
+    roi = app.parse_roi(value)
+    if expected is None:
+        assert roi is None
+    else:
+        assert roi == pytest.approx(expected)
+
+
+def test_near_identical_frames_share_a_hash():
+    image = Image.open(io.BytesIO(JPEG))
+    out = io.BytesIO()
+    image.save(out, format='JPEG', quality=60)
+    assert app.preprocess_frame(out.getvalue()).phash == app.preprocess_frame(JPEG).phash
+    flipped = io.BytesIO()
+    image.transpose(Image.FLIP_LEFT_RIGHT).save(flipped, format='JPEG')
+    assert app.preprocess_frame(flipped.getvalue()).phash != app.preprocess_frame(JPEG).phash
+
+
+@pytest.mark.parametrize('payload, message', [
+    (make_image(fmt='GIF'), 'Unsupported frame format'),
+    (b'\xff\xd8\xff' + bytes(500), 'Could not decode frame'),
+    ('data:image/jpeg;base64,AAAAA', 'not valid base64'),
+])
+def test_bad_frames_are_rejected(payload, message):
+    with pytest.raises(app.FrameError, match=message):
+        app.preprocess_frame(payload)
+
+
+def test_oversized_frames_are_rejected_before_decoding(monkeypatch):
+    monkeypatch.setattr(app, 'FRAME_MAX_BYTES', len(JPEG) - 1)
+    with pytest.raises(app.FrameError, match='too large'):
+        app.preprocess_frame(JPEG)
+    with pytest.raises(app.FrameError, match='too large'):
+        app.preprocess_frame(base64.b64encode(JPEG).decode('ascii'))
+    monkeypatch.setattr(app, 'FRAME_MAX_BYTES', len(JPEG))
+    monkeypatch.setattr(app, 'FRAME_MAX_PIXELS', 1280 * 720 - 1)
+    with pytest.raises(app.FrameError, match='dimensions'):
+        app.preprocess_frame(JPEG)
+
+
+def test_chat_sends_the_preprocessed_frame(fake_model):
+    client = app.app.test_client()
+    response = client.post('/api/chat', content_type='multipart/form-data',
+                           data={'message': 'What is this?', 'image': (io.BytesIO(JPEG), 'frame.jpg', 'image/jpeg')},
+                           headers={'X-Session-Id': uuid.uuid4().hex})
+    assert response.status_code == 200
+    [sent] = fake_model.inline_parts('image/')
+    assert sent['mime_type'] == 'image/jpeg'
+    assert max(Image.open(io.BytesIO(sent['data'])).size) == app.FRAME_MAX_EDGE
@@ -0,0 +1,88 @@
+import time
+
+import app
+
+
+def entry(message):
+    return {'timestamp': time.time(), 'type': 'user', 'message': message}
+
+
+def open_store(path, shared=False, **kwargs):
+    return app.SessionHistoryStore(log=app.HistoryLog(str(path), flush_interval=0.01, shared=shared), **kwargs)
+
+
+def test_history_survives_a_restart(tmp_path):
+    path = tmp_path / 'history.sqlite3'
+    store = open_store(path)
+    for message in ('one', 'two', 'three'):
+        store.append('a', entry(message))
+    store.append('b', entry('other session'))
+    store.log.flush()
+
+    restarted = open_store(path)
+    entries, last_seq = restarted.page('a')
+    assert [(e['seq'], e['message']) for e in entries] == [(1, 'one'), (2, 'two'), (3, 'three')]
+    assert last_seq == 3
+    restarted.append('a', entry('four'))
+    assert restarted.page('a', since=3)[0][0]['seq'] == 4
+
+
+def test_reset_is_logged_not_deleted(tmp_path):
+    path = tmp_path / 'history.sqlite3'
+    store = open_store(path)
+    store.append('a', entry('before'))
+    store.append('a', entry('also before'))
+    store.reset('a')
+    store.append('a', entry('after'))
+    store.log.flush()
+
+    entries, last_seq = open_store(path).page('a')
+    assert [e['message'] for e in entries] == ['after']
+    assert last_seq == 4
+    # The old rows are still in the log
+    assert len(store.log.changes_since('a', 0)) == 4
+
+
+def test_only_the_newest_entries_are_loaded(tmp_path):
+    path = tmp_path / 'history.sqlite3'
+    store = open_store(path)
+    for i in range(6):
+        store.append('a', entry(f'm{i}'))
+    store.log.flush()
+    assert [e['message'] for e in open_store(path, max_entries=2).all('a')] == ['m4', 'm5']
+
+
+def test_workers_sharing_a_log_see_one_history(tmp_path):
+    path = tmp_path / 'history.sqlite3'
+    first, second = open_store(path, shared=True), open_store(path, shared=True)
+    first.append('a', entry('w1 one'))
+    second.append('a', entry('w2 one'))
+    first.append('a', entry('w1 two'))
+    second.reset('a', [entry('w2 after reset')])
+    first.append('a', entry('w1 three'))
+    for store in (first, second):
+        entries, last_seq = store.page('a')
+        assert [e['message'] for e in entries] == ['w2 after reset', 'w1 three']
+        assert [e['seq'] for e in entries] == [5, 6]
+        assert last_seq == 6
+
+
+def test_history_endpoint_pages_and_supports_etags():
+    client = app.app.test_client()
+    headers = {'X-Session-Id': 'history-endpoint-test'}
+    app.history_store.reset('history-endpoint-test')
+    _, start = app.history_store.page('history-endpoint-test')
+    for i in range(5):
+        app.history_store.append('history-endpoint-test', entry(f'm{i}'))
+
+    response = client.get(f'/api/get_chat_history?since={start + 1}&limit=2', headers=headers)
+    assert [e['message'] for e in response.get_json()] == ['m1', 'm2']
+    assert response.headers['X-History-Seq'] == str(start + 5)
+
+    response = client.get('/api/get_chat_history?limit=1', headers=headers)
+    assert [e['message'] for e in response.get_json()] == ['m4']
+    etag = response.headers['ETag']
+    assert client.get('/api/get_chat_history?limit=1', headers={**headers, 'If-None-Match': etag}).status_code == 304
+
+    app.history_store.append('history-endpoint-test', entry('m5'))
+    assert client.get('/api/get_chat_history?limit=1', headers={**headers, 'If-None-Match': etag}).status_code == 200
@@ -0,0 +1,107 @@
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def make_store(monkeypatch):
+    """Builds stores whose rolling summaries are made locally instead of by Gemini."""
+    monkeypatch.setattr(app, 'summarize_history', lambda summary, lines: f'{len(lines)} earlier lines')
+    stores = []
+
+    def make(**kwargs):
+        store = app.SessionHistoryStore(**kwargs)
+        stores.append(store)
+        return store
+
+    yield make
+    # Let background summaries finish before summarize_history is restored
+    deadline = time.monotonic() + 2
+    while any(session.context.summarizing for store in stores for session in store._sessions.values()):
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def entry(message, kind='user'):
+    return {'timestamp': time.time(), 'type': kind, 'message': message}
+
+
+def messages(store, session_id):
+    return [e['message'] for e in store.all(session_id)]
+
+
+def test_sessions_are_kept_apart(make_store):
+    store = make_store()
+    store.append('a', entry('hello from a'))
+    store.append('b', entry('hello from b'))
+    store.append('a', entry('again from a'))
+    assert messages(store, 'a') == ['hello from a', 'again from a']
+    assert messages(store, 'b') == ['hello from b']
+    assert store.session_count() == 2
+
+
+def test_each_session_is_a_bounded_ring_buffer(make_store):
+    store = make_store(max_entries=5)
+    for i in range(12):
+        store.append('a', entry(f'm{i}'))
+    assert messages(store, 'a') == ['m7', 'm8', 'm9', 'm10', 'm11']
+    # seqs keep counting past the entries that fell out
+    assert [e['seq'] for e in store.all('a')] == [8, 9, 10, 11, 12]
+
+
+def test_least_recently_used_sessions_are_evicted(make_store):
+    store = make_store(max_sessions=2)
+    store.append('a', entry('a'))
+    store.append('b', entry('b'))
+    store.append('a', entry('a again'))
+    store.append('c', entry('c'))
+    assert store.session_count() == 2
+    assert messages(store, 'b') == []
+    assert messages(store, 'a') == ['a', 'a again']
+
+
+def test_idle_sessions_expire(make_store, monkeypatch):
+    store = make_store(ttl=60)
+    store.append('a', entry('old'))
+    now = time.time()
+    monkeypatch.setattr(app.time, 'time', lambda: now + 61)
+    store.append('b', entry('new'))
+    assert store.session_count() == 1
+    assert messages(store, 'a') == []
+
+
+def test_page_since_and_limit(make_store):
+    store = make_store()
+    for i in range(6):
+        store.append('a', entry(f'm{i}'))
+    entries, last_seq = store.page('a', since=2, limit=3)
+    assert [e['seq'] for e in entries] == [3, 4, 5]
+    assert last_seq == 6
+    entries, _ = store.page('a', limit=2)
+    assert [e['message'] for e in entries] == ['m4', 'm5']
+    assert store.page('a', since=6) == ([], 6)
+    assert store.page('unknown') == ([], 0)
+
+
+def test_reset_replaces_history_and_moves_the_cursor(make_store):
+    store = make_store()
+    store.append('a', entry('first'))
+    store.append('a', entry('second'))
+    store.reset('a', [entry('kept')])
+    entries, last_seq = store.page('a')
+    assert [e['message'] for e in entries] == ['kept']
+    assert last_seq == 4
+    store.reset('a')
+    assert store.page('a') == ([], 5)
+
+
+def test_prompt_context_renders_recent_turns(make_store):
+    store = make_store()
+    store.append('a', entry('my kettle leaks'))
+    store.append('a', entry('1. Check the seal.', kind='system'))
+    context = store.prompt_context('a', limit=16)
+    assert 'my kettle leaks' in context
+    assert '1. Check the seal.' in context
+    assert store.prompt_context('b', limit=16) == ''
@@ -0,0 +1,40 @@
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def client(fake_model, monkeypatch):
+    monkeypatch.setattr(app, 'search_for_products',
+                        lambda query: [{'title': query, 'url': 'https://shop.example/' + query.replace(' ', '-')}])
+    return app.app.test_client()
+
+
+def poll(client, session_id, message_id):
+    deadline = time.monotonic() + 5
+    while True:
+        response = client.get(f'/api/links/{message_id}', headers={'X-Session-Id': session_id})
+        if response.status_code != 200 or response.get_json()['status'] != 'pending':
+            return response
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_lookup_result_is_polled_by_message_id(client):
+    assert app.start_link_lookup('links-a', 'm-1', 'Replace the battery, part number 661-17933.')
+    response = poll(client, 'links-a', 'm-1')
+    assert response.get_json()['status'] == 'done'
+    assert response.get_json()['search_queries'][0] == 'battery 661-17933'
+
+
+def test_sessions_reusing_a_message_id_keep_their_own_jobs(client):
+    # chat_stream message ids come from the client, so two sessions can send the same one
+    assert app.start_link_lookup('links-owner', 'shared-id', 'Replace the battery.')
+    assert app.start_link_lookup('links-other', 'shared-id', 'Buy a new water filter.')
+    owner = poll(client, 'links-owner', 'shared-id').get_json()
+    other = poll(client, 'links-other', 'shared-id').get_json()
+    assert owner['search_queries'] == ['battery replacement']
+    assert other['search_queries'] == ['water filter replacement']
+    assert client.get('/api/links/shared-id', headers={'X-Session-Id': 'links-third'}).status_code == 404
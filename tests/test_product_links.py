@@ -0,0 +1,89 @@
+import pytest
+
+import app
+
+
+def test_part_number_query_ranks_first():
+    queries, confidence = app.extract_search_queries(
+        "Your Apple iPhone 12 needs a new battery. Replace the battery, part number 661-17933. "
+        "Buy a pentalobe screwdriver too.")
+    assert queries[0] == 'Apple iPhone 12 battery 661-17933'
+    assert 'pentalobe screwdriver' in queries
+    assert confidence == 1.0
+
+
+def test_purchase_intent_is_per_sentence():
+    queries, confidence = app.extract_search_queries(
+        "Check the filter for clogs.\nIf it is torn, replace the water pump.")
+    assert queries[0] == 'water pump replacement'
+    assert 'filter' in queries
+    assert confidence == 0.45
+
+
+def test_generic_terms_are_dropped_for_specific_ones():
+    queries, _ = app.extract_search_queries("Replace the water pump on your Bosch. The pump is behind the kick plate.")
+    assert 'Bosch water pump replacement' in queries
+    assert 'Bosch pump' not in queries
+    assert 'Bosch pump replacement' not in queries
+
+
+def test_query_count_is_capped():
+    text = "Replace the battery, screen, fan, hinge, speaker, camera and charging port."
+    queries, _ = app.extract_search_queries(text)
+    assert 0 < len(queries) <= app.LINKS_MAX_QUERIES
+
+
+def test_nothing_to_shop_for():
+    assert app.extract_search_queries("Unplug it and wait thirty seconds.") == ([], 0.0)
+
+
+@pytest.mark.parametrize('text, expected', [
+    ("Replace the battery.", True),
+    ("You can buy a new charging cable online.", True),
+    ("Purchase part number WPW10130694.", True),
+    ("Replace it.", False),
+    ("Order a new one and pick up a screwdriver.", False),
+    ("You'll need to restart the router.", False),
+])
+def test_needs_product_links(text, expected):
+    assert app.needs_product_links(text) is expected
+
+
+# ---------------------------------------------------------------------------
+# find_product_links
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def searched(monkeypatch):
+    queries = []
+
+    def search(query):
+        queries.append(query)
+        return [{'title': query, 'url': f'https://shop.example/{len(queries)}'}]
+
+    monkeypatch.setattr(app, 'search_for_products', search)
+    return queries
+
+
+def test_confident_local_queries_skip_gemini(fake_model, searched):
+    result = app.find_product_links("Replace the battery on your Apple iPhone 12, part number 661-17933.")
+    assert result['query_source'] == 'local'
+    assert searched[0] == 'Apple iPhone 12 battery 661-17933'
+    assert len(result['links']) == len(searched)
+    assert not fake_model.calls
+
+
+def test_vague_local_queries_ask_gemini(fake_model, searched, monkeypatch):
+    monkeypatch.setattr(app, 'LINKS_LLM_FALLBACK', True)
+    fake_model.answers = ['["Breville BES870 steam wand gasket"]']
+    result = app.find_product_links("You may need to replace the gasket.")
+    assert result['query_source'] == 'llm'
+    assert searched == ['Breville BES870 steam wand gasket']
+    assert len(fake_model.calls) == 1
+
+
+def test_nothing_named_means_no_lookup(fake_model, searched):
+    result = app.find_product_links("Replace it if it still won't start.")
+    assert result['query_source'] == 'none'
+    assert result['links'] == []
+    assert not searched and not fake_model.calls
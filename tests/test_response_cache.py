@@ -0,0 +1,56 @@
+import time
+import uuid
+
+import app
+
+
+def test_key_ignores_trivial_rephrasing():
+    key = app.ResponseCache.make_key('abc', "Why won't it turn on?", '')
+    assert app.ResponseCache.make_key('abc', "  why WON'T it turn on ", '') == key
+    assert app.ResponseCache.make_key('abd', "Why won't it turn on?", '') != key
+    assert app.ResponseCache.make_key('abc', "Why won't it charge?", '') != key
+    assert app.ResponseCache.make_key('abc', "Why won't it turn on?", 'User: it is a kettle') != key
+
+
+def test_entries_expire_and_are_capped(monkeypatch):
+    cache = app.ResponseCache(max_entries=2, ttl=60, state=app.MemoryState())
+    cache.put('a', 'reply a')
+    cache.put('b', 'reply b')
+    assert cache.get('a') == 'reply a'
+    cache.put('c', 'reply c')
+    # 'a' was used more recently than 'b'
+    assert cache.get('b') is None
+    assert cache.get('a') == 'reply a'
+
+    now = time.time()
+    monkeypatch.setattr(app.time, 'time', lambda: now + 61)
+    assert cache.get('c') is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (2, 2)
+
+
+def test_empty_replies_are_not_cached():
+    cache = app.ResponseCache(state=app.MemoryState())
+    cache.put('a', '')
+    assert cache.get('a') is None
+
+
+def ask(client, message, **fields):
+    session = uuid.uuid4().hex
+    return client.post('/api/chat', json={'message': message, **fields}, headers={'X-Session-Id': session}).get_json()
+
+
+def test_repeated_question_is_answered_from_the_cache(fake_model):
+    client = app.app.test_client()
+    first = ask(client, 'My kettle will not boil. What now?')
+    second = ask(client, 'my kettle will not boil what now')
+    assert (first['cached'], second['cached']) == (False, True)
+    assert second['response'] == first['response']
+    assert len(fake_model.calls) == 1
+
+
+def test_no_cache_flag_bypasses_the_cache(fake_model):
+    client = app.app.test_client()
+    ask(client, 'My kettle will not boil.')
+    assert ask(client, 'My kettle will not boil.', no_cache=True)['cached'] is False
+    assert len(fake_model.calls) == 2
@@ -0,0 +1,74 @@
+import os
+
+import app
+
+
+def test_memory_tier_evicts_least_recently_used_by_size():
+    cache = app.TTSCache(memory_bytes=10)
+    cache.put('a', b'aaaa')
+    cache.put('b', b'bbbb')
+    assert cache.get('a') == b'aaaa'
+    cache.put('c', b'cccc')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'aaaa'
+    assert cache.get('c') == b'cccc'
+    assert cache.stats()['memory_bytes'] == 8
+
+
+def test_clips_larger_than_the_memory_tier_are_not_kept():
+    cache = app.TTSCache(memory_bytes=4)
+    cache.put('a', b'too long')
+    assert cache.get('a') is None
+
+
+def test_disk_tier_outlives_the_process_and_is_promoted(tmp_path):
+    app.TTSCache(memory_bytes=1024, disk_dir=str(tmp_path)).put('ab12', b'mp3 bytes')
+    cache = app.TTSCache(memory_bytes=1024, disk_dir=str(tmp_path))
+    assert cache.get('ab12') == b'mp3 bytes'
+    assert cache.get('ab12') == b'mp3 bytes'
+    stats = cache.stats()
+    assert (stats['disk_hits'], stats['memory_hits']) == (1, 1)
+
+
+def test_disk_tier_is_pruned_to_its_budget(tmp_path):
+    cache = app.TTSCache(memory_bytes=0, disk_dir=str(tmp_path), disk_bytes=250)
+    for i in range(5):
+        cache.put(f'{i:02d}key', bytes(100))
+        # Prunes oldest first by mtime; keep them distinct on coarse filesystems
+        os.utime(cache._path(f'{i:02d}key'), (i, i))
+    kept = [i for i in range(5) if os.path.exists(cache._path(f'{i:02d}key'))]
+    assert kept == [3, 4]
+
+
+class FakeTextToSpeech:
+    def __init__(self):
+        self.texts = []
+
+    def convert(self, text, voice_id, model_id):
+        self.texts.append(text)
+        return iter([b'ID3', text.encode('utf-8')])
+
+
+class FakeElevenLabs:
+    def __init__(self):
+        self.text_to_speech = FakeTextToSpeech()
+
+
+def test_repeated_text_is_synthesized_once(monkeypatch):
+    client = FakeElevenLabs()
+    monkeypatch.setattr(app, 'elevenlabs_client', client)
+    monkeypatch.setattr(app, 'tts_cache', app.TTSCache(memory_bytes=1024))
+    chunks = []
+    first = app.synthesize_speech('Unplug the kettle.', on_chunk=chunks.append)
+    second = app.synthesize_speech('Unplug the kettle.', on_chunk=chunks.append)
+    assert first == second == b'ID3Unplug the kettle.'
+    assert client.text_to_speech.texts == ['Unplug the kettle.']
+    # Cached audio is returned whole, not streamed again
+    assert chunks == [b'ID3', b'Unplug the kettle.']
+
+
+def test_cache_key_covers_voice_and_model():
+    key = app.TTSCache.make_key('Hello there.', 'voice-1', 'model-1')
+    assert app.TTSCache.make_key('Hello there.', 'voice-2', 'model-1') != key
+    assert app.TTSCache.make_key('Hello there.', 'voice-1', 'model-2') != key
+    assert app.TTSCache.make_key('Hello there!', 'voice-1', 'model-1') != key
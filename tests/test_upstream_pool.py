@@ -0,0 +1,122 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def make_pool(max_concurrent=1, max_queue=8, queue_timeout=5.0, max_per_session=4):
+    return app.UpstreamPool('test', max_concurrent, max_queue, queue_timeout, max_per_session)
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out waiting for the pool'
+        time.sleep(0.001)
+
+
+def queue_call(pool, session_id, on_run=None):
+    """Start a thread that waits in the pool's queue; returns once it is queued."""
+    queued = pool._queued
+    errors = []
+
+    def call():
+        try:
+            pool.acquire(session_id)
+        except app.UpstreamOverloaded as e:
+            errors.append(e)
+            return
+        try:
+            if on_run:
+                on_run()
+        finally:
+            pool.release()
+
+    thread = threading.Thread(target=call, daemon=True)
+    thread.start()
+    wait_for(lambda: pool._queued > queued)
+    thread.errors = errors
+    return thread
+
+
+def test_runs_immediately_while_below_the_limit():
+    pool = make_pool(max_concurrent=2)
+    pool.acquire('a')
+    pool.acquire('b')
+    assert pool._active == 2 and pool._queued == 0
+    pool.release()
+    pool.release()
+    assert pool._active == 0
+
+
+def test_waiting_sessions_are_served_round_robin():
+    pool = make_pool()
+    order = []
+    pool.acquire('holder')
+    threads = [queue_call(pool, session, lambda label=label: order.append(label))
+               for session, label in [('a', 'a1'), ('a', 'a2'), ('a', 'a3'), ('b', 'b1'), ('c', 'c1'), ('b', 'b2')]]
+    pool.release()
+    for thread in threads:
+        thread.join(2)
+    assert order == ['a1', 'b1', 'c1', 'a2', 'b2', 'a3']
+    assert pool._active == 0 and pool._queued == 0
+
+
+def test_full_queue_is_rejected_with_503():
+    pool = make_pool(max_queue=1)
+    pool.acquire('holder')
+    waiter = queue_call(pool, 'a')
+    assert pool.is_full()
+    with pytest.raises(app.UpstreamOverloaded) as excinfo:
+        pool.acquire('b')
+    assert excinfo.value.status == 503
+    assert 'queue full' in str(excinfo.value)
+    pool.release()
+    waiter.join(2)
+    assert not waiter.errors
+    assert not pool.is_full()
+
+
+def test_session_over_its_share_is_rejected_with_429():
+    pool = make_pool(max_per_session=2)
+    pool.acquire('holder')
+    waiters = [queue_call(pool, 'a'), queue_call(pool, 'a')]
+    with pytest.raises(app.UpstreamOverloaded) as excinfo:
+        pool.acquire('a')
+    assert excinfo.value.status == 429
+    # Other sessions still get a place in the queue
+    waiters.append(queue_call(pool, 'b'))
+    pool.release()
+    for waiter in waiters:
+        waiter.join(2)
+        assert not waiter.errors
+
+
+def test_queue_timeout_gives_up_and_leaves_the_queue():
+    pool = make_pool(queue_timeout=0.05)
+    pool.acquire('holder')
+    with pytest.raises(app.UpstreamOverloaded) as excinfo:
+        pool.acquire('a')
+    assert excinfo.value.status == 503
+    assert 'queue timeout' in str(excinfo.value)
+    assert pool._queued == 0 and not pool._waiting
+    pool.release()
+    assert pool._active == 0
+
+
+def test_admit_checks_without_taking_a_slot():
+    pool = make_pool(max_queue=1, max_per_session=1)
+    pool.admit('a')
+    assert pool._active == 0
+    pool.acquire('holder')
+    pool.admit('a')  # would wait in the queue, which has room
+    waiter = queue_call(pool, 'a')
+    with pytest.raises(app.UpstreamOverloaded) as excinfo:
+        pool.admit('b')
+    assert excinfo.value.status == 503
+    assert pool._active == 1 and pool._queued == 1
+    pool.release()
+    waiter.join(2)
+    assert pool._active == 0 and pool._queued == 0
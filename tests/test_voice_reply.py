@@ -0,0 +1,69 @@
+import pytest
+
+import app
+
+
+def test_plain_json():
+    text = '{"transcript": "why won\'t it turn on", "reply": "1. Charge it."}'
+    assert app.parse_voice_reply(text) == ("why won't it turn on", '1. Charge it.')
+
+
+def test_code_fence_and_escapes():
+    text = '```json\n{"transcript": "is it \\"dead\\"?", "reply": "1. Hold power.\\n2. Wait."}\n```'
+    assert app.parse_voice_reply(text) == ('is it "dead"?', '1. Hold power.\n2. Wait.')
+
+
+def test_text_around_object():
+    text = 'Here you go: {"transcript": "hello", "reply": "Hi."} Hope that helps!'
+    assert app.parse_voice_reply(text) == ('hello', 'Hi.')
+
+
+def test_truncated_keeps_intact_fields():
+    assert app.parse_voice_reply('{"transcript": "hello", "reply": "1. Unplug') == ('hello', None)
+
+
+def test_invalid_json_recovers_fields():
+    text = '{"transcript": "hello", "reply": "Fine.",}'
+    assert app.parse_voice_reply(text) == ('hello', 'Fine.')
+
+
+@pytest.mark.parametrize('text', [None, '', 'no json here', '["a", "b"]', '{"transcript": "  ", "reply": 5}'])
+def test_nothing_usable(text):
+    assert app.parse_voice_reply(text) == (None, None)
+
+
+
+# ---------------------------------------------------------------------------
+# /api/process_audio
+# ---------------------------------------------------------------------------
+
+def post_voice(client):
+    return client.post('/api/process_audio', data=b'\x1aE\xdf\xa3' + bytes(2000), content_type='audio/webm',
+                       headers={'X-Session-Id': 'voice-test'})
+
+
+@pytest.fixture
+def client(fake_model, monkeypatch):
+    # The clip is opaque bytes; preprocessing is covered by the upload tests
+    monkeypatch.setattr(app, 'AUDIO_PREPROCESS_ENABLED', False)
+    app.history_store.reset('voice-test')
+    return app.app.test_client()
+
+
+def test_voice_turn_is_one_model_call(client, fake_model):
+    response = post_voice(client)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['transcript'] == 'how do I fix this'
+    assert body['response'] == fake_model.reply
+    assert len(fake_model.calls) == 1
+
+
+def test_unparseable_voice_reply_falls_back_to_transcribing(client, fake_model):
+    fake_model.answers = ['Sorry, here is your answer without JSON.', 'how do I fix this', '1. Check the fuse.']
+    response = post_voice(client)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['transcript'] == 'how do I fix this'
+    assert body['response'] == '1. Check the fuse.'
+    assert len(fake_model.calls) == 3
@@ -0,0 +1,56 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def warm_up(monkeypatch):
+    """A fresh warm-up behind /api/ready, with connection priming off."""
+    warm_up = app.WarmUp()
+    monkeypatch.setattr(app, 'warm_up', warm_up)
+    monkeypatch.setattr(app, 'WARMUP_ON_START', True)
+    monkeypatch.setattr(app, 'WARMUP_CONNECT', False)
+    monkeypatch.setattr(app, 'ELEVENLABS_API_KEY', None)
+    return warm_up
+
+
+def probe(warm_up):
+    client = app.app.test_client()
+    client.get('/api/ready')
+    warm_up._thread.join(5)
+    return client.get('/api/ready')
+
+
+def test_ready_once_the_clients_are_built(warm_up, fake_model):
+    response = probe(warm_up)
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'ready'
+    assert 'seconds' in response.get_json()['steps']['gemini_client']
+
+
+def test_failed_gemini_client_keeps_the_probe_at_503(warm_up, monkeypatch):
+    attempts = []
+
+    def broken_model():
+        attempts.append(1)
+        raise ImportError('No module named google.generativeai')
+
+    monkeypatch.setattr(app, 'get_model', broken_model)
+    response = probe(warm_up)
+    assert response.status_code == 503
+    assert 'google.generativeai' in response.get_json()['steps']['gemini_client']['error']
+    assert not app.is_ready()
+
+    # The probe retried the warm-up; once the client builds, the server is ready
+    warm_up._thread.join(5)
+    assert len(attempts) == 2
+    monkeypatch.setattr(app, 'get_model', lambda: None)
+    assert probe(warm_up).status_code == 200
+
+
+def test_failed_elevenlabs_client_keeps_the_probe_at_503(warm_up, fake_model, monkeypatch):
+    monkeypatch.setattr(app, 'ELEVENLABS_API_KEY', 'key')
+    monkeypatch.setattr(app, 'get_elevenlabs_client', lambda retry=False: None)
+    response = probe(warm_up)
+    assert response.status_code == 503
+    assert 'could not be built' in response.get_json()['steps']['elevenlabs_client']['error']